@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# acquisition.py
+
+import threading
+import multiprocessing
+from collections import namedtuple
+from Queue import Empty
+import numpy as np
+
+from camera import (TakeImageThread, TakeMainImageThread,
+                    TakeGuiderImageThread)
+from logservice import logs, SourceOf
+from framebus import frames
+from timing import clock
+
+# ------------------------------------------------------------------------------
+# Small, picklable description of a frame held in a SharedFrameRing.
+# This is all that passes between the acquisition process and the main
+# process for each image; the pixels themselves stay in shared memory.
+# readout is the time from the exposure ending to the frame being written,
+# as clocks in different processes cannot be compared on every platform.
+FrameDescriptor = namedtuple('FrameDescriptor',
+                             ['slot', 'seq', 'image_time',
+                              'image_exptime', 'shape', 'readout'])
+
+# ------------------------------------------------------------------------------
+# Ring buffer of image slots in shared memory.
+# A single writer (the acquisition process) fills the slots in turn.
+# Each slot has a sequence counter, which is odd while the slot is being
+# written.  A reader copies a frame out and then checks the counter is
+# unchanged, so a frame which was overwritten while being read is discarded
+# rather than returned half-updated.
+class SharedFrameRing(object):
+    def __init__(self, nslots, maxshape, dtype=np.int32):
+        self.nslots = nslots
+        self.maxshape = tuple(maxshape)
+        self.dtype = np.dtype(dtype)
+        self.slotsize = int(np.product(self.maxshape))
+        nbytes = self.nslots * self.slotsize * self.dtype.itemsize
+        self.buffer = multiprocessing.RawArray('b', nbytes)
+        self.seq = multiprocessing.RawArray('l', self.nslots)
+        self.next_slot = 0
+        self._slots = None
+
+    def __getstate__(self):
+        # numpy views cannot be sent to the child process,
+        # so they are recreated on first use there
+        state = self.__dict__.copy()
+        state['_slots'] = None
+        return state
+
+    def GetSlots(self):
+        if self._slots is None:
+            data = np.frombuffer(self.buffer, dtype=self.dtype)
+            self._slots = data.reshape((self.nslots, self.slotsize))
+        return self._slots
+
+    def Fits(self, image):
+        return image.ndim == len(self.maxshape) and image.size <= self.slotsize
+
+    def Write(self, image, image_time, image_exptime, readout=None):
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.nslots
+        n = image.size
+        self.seq[slot] += 1
+        self.GetSlots()[slot, :n] = image.ravel()
+        self.seq[slot] += 1
+        return FrameDescriptor(slot, self.seq[slot], image_time,
+                               image_exptime, image.shape, readout)
+
+    def Read(self, desc):
+        if self.seq[desc.slot] != desc.seq:
+            return None
+        n = int(np.product(desc.shape))
+        image = self.GetSlots()[desc.slot, :n].reshape(desc.shape).copy()
+        if self.seq[desc.slot] != desc.seq:
+            return None
+        return image
+
+# ------------------------------------------------------------------------------
+# Camera code running inside the acquisition process.
+# This is the normal TakeImageThread, configured from the given camera
+# thread class, but publishing frames into the shared ring and passing
+# log messages and frame descriptors back through a multiprocessing Queue.
+# The exposure time and frame type are shared with the main process via
+# Values.
+class ProcessImageTaker(TakeImageThread):
+    config_attributes = ('continuous', 'camera_id', 'imshape', 'check_period')
+
+    def __init__(self, camera_class, ring, messages,
+                 stopevent, onevent, exptime, light):
+        self.shared_exptime = exptime
+        self.shared_light = light
+        for name in self.config_attributes:
+            setattr(self, name, getattr(camera_class, name))
+        self.ring = ring
+        self.messages = messages
+        TakeImageThread.__init__(self, None, stopevent, onevent,
+                                 exptime.value)
+
+    def SetExpTime(self, exptime):
+        self.shared_exptime.value = exptime
+
+    def GetExpTime(self):
+        return self.shared_exptime.value
+
+    def SetLight(self, light=True):
+        self.shared_light.value = light
+
+    def GetLight(self):
+        return bool(self.shared_light.value)
+
+    def Log(self, text):
+        self.messages.put(('log', text))
+
+    def PublishImage(self, image, image_time, exptime, t_exposed=None):
+        image = np.asarray(image)
+        readout = None if t_exposed is None else clock() - t_exposed
+        if self.ring.Fits(image):
+            desc = self.ring.Write(image, image_time, exptime, readout)
+            self.messages.put(('frame', desc))
+        else:
+            # too large for the ring, so fall back to pickling it
+            self.messages.put(('image', (image, image_time, exptime,
+                                         readout)))
+
+# ------------------------------------------------------------------------------
+# Process which runs a camera, completely separate from the main
+# interpreter, so acquisition timing is not affected by GIL contention
+# from image processing and display in the main process.
+class AcquisitionProcess(multiprocessing.Process):
+    def __init__(self, camera_class, ring, messages,
+                 stopevent, onevent, exptime, light):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.camera_class = camera_class
+        self.ring = ring
+        self.messages = messages
+        self.stopevent = stopevent
+        self.onevent = onevent
+        self.exptime = exptime
+        self.light = light
+
+    def run(self):
+        taker = ProcessImageTaker(self.camera_class, self.ring, self.messages,
+                                  self.stopevent, self.onevent, self.exptime,
+                                  self.light)
+        try:
+            taker.run()
+        finally:
+            self.messages.put(('stopped', None))
+
+# ------------------------------------------------------------------------------
+# Drop-in replacement for a camera thread, which starts an
+# AcquisitionProcess and relays its frames and log messages to the parent.
+# Frames are copied out of shared memory and then published on the frame
+# bus, just as the thread version does.
+# The stop and on events must be multiprocessing.Event instances.
+class TakeImageProcessThread(threading.Thread):
+    camera_class = TakeMainImageThread
+    maxshape = (3072, 3072)
+    nslots = 3
+
+    def __init__(self, parent, stopevent, onevent, exptime):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.parent = parent
+        self.stopevent = stopevent
+        self.onevent = onevent
+        self.topic = self.camera_class.topic
+        self.exptime = multiprocessing.Value('d', exptime)
+        self.light = multiprocessing.Value('b', 1)
+        self.ring = SharedFrameRing(self.nslots, self.maxshape)
+        self.messages = multiprocessing.Queue()
+        self.process = AcquisitionProcess(self.camera_class, self.ring,
+                                          self.messages, self.stopevent,
+                                          self.onevent, self.exptime,
+                                          self.light)
+        self.dropped = 0
+
+    def run(self):
+        self.process.start()
+        try:
+            while True:
+                try:
+                    kind, item = self.messages.get(timeout=1.0)
+                except Empty:
+                    if not self.process.is_alive():
+                        break
+                    continue
+                if kind == 'stopped':
+                    break
+                elif kind == 'log':
+                    self.Log(item)
+                elif kind == 'frame':
+                    image = self.ring.Read(item)
+                    if image is None:
+                        self.dropped += 1
+                        self.Log('Frame overwritten before it was read '
+                                 '({:d} dropped)'.format(self.dropped))
+                    else:
+                        self.PublishImage(image, item.image_time,
+                                          item.image_exptime, item.readout)
+                elif kind == 'image':
+                    self.PublishImage(*item)
+        finally:
+            self.process.join(5.0)
+
+    def SetExpTime(self, exptime):
+        self.exptime.value = exptime
+
+    def GetExpTime(self):
+        return self.exptime.value
+
+    def SetLight(self, light=True):
+        self.light.value = light
+
+    def GetLight(self):
+        return bool(self.light.value)
+
+    def SetWindowing(self, window=False, nx=100, ny=100):
+        self.Log('Windowing is not available with a separate '
+                 'acquisition process')
+
+    def Log(self, text):
+        logs.Post(text, SourceOf(self.parent))
+
+    def PublishImage(self, image, image_time, exptime, readout=None):
+        # the exposure end on this process's clock, leaving out the time
+        # taken to pass the frame across
+        t_exposed = None if readout is None else clock() - readout
+        frames.Publish(self.topic, image, image_time, exptime, t_exposed)
+
+# ------------------------------------------------------------------------------
+# Subclass to obtain images from main camera in a separate process.
+class TakeMainImageProcess(TakeImageProcessThread):
+    def __init__(self, parent, stopevent, onevent, exptime):
+        TakeImageProcessThread.__init__(self, parent, stopevent, onevent,
+                                        exptime)
+        self.start()
+
+# ------------------------------------------------------------------------------
+# Subclass to obtain images from guide camera in a separate process.
+class TakeGuiderImageProcess(TakeImageProcessThread):
+    camera_class = TakeGuiderImageThread
+    maxshape = (1024, 1024)
+    nslots = 4
+
+    def __init__(self, parent, stopevent, onevent, exptime):
+        TakeImageProcessThread.__init__(self, parent, stopevent, onevent,
+                                        exptime)
+        self.start()
@@ -1,19 +1,45 @@
-import wx
 import threading
 import time
+from Queue import Empty
+from collections import OrderedDict
 
 from sxvao import SXVAO
-from logevent import *
+from logservice import logs, SourceOf
+from connections import connections
+from timing import clock
+from orchestrator import Operation, scheduler
 
 # simulate obtaining images for testing
 simulate = False
 
 # ------------------------------------------------------------------------------
-# Class to run AO unit on a separate thread
+# Class to run AO unit on a separate thread, as a service for the whole
+# session, so the serial connection and the state of the AO unit (step
+# counts, calibration) are kept between guiding runs.
 # When run, this connects to the AO unit and listens to a Queue
-# for corrections to make, until the 'Q' command is received.
+# for corrections to make, until the 'Q' command is received (see Shutdown).
+# Corrections are (command, dx, dy) tuples, where command is 'G' to move
+# the AO unit or 'M' the mount by (dx, dy) pixels, or 'GS' or 'MS' to move
+# them by (dx, dy) raw steps, as when calibrating.  They are optionally
+# followed by a deadline (on the timing.clock scale), after which they are
+# skipped, and an Operation, which is completed when the correction has
+# been made (see AOStep).
+# Corrections arriving within minsteptime of the last step are merged (see
+# CorrectionScheduler), and 'K' and 'Q' are handled in the order received.
+# Every offload_period, an 'O' is queued to bleed some of the AO unit's
+# offset from centre into the mount (see SXVAO.Offload), between
+# corrections, instead of recentring all at once when it gets too far.
+# This is not done while training, as it would upset the calibration.
+# Starting and stopping guiding only changes the mode (see SetMode).
+# Corrections with a deadline come from the guide loop, so any still
+# queued when guiding stops are dropped.
+# Each correction made is logged unless verbose is turned off (see
+# SetVerbose), e.g. when they are recorded as telemetry instead.
+# If the connection fails, it is made again when the next command arrives.
 # The AO unit is disconnected before ending.
 class AOThread(threading.Thread):
+    modes = ('idle', 'guiding', 'training')
+
     def __init__(self, parent, corrections,
                  comport, timeout):
         threading.Thread.__init__(self)
@@ -22,95 +48,243 @@ class AOThread(threading.Thread):
         self.comport = comport
         self.timeout = timeout
         self.minsteptime = 0.1  # seconds
+        # mount offload, moving at most offload_max_steps each time, and
+        # only once the AO unit is more than offload_deadband steps out
+        self.offload = True
+        self.offload_period = 1.0  # seconds
+        self.offload_fraction = 0.2
+        self.offload_max_steps = 5
+        self.offload_deadband = 50
         self.AOunit = None
+        self.connected = False
+        self.mode = 'idle'
+        self.verbose = True
+        self.scheduler = CorrectionScheduler()
+        # pixels to steps matrices (see aocalibration.py)
+        self.matrix = None
+        self.mount_matrix = None
 
     def run(self):
         if not simulate:
             self.AOunit = SXVAO(self, self.comport, self.timeout)
-            ok = self.AOunit.Connect()
+            self.AOunit.matrix = self.matrix
+            self.AOunit.mount_matrix = self.mount_matrix
+            self.AOunit.recentre = not self.offload
+            self.AOunit.verbose = self.verbose
+            if self.offload:
+                self.ScheduleOffload()
         else:
             self.Log('Simulating AO')
-            ok = True
-        if not ok:
-            self.Log('Failed to start AO')
-        else:
+        if self.EnsureConnected():
             self.Log('Started AO')
-            try:
-                last_step_time = 0
-                while True:
-                    # avoid sending corrections too quickly to AO unit
-                    dt = time.time() - last_step_time
-                    time.sleep(max(0,  self.minsteptime - dt))
-                    # get the last thing in the queue, in a way that
-                    # avoids never doing anything is the queue is
-                    # currently filling faster than we can empty it
-                    c = self.corrections.get()
-                    n = self.corrections.qsize()
-                    while n > 0:
-                        n -= 1
-                        if c in ['Q', 'K']:
-                            break
-                        c = self.corrections.get()
-                    # process received command
-                    if c == 'Q':
-                        # quit guiding
-                        break
-                    elif c == 'K':
-                        # centre AO unit
-                        if not simulate:
-                            ok = self.AOunit.Centre()
-                        if ok:
-                            self.Log('Centred AO unit')
-                        else:
-                            self.Log('AO unit centring failed')
+        else:
+            self.Log('Failed to start AO, will retry when needed')
+        try:
+            last_step_time = 0
+            while True:
+                # wait for something to do, then until the AO unit can
+                # take another step, merging corrections as they arrive
+                c = self.corrections.get()
+                dt = time.time() - last_step_time
+                if c not in ['Q', 'K', 'O']:
+                    self.Schedule(c)
+                    time.sleep(max(0, self.minsteptime - dt))
+                    control = self.Drain()
+                else:
+                    control = c
+                # merged corrections before any following command
+                if self.scheduler.Pending():
+                    done = self.PerformScheduled()
+                    if done:
                         last_step_time = time.time()
+                if control == 'Q':
+                    # end of session
+                    break
+                elif control == 'K':
+                    # centre AO unit
+                    dt = time.time() - last_step_time
+                    time.sleep(max(0, self.minsteptime - dt))
+                    if not self.EnsureConnected():
+                        self.Log('AO unit not connected')
+                    elif self.Centre():
+                        self.Log('Centred AO unit')
                     else:
-                        # expect (command, dx, dy) correction,
-                        # don't do anything if they are both an
-                        # insignificant fraction of a pixel
-                        done = self.GetAndPerformCorrection(c)
-                        if done:
-                            last_step_time = time.time()
-            finally:
-                if self.AOunit is not None:
-                    self.AOunit.Disconnect()
-                self.Log('Stopped AO')
-
-    def GetAndPerformCorrection(self, c):
-        unknown = True
-        ok = True
+                        self.Log('AO unit centring failed')
+                    last_step_time = time.time()
+                elif control == 'O':
+                    dt = time.time() - last_step_time
+                    if self.mode != 'training' and self.connected:
+                        time.sleep(max(0, self.minsteptime - dt))
+                        try:
+                            self.AOunit.Offload(self.offload_fraction,
+                                                self.offload_max_steps,
+                                                self.offload_deadband)
+                        except EnvironmentError as detail:
+                            self.ConnectionLost(detail)
+                        last_step_time = time.time()
+        finally:
+            if self.connected:
+                connections.Disconnect(self.DeviceId(),
+                                       self.AOunit.Disconnect)
+            self.Log('Stopped AO: {}'.format(self.scheduler.StatsText()))
+
+    def EnsureConnected(self):
+        if self.connected or simulate:
+            return True
+        # close any broken connection, so the port can be opened again
+        self.AOunit.Disconnect()
+        self.connected = connections.Connect(self.DeviceId(),
+                                             self.AOunit.Connect,
+                                             log=self.Log)
+        return self.connected
+
+    def ConnectionLost(self, detail):
+        self.Log('Lost connection to AO unit: {}'.format(detail))
+        self.connected = False
+        connections.SetState(self.DeviceId(), 'failed', str(detail))
+
+    def Centre(self):
+        if simulate:
+            return True
         try:
-            command, dx, dy = c
-            zero = abs(dx) < 1e-3 and abs(dy) < 1e-3
-        except:
-            pass
-        else:
-            if command == 'G':
-                unknown = False
-                if not zero:
-                    if not simulate:
-                        ok = self.AOunit.MakeCorrection(dx, dy)
-                    if ok:
-                        self.Log('Performed AO correction '
-                            '({:.2f},{:.2f})'.format(dx, dy))
-                    else:
-                        self.Log('Failed to perform AO correction')
-            elif command == 'M':
-                unknown = False
-                if not zero:
-                    if not simulate:
-                        ok = self.AOunit.MakeMountCorrection(dx, dy)
-                    if ok:
-                        self.Log('Performed AO mount correction '
-                            '({:.2f},{:.2f})'.format(dx, dy))
-                    else:
-                        self.Log('Failed to perform AO mount correction')
-        if unknown:
+            return self.AOunit.Centre()
+        except EnvironmentError as detail:
+            self.ConnectionLost(detail)
+            return False
+
+    def SetMode(self, mode):
+        # 'idle', 'guiding' or 'training'; this is cheap, as the
+        # connection is kept open whatever the mode
+        if mode not in self.modes:
+            raise ValueError('unknown AO mode {}'.format(mode))
+        if mode != self.mode:
+            self.mode = mode
+            self.Log('AO {}'.format(mode))
+
+    def GetMode(self):
+        return self.mode
+
+    def Shutdown(self, timeout=None):
+        # end the session, disconnecting from the AO unit
+        self.corrections.put('Q')
+        if self.is_alive():
+            self.join(timeout)
+
+    def DeviceId(self):
+        return 'SXVAO port {}'.format(self.comport)
+
+    def Schedule(self, c):
+        if not self.scheduler.Add(c):
             self.Log('Unknown AO correction '
                      '({})'.format(c))
-                
+            if len(c) > 4 and c[4] is not None:
+                c[4].SetResult(False)
+
+    def Drain(self):
+        # schedule everything already queued, up to any 'K', 'Q' or 'O'
+        while True:
+            try:
+                c = self.corrections.get_nowait()
+            except Empty:
+                return None
+            if c in ['Q', 'K', 'O']:
+                return c
+            self.Schedule(c)
+
+    def PerformScheduled(self):
+        stats = self.scheduler.stats
+        stale = stats['stale']
+        merged = self.scheduler.Take(clock(), self.mode == 'guiding')
+        if stats['stale'] > stale:
+            # a newer correction will be along soon
+            self.Log('Skipped stale AO correction '
+                     '({:d} so far)'.format(stats['stale']))
+        done = False
+        for command, dx, dy, ops in merged:
+            if not self.EnsureConnected():
+                self.Log('AO unit not connected')
+                ok = False
+            else:
+                for op in ops:
+                    op.Mark('sent')
+                try:
+                    ok = self.PerformCorrection(command, dx, dy)
+                except EnvironmentError as detail:
+                    self.ConnectionLost(detail)
+                    ok = False
+            done = done or ok
+            for op in ops:
+                op.SetResult(ok)
+        return done
+
+    def PerformCorrection(self, command, dx, dy):
+        # don't do anything if they are both an
+        # insignificant fraction of a pixel
+        ok = True
+        if abs(dx) < 1e-3 and abs(dy) < 1e-3:
+            return ok
+        if command == 'G':
+            if not simulate:
+                ok = self.AOunit.MakeCorrection(dx, dy)
+            if not ok:
+                self.Log('Failed to perform AO correction')
+            elif self.verbose:
+                self.Log('Performed AO correction '
+                    '({:.2f},{:.2f})'.format(dx, dy))
+        elif command == 'M':
+            if not simulate:
+                ok = self.AOunit.MakeMountCorrection(dx, dy)
+            if not ok:
+                self.Log('Failed to perform AO mount correction')
+            elif self.verbose:
+                self.Log('Performed AO mount correction '
+                    '({:.2f},{:.2f})'.format(dx, dy))
+        else:
+            if not simulate and command == 'GS':
+                ok = self.AOunit.MakeStepCorrection(dx, dy)
+            elif not simulate:
+                ok = self.AOunit.MakeMountStepCorrection(dx, dy)
+            if ok:
+                self.Log('Performed {} steps '
+                         '({:.0f},{:.0f})'.format(command, dx, dy))
+            else:
+                self.Log('Failed to perform {} steps'.format(command))
+        return ok
+
+    def ScheduleOffload(self):
+        # queue the next offload, until the session ends
+        def tick():
+            if self.is_alive():
+                self.corrections.put('O')
+                self.ScheduleOffload()
+        scheduler.CallLater(self.offload_period, tick)
+
+    def SetVerbose(self, verbose):
+        self.verbose = verbose
+        if self.AOunit is not None:
+            self.AOunit.verbose = verbose
+
+    def GetPosition(self):
+        # (x, y) position of the AO unit from centre, in steps, or None
+        if self.AOunit is None:
+            return None
+        return -self.AOunit.count_steps_W, self.AOunit.count_steps_N
+
+    def GetStats(self):
+        return dict(self.scheduler.stats)
+
     def Log(self, text):
-        wx.PostEvent(self.parent, LogEvent(text=text))
+        logs.Post(text, SourceOf(self.parent))
+
+    def SetCalibration(self, matrix=None, mount_matrix=None):
+        # set the pixels to steps matrices, leaving any not given
+        if matrix is not None:
+            self.matrix = matrix
+        if mount_matrix is not None:
+            self.mount_matrix = mount_matrix
+        if self.AOunit is not None:
+            self.AOunit.matrix = self.matrix
+            self.AOunit.mount_matrix = self.mount_matrix
 
     def toggle_switch_xy(self):
         if self.AOunit is not None:
@@ -151,4 +325,90 @@ class AOThread(threading.Thread):
         if self.AOunit is not None:
             self.AOunit.mount_steps_per_pixel /= factor
             self.Log('mount_steps_per_pixel = {}'.format(self.AOunit.mount_steps_per_pixel))
-        
+
+# ------------------------------------------------------------------------------
+# Merges corrections waiting to be sent to the AO unit, so that at most one
+# correction per command is made each step, without losing any movement.
+# Moves without a deadline (manual nudges, calibration steps) are summed.
+# Guide loop corrections, which have a deadline, each measure the whole
+# offset remaining, so a newer one replaces an older one, which is counted
+# as superseded; it is added to any summed moves when sent, unless it has
+# passed its deadline or guiding has stopped, when it is counted as stale.
+# stats counts corrections received, merged into another, superseded, stale
+# and unknown, and the merged corrections sent.
+class CorrectionScheduler(object):
+    commands = ('G', 'M', 'GS', 'MS')
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.stats = dict.fromkeys(['received', 'merged', 'superseded',
+                                    'stale', 'unknown', 'sent'], 0)
+
+    def Add(self, c):
+        try:
+            command, dx, dy = c[:3]
+            deadline = c[3] if len(c) > 3 else None
+            op = c[4] if len(c) > 4 else None
+        except (TypeError, ValueError):
+            command = None
+        if command not in self.commands:
+            self.stats['unknown'] += 1
+            return False
+        self.stats['received'] += 1
+        if command in self.pending:
+            self.stats['merged'] += 1
+        else:
+            # summed moves, latest guide correction, and their operations
+            self.pending[command] = [0.0, 0.0, None, []]
+        entry = self.pending[command]
+        if deadline is None:
+            entry[0] += dx
+            entry[1] += dy
+        else:
+            if entry[2] is not None:
+                self.stats['superseded'] += 1
+                if entry[2][3] is not None:
+                    entry[2][3].Cancel()
+            entry[2] = (dx, dy, deadline, op)
+        if deadline is None and op is not None:
+            entry[3].append(op)
+        return True
+
+    def Pending(self):
+        return len(self.pending) > 0
+
+    def Take(self, now, guiding=True):
+        # list of (command, dx, dy, operations) to send now
+        merged = []
+        for command, (dx, dy, guide, ops) in self.pending.items():
+            if guide is not None:
+                gdx, gdy, deadline, op = guide
+                if not guiding or now > deadline:
+                    self.stats['stale'] += 1
+                    if op is not None:
+                        op.SetResult(False)
+                else:
+                    dx += gdx
+                    dy += gdy
+                    if op is not None:
+                        ops = ops + [op]
+            if dx or dy or ops:
+                merged.append((command, dx, dy, ops))
+        self.pending.clear()
+        self.stats['sent'] += len(merged)
+        return merged
+
+    def StatsText(self):
+        return ('{received:d} corrections, {merged:d} merged, {superseded:d} '
+                'superseded, {stale:d} stale, {sent:d} sent'.format(
+                    **self.stats))
+
+# ------------------------------------------------------------------------------
+# Operation (see orchestrator.py) to make an AO ('G') or mount ('M')
+# correction through the given AOThread corrections queue.
+# It completes with True if the correction was made, or is cancelled
+# if it had a deadline and was superseded by a later correction.
+def AOStep(corrections, command, dx, dy, deadline=None):
+    op = Operation('AO step')
+    corrections.put((command, dx, dy, deadline, op))
+    return op
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# aobenchmark.py
+
+from __future__ import division, print_function
+
+import argparse
+import time
+from Queue import Queue
+import numpy as np
+
+from ao import AOThread, AOStep
+from aoemulator import SXVAOEmulator
+from timing import clock
+
+# ------------------------------------------------------------------------------
+# Benchmark of AO corrections made through AOThread and the serial protocol
+# (see sxvao.py), against the SX AO emulator on a pseudo-terminal.
+# Latency is the time from queueing a raw step correction to it being
+# acknowledged, for several sizes of correction, queued far enough apart
+# that the minimum time between steps does not add to it.
+# Throughput is the rate at which corrections are made when guide
+# corrections are queued faster than the AO unit can take them.
+
+def Summary(times):
+    ms = np.array(times) * 1000
+    return 'median {:.1f} ms, 90% {:.1f} ms, max {:.1f} ms'.format(
+        np.median(ms), np.percentile(ms, 90), ms.max())
+
+def Latency(ao, steps, repeats):
+    times = []
+    for i in range(repeats):
+        time.sleep(ao.minsteptime)
+        # alternate directions, so the tip-tilt stays near the centre
+        sign = 1 if i % 2 == 0 else -1
+        op = AOStep(ao.corrections, 'GS', sign * steps, sign * steps)
+        if not op.Result(10.0):
+            raise RuntimeError('AO correction failed')
+        times.append(op.Elapsed())
+    return times
+
+def Throughput(ao, duration, rate):
+    before = ao.GetStats()
+    t_end = clock() + duration
+    while clock() < t_end:
+        dx, dy = np.random.normal(0, 2.0, 2)
+        ao.corrections.put(('G', dx, dy, clock() + 1.0))
+        time.sleep(1 / rate)
+    # let the last one through
+    time.sleep(2 * ao.minsteptime)
+    after = ao.GetStats()
+    return dict((key, after[key] - before[key]) for key in after)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AO corrections '
+                                     'against the SX AO emulator')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--steps', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds of guide corrections for throughput')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='guide corrections queued per second')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='emulated time to handle each command')
+    parser.add_argument('--step-time', type=float, default=0.0005,
+                        help='emulated time per tip-tilt step')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    emulator = SXVAOEmulator(latency=args.latency, step_time=args.step_time)
+    emulator.start()
+    ao = AOThread(None, Queue(), emulator.Port(), 10)
+    log = []
+    ao.Log = print if args.verbose else log.append
+    ao.start()
+    ao.SetMode('guiding')
+    try:
+        AOStep(ao.corrections, 'GS', 0, 0).Result(30.0)
+        if not ao.connected:
+            raise RuntimeError('unable to connect to emulator')
+        for steps in args.steps:
+            times = Latency(ao, steps, args.repeats)
+            print('{:d} step correction: {}'.format(steps, Summary(times)))
+        stats = Throughput(ao, args.duration, args.rate)
+        print('Throughput: {:.1f} corrections/sec from {:.0f} queued/sec '
+              '({merged:d} merged, {superseded:d} superseded, {stale:d} '
+              'stale)'.format(stats['sent'] / args.duration,
+                              stats['received'] / args.duration, **stats))
+        position, mount, counts = emulator.GetState()
+        print('Emulator: tip-tilt at ({:.0f},{:.0f}) steps, {:d} step '
+              'commands, {:d} at limit'.format(position[0], position[1],
+                                              counts['G'], counts['L']))
+    finally:
+        ao.Shutdown(10.0)
+        emulator.Stop()
+
+if __name__ == '__main__':
+    main()
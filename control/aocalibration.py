@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# aocalibration.py
+
+from __future__ import division
+
+import os
+import json
+from datetime import datetime
+from collections import namedtuple
+import numpy as np
+
+from ao import AOStep
+from calibration import CollectFrames
+from orchestrator import Task, Delay
+from timing import clock
+
+class CalibrationError(Exception):
+    pass
+
+# Result of calibrating the AO unit or mount.
+# pixels_per_step is the 2x2 matrix taking (x, y) steps to the resulting
+# (x, y) star movement in pixels, and matrix is its inverse, taking a
+# wanted movement in pixels to steps.  Between them they cover scale,
+# rotation, reversal, swapped axes and non-orthogonal axes.
+# rms and max_residual are the residuals of the fit, in pixels.
+Calibration = namedtuple('Calibration', ['matrix', 'pixels_per_step', 'rms',
+                                         'max_residual', 'npoints'])
+
+def FitCalibration(steps, positions):
+    # Least-squares fit of positions = origin + pixels_per_step . steps,
+    # for (n, 2) arrays of step counts and star positions
+    steps = np.asarray(steps, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    design = np.column_stack([steps, np.ones(len(steps))])
+    coeffs = np.linalg.lstsq(design, positions)[0]
+    pixels_per_step = coeffs[:2].T
+    residuals = positions - design.dot(coeffs)
+    distance = np.hypot(residuals[:, 0], residuals[:, 1])
+    try:
+        matrix = np.linalg.inv(pixels_per_step)
+    except np.linalg.LinAlgError:
+        raise CalibrationError('star did not move along both axes')
+    return Calibration(matrix, pixels_per_step,
+                       np.sqrt(np.mean(distance**2)), distance.max(),
+                       len(steps))
+
+def Describe(calibration):
+    # scale and angle of each axis, and the angle between them
+    cols = calibration.pixels_per_step.T
+    scale = np.hypot(cols[:, 0], cols[:, 1])
+    angle = np.degrees(np.arctan2(cols[:, 1], cols[:, 0]))
+    between = (angle[1] - angle[0] + 180) % 360 - 180
+    return ('x {:.3f} pix/step at {:.1f} deg, y {:.3f} pix/step at {:.1f} '
+            'deg, {:.1f} deg apart, rms {:.3f} pix, max {:.3f} pix'.format(
+                scale[0], angle[0], scale[1], angle[1], between,
+                calibration.rms, calibration.max_residual))
+
+def Pattern(amplitude, repeats=2):
+    # step positions visited: out and back along each axis, in both
+    # directions, ending back at the start
+    a = amplitude
+    cycle = [(a, 0), (0, 0), (-a, 0), (0, 0), (0, a), (0, 0), (0, -a), (0, 0)]
+    return cycle * repeats
+
+# ------------------------------------------------------------------------------
+# Task to calibrate the AO unit (command 'GS') or mount ('MS') through an
+# AOThread corrections queue, by moving in raw steps and measuring where
+# the star goes.  Probe moves along x, doubling in size until the star
+# moves by at least min_move pixels, set the size of the pattern so that
+# it moves the star by about target pixels.  All the positions measured,
+# including the probes, are then fitted together.
+# measure(frame, position) must return the (x, y) position of the star in
+# the frame, starting from the given position, or raise CalibrationError.
+# Each position is measured from the first frame started after the move
+# has finished and settle seconds have passed.
+# The Task completes with a Calibration.
+def Calibrate(corrections, command, measure, start, target, probe_steps=5,
+              max_steps=200, min_move=1.0, settle=0.2, topic='guider',
+              log=None):
+    return Task(CalibrationSteps(corrections, command, measure, start,
+                                 target, probe_steps, max_steps, min_move,
+                                 settle, topic, log), name='calibrate')
+
+def CalibrationSteps(corrections, command, measure, start, target,
+                     probe_steps, max_steps, min_move, settle, topic, log):
+    position = start
+    current = np.zeros(2)
+    steps = []
+    positions = []
+    probe = probe_steps
+    amplitude = None
+    targets = [(0, 0), (probe, 0)]
+    while targets:
+        wanted = np.array(targets.pop(0), dtype=np.float64)
+        delta = wanted - current
+        if delta.any():
+            ok = yield AOStep(corrections, command, delta[0], delta[1])
+            if not ok:
+                raise CalibrationError('{} move failed'.format(command))
+            current = wanted
+            yield Delay(settle)
+        t_moved = clock()
+        accept = lambda f, t=t_moved: f.t_ready - (f.image_exptime or 0.0) > t
+        frames = yield CollectFrames(topic, 1, accept)
+        position = measure(frames[0], position)
+        steps.append(current)
+        positions.append(position)
+        if amplitude is None and len(steps) > 1:
+            moved = np.hypot(*np.subtract(position, positions[0]))
+            if moved < min_move:
+                if probe * 2 > max_steps:
+                    raise CalibrationError('star did not move')
+                probe *= 2
+                targets = [(probe, 0)]
+                continue
+            amplitude = int(np.clip(round(probe * target / moved),
+                                    probe_steps, max_steps))
+            if log is not None:
+                log('{} calibration: {:d} steps moved star {:.1f} pixels, '
+                    'using {:d} steps'.format(command, probe, moved,
+                                              amplitude))
+            targets = Pattern(amplitude)
+    calibration = FitCalibration(steps, positions)
+    if log is not None:
+        log('{} calibration: {}'.format(command, Describe(calibration)))
+    yield calibration
+
+# ------------------------------------------------------------------------------
+# Task to check a saved Calibration with a single probe move of the AO unit
+# or mount, predicted by the calibration to move the star by target pixels
+# along x, and back again.  It completes with the error in the movement, in
+# pixels, or raises CalibrationError if the error is more than tolerance.
+def VerifyCalibration(corrections, command, calibration, measure, start,
+                      target, tolerance=0.5, settle=0.2, topic='guider',
+                      log=None):
+    return Task(VerifySteps(corrections, command, calibration, measure,
+                            start, target, tolerance, settle, topic, log),
+                name='verify calibration')
+
+def VerifySteps(corrections, command, calibration, measure, start, target,
+                tolerance, settle, topic, log):
+    steps = np.round(calibration.matrix.dot((target, 0)))
+    expected = calibration.pixels_per_step.dot(steps)
+    positions = []
+    position = start
+    for move in (None, steps, -steps):
+        if move is not None:
+            ok = yield AOStep(corrections, command, move[0], move[1])
+            if not ok:
+                raise CalibrationError('{} move failed'.format(command))
+            yield Delay(settle)
+        t_moved = clock()
+        accept = lambda f, t=t_moved: f.t_ready - (f.image_exptime or 0.0) > t
+        frames = yield CollectFrames(topic, 1, accept)
+        position = measure(frames[0], position)
+        positions.append(position)
+    moved = np.subtract(positions[1], positions[0])
+    error = np.hypot(*(moved - expected))
+    if log is not None:
+        log('{} calibration check: moved ({:.2f},{:.2f}), expected '
+            '({:.2f},{:.2f}) pixels'.format(command, moved[0], moved[1],
+                                            expected[0], expected[1]))
+    limit = max(tolerance, 3 * calibration.rms)
+    if error > limit:
+        raise CalibrationError('{} calibration is out by {:.2f} '
+                               'pixels'.format(command, error))
+    yield error
+
+# ------------------------------------------------------------------------------
+# Calibrations saved in a JSON file, so they can be reused between sessions.
+# Entries are keyed by the AO port, camera and a description of the optical
+# configuration, since changing any of them changes the calibration, and
+# hold the AO and mount calibrations with the time they were made.
+class CalibrationCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def Key(self, comport, camera_id, optics):
+        return 'COM{}|{}|{}'.format(comport, camera_id, optics)
+
+    def Read(self):
+        # falling back on the previous file, if a save was interrupted
+        for filename in (self.filename, self.filename + '.bak'):
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    return json.load(f)
+        return {}
+
+    def Get(self, key):
+        # (ao, mount, timestamp) or None
+        entry = self.Read().get(key)
+        if entry is None:
+            return None
+        return (FromDict(entry['ao']), FromDict(entry['mount']),
+                entry['timestamp'])
+
+    def Put(self, key, ao, mount):
+        entries = self.Read()
+        entries[key] = {'ao': ToDict(ao), 'mount': ToDict(mount),
+                        'timestamp': datetime.utcnow().isoformat()}
+        # Write to a new file first, so a failure cannot lose the others.
+        # Renaming cannot replace a file on Windows, so the old file is
+        # kept as a backup until the new one is in place, and put back if
+        # that fails.
+        tmp = self.filename + '.tmp'
+        backup = self.filename + '.bak'
+        with open(tmp, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        if os.path.exists(self.filename):
+            if os.path.exists(backup):
+                os.remove(backup)
+            os.rename(self.filename, backup)
+        try:
+            os.rename(tmp, self.filename)
+        except EnvironmentError:
+            if os.path.exists(backup):
+                os.rename(backup, self.filename)
+            raise
+
+def ToDict(calibration):
+    return {'pixels_per_step': calibration.pixels_per_step.tolist(),
+            'rms': float(calibration.rms),
+            'max_residual': float(calibration.max_residual),
+            'npoints': int(calibration.npoints)}
+
+def FromDict(entry):
+    pixels_per_step = np.array(entry['pixels_per_step'], dtype=np.float64)
+    return Calibration(np.linalg.inv(pixels_per_step), pixels_per_step,
+                       entry['rms'], entry['max_residual'], entry['npoints'])
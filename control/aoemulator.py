@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# aoemulator.py
+
+from __future__ import division
+
+import os
+import tty
+import select
+import threading
+import time
+import numpy as np
+
+from timing import clock
+
+# ------------------------------------------------------------------------------
+# Emulator of the SX AO unit, speaking its serial protocol over a
+# pseudo-terminal, so the whole serial path (see sxvao.py) can be run and
+# timed without the hardware.  Open the port named by Port() as the AO
+# comport (Linux only, as it needs os.openpty).
+# Commands are handled one at a time, in the order received, as by the
+# real unit, each taking latency seconds plus a time per step:
+#   'X' handshake, answered with 'Y'
+#   'K' centre the tip-tilt, answered with 'K'
+#   'G' + direction + 5 digits, move the tip-tilt by that many steps,
+#       answered with 'G', or 'L' if it stopped at the end of its travel
+#   'M' + direction + 5 digits, move the mount, answered with 'M'
+# Directions are N, S, T and W, positive steps being T and N, as in SXVAO.
+# The star field moves by pixels_per_step times the tip-tilt position plus
+# mount_pixels_per_step times the mount position, and drifts at drift
+# pixels per second; Offset() gives the total, which can be fed to the
+# simulated camera (see camera.simulate_offset) so corrections move stars.
+class SXVAOEmulator(threading.Thread):
+    def __init__(self, travel=1200, latency=0.005, step_time=0.0005,
+                 mount_step_time=0.002, pixels_per_step=None,
+                 mount_pixels_per_step=None, drift=(0.0, 0.0)):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.travel = travel
+        self.latency = latency
+        self.step_time = step_time
+        self.mount_step_time = mount_step_time
+        # as SXVAO.steps_per_pixel, slightly rotated and unequal, so
+        # calibration has something to find
+        if pixels_per_step is None:
+            pixels_per_step = [[0.17, 0.01], [-0.01, 0.16]]
+        if mount_pixels_per_step is None:
+            mount_pixels_per_step = [[0.0, -0.16], [0.17, 0.0]]
+        self.pixels_per_step = np.array(pixels_per_step, dtype=np.float64)
+        self.mount_pixels_per_step = np.array(mount_pixels_per_step,
+                                              dtype=np.float64)
+        self.drift = np.array(drift, dtype=np.float64)
+        self.lock = threading.Lock()
+        self.stopevent = threading.Event()
+        self.position = np.zeros(2)
+        self.mount = np.zeros(2)
+        self.t_start = clock()
+        self.counts = dict.fromkeys('XKGML?', 0)
+        self.master, self.slave = os.openpty()
+        # no echo or line editing, so bytes pass through unchanged
+        tty.setraw(self.slave)
+        self.buffer = ''
+
+    def Port(self):
+        return os.ttyname(self.slave)
+
+    def run(self):
+        try:
+            while not self.stopevent.is_set():
+                ready = select.select([self.master], [], [], 0.1)[0]
+                if not ready:
+                    continue
+                try:
+                    data = os.read(self.master, 1024)
+                except OSError:
+                    # the other end was closed
+                    break
+                self.buffer += data.decode('ascii', 'replace')
+                self.HandleCommands()
+        finally:
+            os.close(self.master)
+            os.close(self.slave)
+
+    def Stop(self):
+        self.stopevent.set()
+        if self.is_alive():
+            self.join(1.0)
+
+    def HandleCommands(self):
+        while self.buffer:
+            command = self.buffer[0]
+            if command in 'GM':
+                if len(self.buffer) < 7:
+                    # rest of the command still to come
+                    return
+                text, self.buffer = self.buffer[:7], self.buffer[7:]
+            else:
+                text, self.buffer = command, self.buffer[1:]
+            response = self.Execute(text)
+            if response is not None:
+                os.write(self.master, response.encode('ascii'))
+
+    def Execute(self, text):
+        command = text[0]
+        if command == 'X':
+            self.counts['X'] += 1
+            return 'Y'
+        elif command == 'K':
+            self.counts['K'] += 1
+            time.sleep(self.latency + self.step_time * np.abs(
+                self.position).sum())
+            with self.lock:
+                self.position[:] = 0
+            return 'K'
+        elif command in 'GM':
+            try:
+                axis, sign = {'T': (0, 1), 'W': (0, -1),
+                              'N': (1, 1), 'S': (1, -1)}[text[1]]
+                n = int(text[2:])
+            except (KeyError, ValueError):
+                self.counts['?'] += 1
+                return None
+            if command == 'G':
+                self.counts['G'] += 1
+                return self.Step(axis, sign * n)
+            self.counts['M'] += 1
+            time.sleep(self.latency + self.mount_step_time * n)
+            with self.lock:
+                self.mount[axis] += sign * n
+            return 'M'
+        self.counts['?'] += 1
+        return None
+
+    def Step(self, axis, n):
+        # tip-tilt move, stopping at the end of its travel
+        with self.lock:
+            start = self.position[axis]
+        end = np.clip(start + n, -self.travel, self.travel)
+        time.sleep(self.latency + self.step_time * abs(end - start))
+        with self.lock:
+            self.position[axis] = end
+        if end != start + n:
+            self.counts['L'] += 1
+            return 'L'
+        return 'G'
+
+    def Offset(self):
+        # (x, y) movement of the star field in pixels
+        with self.lock:
+            offset = (self.pixels_per_step.dot(self.position) +
+                      self.mount_pixels_per_step.dot(self.mount))
+        return offset + self.drift * (clock() - self.t_start)
+
+    def GetState(self):
+        with self.lock:
+            return (tuple(self.position), tuple(self.mount),
+                    dict(self.counts))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# calibration.py
+
+from __future__ import division
+
+import numpy as np
+
+from framebus import frames, BLOCK
+from orchestrator import Operation, Task
+
+# ------------------------------------------------------------------------------
+# Library of guider dark frames at several exposure times.
+# Each pixel is fitted as bias plus dark current times exposure time, so a
+# dark for any exposure time can be made, and pixels whose dark current or
+# bias stand out from the rest are marked as hot.
+# To keep the per-frame cost near zero, bias and dark current are packed
+# together, with hot pixels as NaN bias, so calibrating the guide boxes
+# needs only one gather with the box indices (see centroid.BoxIndices).
+# Hot pixels in a box are replaced by the median of the rest of the box.
+class DarkLibrary(object):
+    def __init__(self, hot_sigma=5.0):
+        self.hot_sigma = hot_sigma
+        self.darks = {}
+        self.bias = None
+        self.rate = None
+        self.hot = None
+        self.packed = None
+
+    def Add(self, exptime, images):
+        # median of several dark frames at one exposure time
+        stack = np.array(images, dtype=np.float32)
+        self.darks[exptime] = np.median(stack, axis=0)
+
+    def Fit(self):
+        exptimes = np.array(sorted(self.darks))
+        stack = np.array([self.darks[t] for t in exptimes], dtype=np.float64)
+        if len(exptimes) > 1:
+            dt = exptimes - exptimes.mean()
+            mean = stack.mean(axis=0)
+            rate = np.tensordot(dt, stack - mean, axes=1) / np.sum(dt**2)
+            bias = mean - rate * exptimes.mean()
+        else:
+            # a single exposure time cannot separate bias and dark current
+            rate = np.zeros(stack.shape[1:])
+            bias = stack[0]
+        self.hot = self.Outliers(rate) | self.Outliers(bias)
+        self.hot |= self.Outliers(stack[-1])
+        self.rate = rate.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        self.packed = np.empty(bias.shape + (2,), dtype=np.float32)
+        self.packed[..., 0] = np.where(self.hot, np.nan, self.bias)
+        self.packed[..., 1] = self.rate
+        return self.hot.sum()
+
+    def Outliers(self, values):
+        sample = values[::4, ::4]
+        median = np.median(sample)
+        sigma = 1.4826 * np.median(np.abs(sample - median))
+        return values > median + self.hot_sigma * max(sigma, 1e-6)
+
+    def Ready(self):
+        return self.packed is not None
+
+    def Matches(self, image):
+        return self.Ready() and image.shape == self.bias.shape
+
+    def Exptimes(self):
+        return sorted(self.darks)
+
+    def Dark(self, exptime):
+        return self.bias + self.rate * exptime
+
+    def Calibrate(self, image, exptime, x0=0, y0=0):
+        # the whole image, or a region of it starting at (x0, y0),
+        # e.g. for star detection
+        nx, ny = image.shape
+        packed = self.packed[x0:x0+nx, y0:y0+ny]
+        return self.Subtract(image[None], packed[None], exptime)[0]
+
+    def CalibrateBoxes(self, boxes, index, exptime):
+        # a stack of boxes taken from an image with index
+        return self.Subtract(boxes, self.packed[index], exptime)
+
+    def Subtract(self, boxes, packed, exptime):
+        data = boxes - (packed[..., 0] + packed[..., 1] * exptime)
+        hot = np.isnan(data)
+        if hot.any():
+            n = data.shape[0]
+            fill = np.nanmedian(data.reshape(n, -1), axis=1)
+            data = np.where(hot, fill[:, None, None], data)
+        return data
+
+    def Save(self, filename):
+        exptimes = self.Exptimes()
+        np.savez_compressed(filename, exptimes=exptimes,
+                            darks=np.array([self.darks[t] for t in exptimes]))
+
+    @classmethod
+    def Load(cls, filename, hot_sigma=5.0):
+        library = cls(hot_sigma)
+        data = np.load(filename)
+        for exptime, dark in zip(data['exptimes'], data['darks']):
+            library.darks[float(exptime)] = dark
+        library.Fit()
+        return library
+
+# ------------------------------------------------------------------------------
+# Operation (see orchestrator.py) which completes with the next n frames
+# on a topic of the frame bus, for which accept(frame) is true.
+def CollectFrames(topic, n, accept=None):
+    op = Operation('collect frames')
+    collected = []
+    def notify(subscription):
+        while not op.Done():
+            frame = subscription.Get(block=False)
+            if frame is None:
+                break
+            if accept is None or accept(frame):
+                collected.append(frame)
+                if len(collected) >= n:
+                    op.SetResult(collected)
+    subscription = frames.Subscribe(topic, maxsize=n, policy=BLOCK,
+                                    notify=notify)
+    op.AddDoneCallback(lambda op: frames.Unsubscribe(subscription))
+    return op
+
+# ------------------------------------------------------------------------------
+# Task to build a DarkLibrary from a camera thread, which must be taking
+# images continuously.  The telescope should be covered, as not all
+# cameras have a shutter.  The camera's exposure time and frame type are
+# restored afterwards.
+def BuildDarkLibrary(image_taker, exptimes, nframes, log=None):
+    return Task(DarkLibrarySteps(image_taker, exptimes, nframes, log),
+                name='dark library')
+
+def DarkLibrarySteps(image_taker, exptimes, nframes, log):
+    library = DarkLibrary()
+    original = image_taker.GetExpTime()
+    image_taker.SetLight(False)
+    try:
+        for exptime in exptimes:
+            if log is not None:
+                log('Taking {:d} darks of {:.3f} sec'.format(nframes, exptime))
+            image_taker.SetExpTime(exptime)
+            # the first frame at this exposure time may have started before
+            # the switch to darks
+            accept = lambda frame, t=exptime: frame.image_exptime == t
+            darks = yield CollectFrames(image_taker.topic, nframes + 1, accept)
+            library.Add(exptime, [frame.image for frame in darks[1:]])
+    finally:
+        image_taker.SetLight(True)
+        image_taker.SetExpTime(original)
+    nhot = library.Fit()
+    if log is not None:
+        log('Dark library complete, {:d} hot pixels'.format(nhot))
+    yield library
@@ -5,10 +5,18 @@ from datetime import datetime
 import numpy as np
 from scipy.stats import norm
 
-from logevent import *
+from logservice import logs, SourceOf
+from connections import connections
+from framebus import frames
+from orchestrator import Operation
+from timing import clock
 
 # simulate obtaining images for testing
 simulate = False
+# callable giving the (x, y) pixel offset of the simulated star field,
+# e.g. SXVAOEmulator.Offset (see aoemulator.py), so simulated guiding
+# corrections move the stars; only seen by cameras in this process
+simulate_offset = None
 
 if not simulate:
     # http://www.ascom-standards.org/Help/Developer/html/N_ASCOM_DeviceInterface.htm
@@ -18,11 +26,10 @@ if not simulate:
     except ImportError:
         simulate = True
 
-# Avoid multiple processes connecting to camera at same time
-COMlock = threading.Lock()
-
 # ------------------------------------------------------------------------------
-# Event to signal that a new image is ready for use
+# Event to signal that a new image is ready for use.
+# Images are published on the frame bus (see framebus.py), and these events
+# only notify subscribers, so the image attributes are normally None.
 myEVT_IMAGEREADY_MAIN = wx.NewEventType()
 EVT_IMAGEREADY_MAIN = wx.PyEventBinder(myEVT_IMAGEREADY_MAIN, 1)
 myEVT_IMAGEREADY_GUIDER = wx.NewEventType()
@@ -47,37 +54,45 @@ class ImageReadyEventGuider(wx.PyCommandEvent):
 # ------------------------------------------------------------------------------
 # Class to obtain images on a separate thread.
 # When run, this connects to the camera, waits for events requesting images,
-# or a continuous stream of images, and posts events when each image is ready.
+# or a continuous stream of images, and publishes each image on its
+# topic of the frame bus when it is ready.
 # The camera is disconnected before ending.
+# The camera configuration is held in class attributes, so that it can be
+# shared with acquisition.py, which runs the same code in a separate process.
 class TakeImageThread(threading.Thread):
+    continuous = False
+    topic = 'main'
+    camera_id = "ASCOM.SXMain0.Camera"
+    imshape = (2024, 3040)
+    check_period = 1.0
+    # how often to check whether readout has finished, once the
+    # exposure time has passed
+    readout_check_period = 0.02
+
     def __init__(self, parent, stopevent, onevent, exptime):
         threading.Thread.__init__(self)
         self.daemon = True
         self.parent = parent
         self.stopevent = stopevent
         self.onevent = onevent
-        self.continuous = False
-        self.camera_id = "ASCOM.SXMain0.Camera"
-        self.imshape = (2024, 3040)
-        self.ImageReadyEvent = ImageReadyEventMain
-        self.check_period = 1.0
         self.cam = None
+        self.simulated_stars = None
         self.exptime_lock = threading.Lock()
         self.camera_lock = threading.Lock()
         self.SetExpTime(exptime)
+        self.SetLight(True)
 
     def run(self):
-        with COMlock:
-            self.InitCamera()
+        self.InitCamera()
         try:
             while not self.stopevent.is_set():
                 # only take images when camera is "on" and
                 # check for stopevent every second
                 if self.onevent.wait(1.0):
-                    if self.cam.CameraState > 4:
+                    if self.cam is not None and self.cam.CameraState > 4:
                         self.Log('Camera error')
                         break
-                    if self.cam.CameraState > 0:
+                    if self.cam is not None and self.cam.CameraState > 0:
                         time.sleep(5)
                         if self.cam.CameraState > 0:
                             self.Log('Aborting current exposure')
@@ -107,37 +122,39 @@ class TakeImageThread(threading.Thread):
             self.cam = None
 
     def Connect(self):
+        # Connection attempts are serialised per camera, not globally,
+        # so a misbehaving camera does not hold up the other one
         if self.cam is not None:
-            for i in range(3):
-                try:
-                    self.Log('Connecting...')
-                    #self.cam.Connected = False
-                    #time.sleep(1)
-                    if not self.cam.Connected:
-                        self.cam.Connected = True
-                except:
-                    self.Log("Problem connecting to camera")
-                    self.Log("Trying again in 20 sec")
-                    time.sleep(20)
-                else:
-                    self.cam.StartExposure(0, True) # discard first image
-                    # wait for camera to cool?
-                    self.Log("Connected to camera {} {}".format(
-                             self.camera_id, self.cam.Description))
-                    break
-            if not self.cam.Connected:
+            ok = connections.Connect(self.camera_id, self.ConnectOnce,
+                                     stopevent=self.stopevent, log=self.Log)
+            if not ok:
                 self.Log("Unable to connect to camera")
 
+    def ConnectOnce(self):
+        self.Log('Connecting...')
+        #self.cam.Connected = False
+        #time.sleep(1)
+        if not self.cam.Connected:
+            self.cam.Connected = True
+        self.cam.StartExposure(0, True) # discard first image
+        # wait for camera to cool?
+        self.Log("Connected to camera {} {}".format(
+                 self.camera_id, self.cam.Description))
+        return True
+
     def Disconnect(self):
         if self.cam is not None:
-            self.cam.Connected = False
-            if not self.cam.Connected:
-                self.Log("Disconnected from camera")
-            else:
-                self.Log("Unable to disconnect from camera")
+            connections.Disconnect(self.camera_id, self.DisconnectOnce)
             self.cam = None
             win32com.client.pythoncom.CoUninitialize()
 
+    def DisconnectOnce(self):
+        self.cam.Connected = False
+        if not self.cam.Connected:
+            self.Log("Disconnected from camera")
+        else:
+            self.Log("Unable to disconnect from camera")
+
     def SetWindowing(self, window=False, nx=100, ny=100):
         if window:
             self.cam.StartX = self.cam.CameraXSize // 2 - nx // 2
@@ -160,17 +177,27 @@ class TakeImageThread(threading.Thread):
         with self.exptime_lock:
             return self.exptime
 
+    def SetLight(self, light=True):
+        # take light frames, or darks (with the shutter closed,
+        # if the camera has one)
+        with self.exptime_lock:
+            self.light = light
+
+    def GetLight(self):
+        with self.exptime_lock:
+            return self.light
+
     def Log(self, text):
-        wx.PostEvent(self.parent, LogEvent(text=text))
+        logs.Post(text, SourceOf(self.parent))
 
     def TakeImage(self, exptime):
         image = None
         image_time = datetime.utcnow()
         if self.cam is not None:
             self.Log('Taking exposure with {}'.format(self.cam.Description))
-            self.cam.StartExposure(exptime, True)
-            while (not self.cam.ImageReady) and self.onevent.is_set():
-                time.sleep(self.check_period)
+            t_exposed = clock() + exptime
+            self.cam.StartExposure(exptime, self.GetLight())
+            self.WaitForImage(exptime)
             if self.cam.ImageReady and self.onevent.is_set():
                 image = np.array(self.cam.ImageArray)
                 #self.Log("Check image size: {}x{}, {}x{}".format(
@@ -182,28 +209,52 @@ class TakeImageThread(threading.Thread):
                 #self.Log('Stopping current exposure early')
                 self.cam.StopExposure()
         else:
+            # the wait in SimulateImage stands in for the exposure
+            t_exposed = clock() + self.check_period
             image = self.SimulateImage(exptime)
         #self.filters = None  # do not use filters until debayered
         if image is not None:
-            wx.PostEvent(self.parent,
-                         self.ImageReadyEvent(image=image,
-                                              image_time=image_time,
-                                              image_exptime=exptime))
+            self.PublishImage(image, image_time, exptime, t_exposed)
+
+    def WaitForImage(self, exptime):
+        # Check for a stop every check_period during the exposure, but
+        # poll quickly once it should be reading out, rather than waiting
+        # up to a whole check_period after the image is ready
+        end_time = clock() + exptime
+        while (not self.cam.ImageReady) and self.onevent.is_set():
+            remaining = end_time - clock()
+            if remaining > 0:
+                time.sleep(min(remaining, self.check_period))
+            else:
+                time.sleep(self.readout_check_period)
+
+    def PublishImage(self, image, image_time, exptime, t_exposed=None):
+        frames.Publish(self.topic, image, image_time, exptime, t_exposed)
 
     def SimulateImage(self, exptime):
         # simulate an image
         time.sleep(self.check_period)
         image = np.zeros(self.imshape)
-        # add one star per 10000 pixels
+        # add one star per 10000 pixels, at the same place in each image,
+        # apart from any offset (e.g. from the AO emulator)
         sigma = 4.0
         size = 23
-        g = norm.pdf(np.arange(size), (size-1)/2.0, sigma)
-        star = np.dot(g[:, None], g[None, :])
-        for i in range(np.product(image.shape)//10000):
-            x = np.random.choice(image.shape[0]-size)
-            y = np.random.choice(image.shape[1]-size)
+        if self.simulated_stars is None:
+            state = np.random.RandomState(1)
+            n = np.product(image.shape)//10000
+            self.simulated_stars = state.uniform(
+                size, np.array(image.shape) - 2*size, size=(n, 2))
+        offset = (0.0, 0.0) if simulate_offset is None else simulate_offset()
+        for position in self.simulated_stars + offset:
+            corner = np.floor(position).astype(int) - size//2
+            if (corner < 0).any() or (corner + size > image.shape).any():
+                continue
+            frac = position - np.floor(position)
+            gx = norm.pdf(np.arange(size), size//2 + frac[0], sigma)
+            gy = norm.pdf(np.arange(size), size//2 + frac[1], sigma)
             flux = np.random.poisson(10000 * exptime)
-            image[x:x+size,y:y+size] += star * flux
+            x, y = corner
+            image[x:x+size,y:y+size] += np.outer(gx, gy) * flux
         # add bright sky background
         image += 1000 * exptime
         # sloping response / vignetting
@@ -214,6 +265,23 @@ class TakeImageThread(threading.Thread):
         image += np.random.normal(800, 20, size=image.shape)
         return image
 
+# ------------------------------------------------------------------------------
+# Operation (see orchestrator.py) to take an exposure with the given camera
+# thread, which completes with the next frame from that camera.
+# Cancelling it stops the exposure.
+def Expose(image_taker, onevent, exptime):
+    op = Operation('expose')
+    def notify(subscription):
+        frame = subscription.Get(block=False)
+        if frame is not None:
+            op.SetResult(frame)
+    subscription = frames.Subscribe(image_taker.topic, notify=notify)
+    op.AddDoneCallback(lambda op: frames.Unsubscribe(subscription))
+    op.AddCancelHook(onevent.clear)
+    image_taker.SetExpTime(exptime)
+    onevent.set()
+    return op
+
 # ------------------------------------------------------------------------------
 # Subclass to obtain images from main camera on a separate thread.
 class TakeMainImageThread(TakeImageThread):
@@ -224,15 +292,16 @@ class TakeMainImageThread(TakeImageThread):
 # ------------------------------------------------------------------------------
 # Subclass to obtain images from guide camera on a separate thread.
 class TakeGuiderImageThread(TakeImageThread):
+    continuous = True
+    topic = 'guider'
+    # Something bizarre is happening!
+    # Somehow, the camera connection for the guider thread is being used
+    # for the main thread.  Don't know how!
+    # Next thing to try is using different ImageReadyEvent classes.
+    camera_id = "ASCOM.SXGuide0.Camera"
+    imshape = (600, 400)
+    check_period = 0.1
+
     def __init__(self, parent, stopevent, onevent, exptime):
         TakeImageThread.__init__(self, parent, stopevent, onevent, exptime)
-        self.continuous = True
-        # Something bizarre is happening!
-        # Somehow, the camera connection for the guider thread is being used
-        # for the main thread.  Don't know how!
-        # Next thing to try is using different ImageReadyEvent classes.
-        self.camera_id = "ASCOM.SXGuide0.Camera"
-        self.imshape = (600, 400)
-        self.check_period = 0.1
-        self.ImageReadyEvent = ImageReadyEventGuider
         self.start()
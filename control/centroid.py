@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+# centroid.py
+
+from __future__ import division
+
+from collections import namedtuple
+import numpy as np
+
+# Positions are in numpy image pixel coordinates, as used by the guider,
+# so zero-indexed and on the native image scale.
+# Offsets (dx, dy) are measured from the centre of a box, with dx along
+# the first image axis and dy along the second.
+
+# Measurements of a stack of boxes.  Each field is an array with one
+# entry per box (or a scalar, from MeasureBox).
+# flux and background are in counts, fwhm in pixels.
+Centroids = namedtuple('Centroids', ['dx', 'dy', 'dx_err', 'dy_err',
+                                     'flux', 'background', 'noise', 'fwhm',
+                                     'peak', 'snr', 'saturated'])
+
+# Defaults for the measurements below
+saturation = 60000.0  # counts
+gain = 1.0  # electrons per count
+threshold = 3.0  # sigma above background, for moments
+border = 2  # pixels around the box edge used to estimate background
+moffat_beta = 2.5
+gaussian_fwhm = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+def BoxCorner(x, y, size):
+    xc, yc = [int(round(c - size / 2.0)) for c in (x, y)]
+    size = int(round(size))
+    return xc, yc, size
+
+def ExtractBox(image, x, y, size):
+    xc, yc, size = BoxCorner(x, y, size)
+    return image[xc:xc+size, yc:yc+size]
+
+def BoxIndices(shape, positions, size):
+    # Indices of the pixels in boxes centred on the N (x, y) positions,
+    # to pick out a stack of boxes, shape (N, size, size), from an image
+    # (or anything else of the same shape) with image[indices].
+    # Pixels beyond the edge of the image repeat the edge.
+    positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+    size = int(round(size))
+    # rounding half up, as round() does in BoxCorner, not half to even
+    corners = np.floor(positions - size / 2.0 + 0.5).astype(np.int64)
+    offsets = np.arange(size)
+    rows = (corners[:, 0, None] + offsets).clip(0, shape[0] - 1)
+    cols = (corners[:, 1, None] + offsets).clip(0, shape[1] - 1)
+    return rows[:, :, None], cols[:, None, :]
+
+def ExtractBoxes(image, positions, size):
+    return image[BoxIndices(image.shape, positions, size)]
+
+def CentroidBox(image, x, y, size):
+    # offset of centroid from the centre of the box at (x, y)
+    return Centroid(ExtractBox(image, x, y, size))
+
+def Centroid(image):
+    dx, dy = [Centroid1d(np.sum(image, axis)) for axis in (1, 0)]
+    return dx, dy
+
+def Centroid1d(array):
+    n = len(array)
+    p = np.arange(n) - (n-1)/2.0
+    w = (array - array.min()).astype(np.float64)
+    w **= 2
+    c = np.average(p, weights=w)
+    return c
+
+# ------------------------------------------------------------------------------
+# Vectorised measurements on a stack of boxes, shape (N, size, size)
+
+def BoxCoordinates(size):
+    p = np.arange(size) - (size - 1) / 2.0
+    return p[:, None], p[None, :]
+
+def Background(boxes, border=border):
+    # median and robust noise of the pixels around the edge of each box
+    size = boxes.shape[-1]
+    edge = np.ones((size, size), dtype=bool)
+    edge[border:size-border, border:size-border] = False
+    values = boxes[:, edge]
+    background = np.median(values, axis=1)
+    mad = np.median(np.abs(values - background[:, None]), axis=1)
+    noise = np.maximum(1.4826 * mad, 1e-6)
+    return background, noise
+
+def Variance(data, noise, gain=gain):
+    # per-pixel variance: background noise plus signal photon noise
+    return noise[:, None, None]**2 + np.maximum(data, 0) / gain
+
+def Moments(boxes, threshold=threshold, saturation=saturation, gain=gain):
+    # background-subtracted first and second moments of the pixels
+    # above threshold, with uncertainties from the pixel variances
+    boxes = np.asarray(boxes, dtype=np.float64)
+    px, py = BoxCoordinates(boxes.shape[-1])
+    background, noise = Background(boxes)
+    data = boxes - background[:, None, None]
+    variance = Variance(data, noise, gain)
+    mask = data > threshold * noise[:, None, None]
+    w = np.where(mask, data, 0.0)
+    flux = w.sum(axis=(1, 2))
+    ok = flux > 0
+    safe_flux = np.where(ok, flux, 1.0)
+    dx = (w * px).sum(axis=(1, 2)) / safe_flux
+    dy = (w * py).sum(axis=(1, 2)) / safe_flux
+    rx = px - dx[:, None, None]
+    ry = py - dy[:, None, None]
+    var_sum = np.where(mask, variance, 0.0)
+    dx_err = np.sqrt((var_sum * rx**2).sum(axis=(1, 2))) / safe_flux
+    dy_err = np.sqrt((var_sum * ry**2).sum(axis=(1, 2))) / safe_flux
+    sigma2 = (w * (rx**2 + ry**2)).sum(axis=(1, 2)) / (2 * safe_flux)
+    fwhm = gaussian_fwhm * np.sqrt(np.maximum(sigma2, 0))
+    snr = flux / np.sqrt(np.maximum(var_sum.sum(axis=(1, 2)), 1e-12))
+    peak = boxes.max(axis=(1, 2))
+    inf = np.inf
+    return Centroids(np.where(ok, dx, 0.0), np.where(ok, dy, 0.0),
+                     np.where(ok, dx_err, inf), np.where(ok, dy_err, inf),
+                     np.where(ok, flux, 0.0), background, noise,
+                     np.where(ok, fwhm, 0.0), peak,
+                     np.where(ok, snr, 0.0), peak >= saturation)
+
+def WindowedCentroid(boxes, iterations=10, tolerance=2e-4, **kwargs):
+    # Iterative centroid with a Gaussian window matched to the star
+    # (as SExtractor's XWIN), which is much less affected by noise in the
+    # wings than plain moments.  Starts from the moments.
+    boxes = np.asarray(boxes, dtype=np.float64)
+    start = Moments(boxes, **kwargs)
+    px, py = BoxCoordinates(boxes.shape[-1])
+    half = (boxes.shape[-1] - 1) / 2.0
+    data = boxes - start.background[:, None, None]
+    sigma_w = np.maximum(start.fwhm / gaussian_fwhm, 1.0)[:, None, None]
+    dx, dy = start.dx.copy(), start.dy.copy()
+    for i in range(iterations):
+        rx = px - dx[:, None, None]
+        ry = py - dy[:, None, None]
+        r2 = rx**2 + ry**2
+        w = data * np.exp(-r2 / (2 * sigma_w**2))
+        total = w.sum(axis=(1, 2))
+        ok = total > 0
+        total = np.where(ok, total, 1.0)
+        step_x = np.where(ok, 2 * (w * rx).sum(axis=(1, 2)) / total, 0.0)
+        step_y = np.where(ok, 2 * (w * ry).sum(axis=(1, 2)) / total, 0.0)
+        # for a Gaussian star the windowed second moment is half the
+        # star's variance when the window matches it, so adjust towards that
+        sigma2 = np.where(ok, (w * r2).sum(axis=(1, 2)) / (2 * total), 0.0)
+        sigma_new = np.sqrt(2 * np.maximum(sigma2, 0.25))
+        sigma_w = np.clip(sigma_new, 1.0, half)[:, None, None]
+        dx = (dx + step_x).clip(-half, half)
+        dy = (dy + step_y).clip(-half, half)
+        if np.all(np.maximum(np.abs(step_x), np.abs(step_y)) < tolerance):
+            break
+    found = start.flux > 0
+    return start._replace(dx=np.where(found, dx, 0.0),
+                          dy=np.where(found, dy, 0.0),
+                          fwhm=np.where(found, gaussian_fwhm * sigma_w[:, 0, 0],
+                                        0.0))
+
+def PSFModel(params, px, py, model, beta=moffat_beta):
+    # model and its derivatives with respect to the parameters
+    # (amplitude, x0, y0, width, background) for a stack of boxes;
+    # width is the Gaussian sigma or the Moffat alpha
+    a, x0, y0, s, b = [params[:, i, None, None] for i in range(5)]
+    rx = px - x0
+    ry = py - y0
+    r2 = rx**2 + ry**2
+    if model == 'gaussian':
+        f = np.exp(-r2 / (2 * s**2))
+        g = a * f / s**2
+        derivs = [f, g * rx, g * ry, g * r2 / s, np.ones_like(f)]
+    else:
+        u = 1 + r2 / s**2
+        f = u**-beta
+        g = 2 * a * beta * u**(-beta - 1) / s**2
+        derivs = [f, g * rx, g * ry, g * r2 / s, np.ones_like(f)]
+    return b + a * f, np.concatenate([d[..., None] for d in derivs], axis=-1)
+
+def FitPSF(boxes, model='gaussian', iterations=20, beta=moffat_beta,
+           **kwargs):
+    # Weighted least-squares fit of a circular Gaussian or Moffat profile
+    # to every box at once, by Levenberg-Marquardt.  Starts from the
+    # moments, and falls back to them for boxes where the fit fails.
+    boxes = np.asarray(boxes, dtype=np.float64)
+    start = Moments(boxes, **kwargs)
+    n, size = boxes.shape[0], boxes.shape[-1]
+    px, py = BoxCoordinates(size)
+    half = (size - 1) / 2.0
+    sigma = np.maximum(start.fwhm / gaussian_fwhm, 0.5)
+    if model == 'gaussian':
+        width = sigma
+    else:
+        # alpha giving the same FWHM
+        width = sigma * gaussian_fwhm / (2 * np.sqrt(2**(1 / beta) - 1))
+    params = np.column_stack([np.maximum(start.peak - start.background, 1.0),
+                              start.dx, start.dy, width, start.background])
+    weights = 1 / Variance(boxes - start.background[:, None, None],
+                           start.noise, kwargs.get('gain', gain))
+    def chisq(p):
+        m, J = PSFModel(p, px, py, model, beta)
+        r = boxes - m
+        return (weights * r**2).sum(axis=(1, 2)), r, J
+    chi2, r, J = chisq(params)
+    lam = np.full(n, 1e-3)
+    eye = np.eye(5)
+    for i in range(iterations):
+        Jw = J * weights[..., None]
+        JTJ = np.einsum('nxyi,nxyj->nij', Jw, J)
+        grad = np.einsum('nxyi,nxy->ni', Jw, r)
+        damped = JTJ + lam[:, None, None] * JTJ * eye
+        try:
+            step = np.linalg.solve(damped, grad[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            break
+        trial = params + step
+        trial[:, 3] = np.abs(trial[:, 3]).clip(0.3, size)
+        trial[:, 1:3] = trial[:, 1:3].clip(-half, half)
+        new_chi2, new_r, new_J = chisq(trial)
+        better = np.isfinite(new_chi2) & (new_chi2 < chi2)
+        params = np.where(better[:, None], trial, params)
+        r = np.where(better[:, None, None], new_r, r)
+        J = np.where(better[:, None, None, None], new_J, J)
+        improvement = np.where(better, chi2 - new_chi2, 0.0)
+        chi2 = np.where(better, new_chi2, chi2)
+        lam = np.where(better, lam / 10, lam * 10)
+        if np.all(improvement < 1e-3 * chi2):
+            break
+    # covariance, scaled by the reduced chi-squared
+    Jw = J * weights[..., None]
+    JTJ = np.einsum('nxyi,nxyj->nij', Jw, J)
+    with np.errstate(invalid='ignore'):
+        try:
+            cov = np.linalg.inv(JTJ)
+        except np.linalg.LinAlgError:
+            cov = np.full((n, 5, 5), np.inf)
+        scale = np.maximum(chi2 / max(size * size - 5, 1), 1.0)
+        dx_err = np.sqrt(cov[:, 1, 1] * scale)
+        dy_err = np.sqrt(cov[:, 2, 2] * scale)
+    a, x0, y0, s, b = params.T
+    if model == 'gaussian':
+        flux = 2 * np.pi * a * s**2
+        fwhm = gaussian_fwhm * s
+    else:
+        flux = np.pi * a * s**2 / (beta - 1)
+        fwhm = 2 * s * np.sqrt(2**(1 / beta) - 1)
+    good = ((start.flux > 0) & np.isfinite(params).all(axis=1) &
+            np.isfinite(dx_err) & np.isfinite(dy_err) & (a > 0))
+    def pick(fit, fallback):
+        return np.where(good, fit, fallback)
+    return start._replace(dx=pick(x0, start.dx), dy=pick(y0, start.dy),
+                          dx_err=pick(dx_err, start.dx_err),
+                          dy_err=pick(dy_err, start.dy_err),
+                          flux=pick(flux, start.flux),
+                          background=pick(b, start.background),
+                          fwhm=pick(fwhm, start.fwhm))
+
+def Marginal(boxes, **kwargs):
+    # the original marginal-sum centroid, with moments for the rest
+    boxes = np.asarray(boxes, dtype=np.float64)
+    result = Moments(boxes, **kwargs)
+    dxdy = np.array([Centroid(box) for box in boxes]).reshape(-1, 2)
+    return result._replace(dx=dxdy[:, 0], dy=dxdy[:, 1])
+
+methods = {
+    'marginal': Marginal,
+    'moments': Moments,
+    'windowed': WindowedCentroid,
+    'gaussian': lambda boxes, **kw: FitPSF(boxes, 'gaussian', **kw),
+    'moffat': lambda boxes, **kw: FitPSF(boxes, 'moffat', **kw),
+}
+
+def CentroidBoxes(boxes, method='windowed', **kwargs):
+    # measure a stack of boxes, shape (N, size, size)
+    try:
+        measure = methods[method]
+    except KeyError:
+        raise ValueError('Unknown centroid method: {}'.format(method))
+    return measure(np.asarray(boxes, dtype=np.float64), **kwargs)
+
+def MeasureBoxes(image, positions, size, method='windowed', **kwargs):
+    # measure boxes centred on each of the N (x, y) positions
+    return CentroidBoxes(ExtractBoxes(image, positions, size),
+                         method, **kwargs)
+
+def MeasureBox(image, x, y, size, method='windowed', **kwargs):
+    # measure a single box, returning Centroids of scalars
+    result = MeasureBoxes(image, [(x, y)], size, method, **kwargs)
+    return Centroids._make(field[0] for field in result)
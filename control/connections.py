@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# connections.py
+
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+# Connection state of a single device.
+# Each device has its own lock, so one device retrying a connection
+# does not hold up any other device.
+class DeviceConnection(object):
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.lock = threading.RLock()
+        self.state = 'disconnected'
+        self.attempts = 0
+        self.last_error = None
+        self.since = time.time()
+
+# ------------------------------------------------------------------------------
+# Keeps track of device connections, by device id (e.g. ASCOM driver id).
+# Connect() calls the given function until it succeeds, backing off
+# between attempts, and gives up after a fixed number of attempts or
+# when the overall timeout is reached.  The timeout bounds the waiting
+# between attempts; a single blocking driver call cannot be interrupted.
+# Each device connects from its own thread, so devices connect in
+# parallel and startup is limited by the slowest device.
+class ConnectionManager(object):
+    def __init__(self, retries=3, backoff=2.0, max_backoff=20.0, timeout=60.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def GetDevice(self, device_id):
+        with self.lock:
+            if device_id not in self.devices:
+                self.devices[device_id] = DeviceConnection(device_id)
+            return self.devices[device_id]
+
+    def Lock(self, device_id):
+        return self.GetDevice(device_id).lock
+
+    def SetState(self, device_id, state, error=None):
+        device = self.GetDevice(device_id)
+        device.state = state
+        device.last_error = error
+        device.since = time.time()
+
+    def GetState(self, device_id):
+        return self.GetDevice(device_id).state
+
+    def GetStates(self):
+        with self.lock:
+            devices = self.devices.values()
+        return dict((d.device_id, (d.state, d.attempts, d.since))
+                    for d in devices)
+
+    def Connect(self, device_id, connect, stopevent=None, log=None,
+                retries=None, timeout=None):
+        if retries is None:
+            retries = self.retries
+        if timeout is None:
+            timeout = self.timeout
+        if log is None:
+            log = lambda text: None
+        device = self.GetDevice(device_id)
+        with device.lock:
+            deadline = time.time() + timeout
+            delay = self.backoff
+            device.attempts = 0
+            while True:
+                device.attempts += 1
+                self.SetState(device_id, 'connecting')
+                try:
+                    ok = connect()
+                    error = None if ok else 'connection refused'
+                except Exception as detail:
+                    ok = False
+                    error = str(detail)
+                if ok:
+                    self.SetState(device_id, 'connected')
+                    return True
+                log('Problem connecting to {} (attempt {:d}/{:d})'.format(
+                    device_id, device.attempts, retries))
+                remaining = deadline - time.time()
+                if device.attempts >= retries or remaining <= 0:
+                    break
+                wait = min(delay, self.max_backoff, remaining)
+                log('Trying again in {:.0f} sec'.format(wait))
+                if stopevent is not None:
+                    if stopevent.wait(wait):
+                        break
+                else:
+                    time.sleep(wait)
+                delay *= 2
+            self.SetState(device_id, 'failed', error)
+            return False
+
+    def Disconnect(self, device_id, disconnect):
+        device = self.GetDevice(device_id)
+        with device.lock:
+            try:
+                disconnect()
+            finally:
+                self.SetState(device_id, 'disconnected')
+
+# Shared by all devices in this process
+connections = ConnectionManager()
@@ -6,6 +6,7 @@
 from __future__ import print_function
 import wx
 import threading
+import multiprocessing
 from datetime import datetime, timedelta
 import time
 from Queue import Queue
@@ -29,6 +30,8 @@ simulate = False
 debug = True
 enable_guider = False
 enable_windowing = False
+# run the main camera in a separate process (see acquisition.py)
+use_acquisition_process = False
 
 if not simulate:
     # http://www.ascom-standards.org/Help/Developer/html/N_ASCOM_DeviceInterface.htm
@@ -40,9 +43,14 @@ if not simulate:
         simulate = True
 
 from guider import Guider
-from camera import TakeMainImageThread, EVT_IMAGEREADY_MAIN
-from solver import SolverThread, EVT_SOLUTIONREADY
-from logevent import EVT_LOG
+from camera import (TakeMainImageThread, EVT_IMAGEREADY_MAIN,
+                    ImageReadyEventMain)
+from framebus import frames, WxFrameNotify, BLOCK
+from acquisition import TakeMainImageProcess
+from solver import SolverThread, EVT_SOLUTIONREADY, Solve
+from telescope import TelescopeDevice, Sexagesimal
+from orchestrator import Operation, Completed, Delay
+from logservice import logs
 
 class Control(wx.Frame):
 
@@ -52,7 +60,6 @@ class Control(wx.Frame):
         self.__DoLayout()
         self.Log = self.panel.Log
         self.Bind(wx.EVT_CLOSE, self.OnQuit)
-        self.Bind(EVT_LOG, self.panel.OnLog)
         self.Bind(EVT_IMAGEREADY_MAIN, self.panel.OnImageReady)
         self.Bind(EVT_SOLUTIONREADY, self.panel.OnSolutionReady)
         self.Show(True)
@@ -84,6 +91,8 @@ class Control(wx.Frame):
         e.Skip()
 
 class ControlPanel(wx.Panel):
+    # where the threads it starts log to (see logservice.py)
+    log_source = 'control'
 
     def __init__(self, *args, **kwargs):
         wx.Panel.__init__(self, *args, **kwargs)
@@ -104,12 +113,17 @@ class ControlPanel(wx.Panel):
         self.images_root_path = "C:/Users/lab_user/Dropbox/control/"
         # special objects:
         self.tel = None
+        self.telescope_timeout = 2.0  # seconds
+        # how often the telescope's position and status are read
+        self.telescope_poll_period = 1.0  # seconds
+        self.worker = None
+        self.pending_op = None
         self.bias = None
         self.dark = None
         self.flat = None
         self.samp_client = None
         self.ast_position = None
-        self.tel_position = None
+        self.tel_state = None
         self.wcs = None
         self.image_time = None
         self.image_exptime = None
@@ -130,10 +144,26 @@ class ControlPanel(wx.Panel):
         self.UpdateInfoTimer.Start(1000) # 1 second interval
 
     def InitCamera(self):
-        self.stop_camera = threading.Event()
-        self.take_image = threading.Event()
-        self.ImageTaker = TakeMainImageThread(self, self.stop_camera,
-                                              self.take_image, 0.0)
+        # every main camera frame is wanted (e.g. for calibration stacks),
+        # so make the camera wait rather than drop frames
+        self.image_notify = WxFrameNotify(self, ImageReadyEventMain)
+        self.frames = frames.Subscribe('main', maxsize=2, policy=BLOCK,
+                                       notify=self.image_notify)
+        if use_acquisition_process:
+            self.stop_camera = multiprocessing.Event()
+            self.take_image = multiprocessing.Event()
+        else:
+            self.stop_camera = threading.Event()
+            self.take_image = threading.Event()
+        self.StartImageTaker()
+
+    def StartImageTaker(self):
+        if use_acquisition_process:
+            self.ImageTaker = TakeMainImageProcess(self, self.stop_camera,
+                                                   self.take_image, 0.0)
+        else:
+            self.ImageTaker = TakeMainImageThread(self, self.stop_camera,
+                                                  self.take_image, 0.0)
 
     def StopCamera(self):
         self.stop_camera.set()
@@ -141,39 +171,25 @@ class ControlPanel(wx.Panel):
         time.sleep(1)
 
     def InitTelescope(self):
+        # The telescope runs on its own thread (see telescope.py),
+        # and is only made available once it has connected
+        self.tel = None
         if not simulate:
-            # Only in a thread:
-            # win32com.client.pythoncom.CoInitialize()
-            self.tel = win32com.client.Dispatch("ASCOM.Celestron.Telescope")
+            device = TelescopeDevice(self, "ASCOM.Celestron.Telescope",
+                                     self.telescope_poll_period)
+            connect = device.Connect()
+            connect.AddDoneCallback(lambda op: wx.CallAfter(
+                self.OnTelescopeConnected, device, op))
+
+    def OnTelescopeConnected(self, device, op):
+        if op.exception is None and op.result:
+            self.tel = device
+            device.StartPolling()
         else:
-            self.tel = None
-        if self.tel is not None:
-            if not self.tel.Connected:
-                try:
-                    self.tel.Connected = True
-                except pythoncom.com_error as error:
-                    pass
-            if self.tel.Connected:
-                self.Log("Connected to telescope")
-            else:
-                self.Log("Unable to connect to telescope")
-                self.tel = None
-        if self.tel is not None:
-            self.Log("Telescope time is {}".format(self.tel.UTCDate))
-            if not self.tel.Tracking:
-                self.tel.Tracking = True
-            if self.tel.Tracking:
-                self.Log("Telescope tracking")
-            else:
-                self.Log("Unable to start telescope tracking")
-        if self.tel is not None:
-            now = self.tel.UTCDate
-            now = datetime(now.year, now.month, now.day,
-                           now.hour, now.minute, now.second,
-                           now.msec * 1000)
-            time_offset = abs(now - datetime.utcnow())
-            if time_offset > timedelta(seconds=1):
-                self.Log("Warning: PC and telescope times do not agree!")
+            if op.exception is not None:
+                self.Log("Unable to connect to telescope:\n{}".format(
+                    op.exception))
+            device.Stop()
 
     def InitSAMP(self):
         try:
@@ -492,37 +508,46 @@ class ControlPanel(wx.Panel):
         now = datetime.utcnow()
         timeStamp = now.strftime('%H:%M:%S UT')
         self.pc_time.SetLabel('PC time:  {}'.format(timeStamp))
+        if self.tel is not None and self.tel.failed is not None:
+            self.Log('Telescope disconnected:\n{}'.format(self.tel.failed))
+            self.tel.Stop()
+            self.tel = None
+        # the state read by the telescope thread (see telescope.py), if
+        # it is recent
+        state = None
         if self.tel is not None:
-            try:
-                now = self.tel.UTCDate
-                self.tel_time.SetLabel('Tel. time:  {}'.format(now))
-            except:
-                self.tel = None
-                self.Log('Telescope disconnected')
+            state = self.tel.state
+            if state is not None and (now - state.time).total_seconds() > (
+                    self.telescope_poll_period + self.telescope_timeout):
+                state = None
+        self.tel_state = state
+        if state is not None:
+            self.tel_time.SetLabel('Tel. time:  {}'.format(state.utc))
         else:
             self.tel_time.SetLabel('Tel. time:  not available')
 
     def UpdatePosition(self):
         # TODO: check self.tel.EquatorialSystem
-        if self.tel is not None:
-            c = coord.SkyCoord(ra=self.tel.RightAscension,
-                               dec=self.tel.Declination,
-                               unit=(u.hour, u.degree), frame='icrs')
-            if self.tel_position is not None:
-                if c.separation(self.tel_position).arcsecond > 15:
-                    self.last_telescope_move = datetime.utcnow()
-            self.tel_position = c
-            ra = c.ra.to_string(u.hour, precision=1, pad=True)
-            dec = c.dec.to_string(u.degree, precision=1, pad=True, alwayssign=True)
-            self.tel_ra.SetLabel('RA:  ' + ra)
-            self.tel_dec.SetLabel('Dec:  '+ dec)
+        state = self.tel_state
+        if state is not None:
+            self.last_telescope_move = state.last_move
+            self.tel_ra.SetLabel('RA:  ' + Sexagesimal(state.ra, 'hms'))
+            self.tel_dec.SetLabel('Dec:  ' + Sexagesimal(state.dec, 'dms',
+                                                         sign=True))
             self.SlewButton.Enable()
         else:
-            self.tel_position = None
             self.tel_ra.SetLabel('RA:  not available')
             self.tel_dec.SetLabel('Dec:  not available')
             self.SlewButton.Disable()
 
+    def TelescopePosition(self):
+        # the telescope's last known position, or None
+        state = self.tel_state
+        if state is None:
+            return None
+        return coord.SkyCoord(ra=state.ra, dec=state.dec,
+                              unit=(u.hour, u.degree), frame='icrs')
+
     def UpdateAstrometry(self):
         if self.image_time is None or self.last_telescope_move > self.image_time:
             self.ast_position = None
@@ -550,40 +575,17 @@ class ControlPanel(wx.Panel):
         box.Add(self.logger, 1, flag=wx.EXPAND)
         now = datetime.utcnow()
         timeStamp = now.strftime('%a %d %b %Y %H:%M:%S UT')
-        text = "Log started {}\n".format(timeStamp)
-        text += 'Storing images in {}\n'.format(self.images_path)
-        self.logger.AppendText(text)
-        self.logfilename = os.path.abspath(os.path.join(self.images_path,
-                                                    'log_' + self.night))
-        self.logfile = file(self.logfilename, 'a')
-        self.logfile.write(text)
+        # the log of the whole session, shown in batches (see logservice.py)
+        logs.AddView(self.logger, ['control'])
+        self.logfilename = os.path.abspath(os.path.join(
+            self.images_path, 'log_' + self.night + '.tsv'))
+        logs.Open(self.logfilename)
+        self.Log("Log started {}".format(timeStamp))
+        self.Log('Storing images in {}'.format(self.images_path))
 
     def Log(self, text):
-        # Work out if we're at the end of the file
-        currentCaretPosition = self.logger.GetInsertionPoint()
-        (currentSelectionStart, currentSelectionEnd) = self.logger.GetSelection()
-        self.holdingBack = (currentSelectionEnd - currentSelectionStart) > 0
-        # If some text is selected, then hold back advancing the log
-        if self.holdingBack:
-            self.logger.Freeze()
-        now = datetime.utcnow()
-        timeStamp = now.strftime('%H:%M:%S UT')
-        text = "{} : {}\n".format(timeStamp, text)
-        self.logger.AppendText(text)
-        try:
-            self.logfile.write(text)
-        except ValueError:
-            # no logfile to write to
-            pass
-        if self.holdingBack:
-            self.logger.SetInsertionPoint(currentCaretPosition)
-            self.logger.SetSelection(currentSelectionStart, currentSelectionEnd)
-            self.logger.Thaw()
-        time.sleep(0.01)
-        self.logger.Refresh()
-
-    def OnLog(self, event):
-        self.Log(event.text)
+        # from any thread, never waiting for the display or the log file
+        logs.Post(text, 'control')
 
     def OnQuit(self, e):
         try:
@@ -598,13 +600,12 @@ class ControlPanel(wx.Panel):
             self.Log('Disconnecting from SAMP hub')
             self.samp_client.disconnect()
         try:
-            self.tel.Connected = False
-            # Only in a thread:
-            # win32com.client.pythoncom.CoUninitialize() # tel
+            self.tel.Disconnect()
+            self.tel.Stop()
         except:
             pass
         self.UpdateInfoTimer.Stop()
-        self.logfile.close()
+        logs.Close()
 
     def EnableWorkButtons(self):
         for button in self.WorkButtons:
@@ -639,6 +640,7 @@ class ControlPanel(wx.Panel):
         if self.working:
             self.working = False
             self.worker = None
+            self.pending_op = None
             self.AbortButton.Disable()
             self.EnableWorkButtons()
             wx.Bell()
@@ -652,10 +654,11 @@ class ControlPanel(wx.Panel):
             self.Log('Trying to abort...')
             self.need_abort = True
             self.take_image.clear()  # stop current exposure
-            try:
-                self.worker.next()
-            except StopIteration:
-                pass
+            if self.pending_op is not None:
+                # the worker continues when the operation is cancelled
+                self.pending_op.Cancel()
+            else:
+                self.StepWorker()
             return True
         else:
             return False
@@ -668,26 +671,48 @@ class ControlPanel(wx.Panel):
         # TakeWorker then calls next() on this generator, which starts an
         # exposure via the ImageTaker thread, then yields. TakeWorker then
         # completes, returning control to the WX panel.
-        # When the exposure is done and the new image is ready, an
-        # ImageReadyEvent is posted, running OnImageReady.
+        # When the exposure is done and the new image is ready, it is
+        # published on the frame bus and an ImageReadyEvent is posted,
+        # running OnImageReady.
         # This transfers the image and its time to instance variables, then
         # calls next() on self.worker to continue from where it left off.
         # If an abort is issued, then the current exposure is stopped,
         # self.worker.next() is called and the worker handles the abort.
-        if self.worker is not None:
-            self.image = event.image
-            self.image_time = event.image_time
-            self.image_exptime = event.image_exptime
-            self.image_tel_position = self.tel_position
-            try:
-                self.worker.next()
-            except StopIteration:
-                pass
+        # A worker may also yield an Operation (see orchestrator.py), such
+        # as a telescope offset, and is then continued when it completes.
+        self.image_notify.Clear()
+        frame = self.frames.Get(block=False)
+        while frame is not None:
+            if self.worker is not None:
+                self.image = frame.image
+                self.image_time = frame.image_time
+                self.image_exptime = frame.image_exptime
+                self.image_tel_position = self.TelescopePosition()
+                self.StepWorker()
+            frame = self.frames.Get(block=False)
 
     def TakeWorker(self, worker):
         if not self.working:
             self.worker = worker()
-            self.worker.next()
+            self.StepWorker()
+
+    def StepWorker(self):
+        if self.worker is None:
+            return
+        worker = self.worker
+        try:
+            op = worker.next()
+        except StopIteration:
+            return
+        if isinstance(op, Operation):
+            self.pending_op = op
+            op.AddDoneCallback(lambda op: wx.CallAfter(self.ResumeWorker,
+                                                       worker, op))
+
+    def ResumeWorker(self, worker, op):
+        if self.worker is worker and self.pending_op is op:
+            self.pending_op = None
+            self.StepWorker()
 
     def TakeBias(self, e):
         if self.CheckReadyForBias():
@@ -803,8 +828,8 @@ class ControlPanel(wx.Panel):
                         self.SaveImage('flat')
                         self.Log('Taken flat {:d}'.format(i+1))
                         self.CheckForAbort()
-                        self.OffsetTelescope(self.flat_offset)
-                        self.CheckForAbort()
+                        # move while this flat is processed
+                        offset = self.OffsetTelescope(self.flat_offset)
                         if i==0:
                             flat_stack = np.zeros((nflat,)+self.image.shape,
                                                   np.float)
@@ -816,6 +841,9 @@ class ControlPanel(wx.Panel):
                         self.DisplayRGBImage()
                         flat_stack[i] = self.image
                         self.CheckForAbort()
+                        yield offset
+                        self.CheckForAbort()
+                        offset.Result()
                     self.ProcessFlat(flat_stack)
                     self.CheckForAbort()
                     self.flat = self.image
@@ -889,8 +917,9 @@ class ControlPanel(wx.Panel):
                     self.GetAstrometry()
                     self.DisplayRGBImage()
                     self.CheckForAbort()
-                    if i < nexp - 1:
-                        self.Delay(delaytime)
+                    if i < nexp - 1 and delaytime > 0:
+                        self.Log('### Waiting {:.1f} sec'.format(delaytime))
+                        yield Delay(delaytime)
                     self.CheckForAbort()
             except ControlAbortError:
                 self.need_abort = False
@@ -902,16 +931,6 @@ class ControlPanel(wx.Panel):
                 self.Log('Science images done')
             self.StopWorking()
 
-    def Delay(self, delaytime):
-        if delaytime > 0:
-            self.Log('### Waiting {:.1f} sec'.format(delaytime))
-            delay = delaytime
-            while delay > 0:
-                self.CheckForAbort()
-                wx.Yield()
-                time.sleep(0.1)
-                delay -= 0.1
-
     def TakeContinuous(self, e):
         self.TakeWorker(self.TakeContinuousWorker)
 
@@ -1071,34 +1090,33 @@ class ControlPanel(wx.Panel):
             target = None
             self.Log('Target coordinates not recognised')
             traceback.print_exc()
-        if target is not None:
+        if target is not None and self.tel is not None:
             ra_str = target.ra.to_string(u.hour, precision=1, pad=True)
             dec_str = target.dec.to_string(u.deg, precision=1, pad=True,
                                            alwayssign=True)
             self.TargetRACtrl.ChangeValue(ra_str)
             self.TargetDecCtrl.ChangeValue(dec_str)
             self.Log('Slewing to {} {}'.format(ra_str, dec_str))
-            self.tel.TargetRightAscension = target.ra.hour
-            self.tel.TargetDeclination = target.dec.deg
             self.ast_position = None
-            try:
-                self.tel.SlewToTarget()
-            except:
-                self.Log('Slew failed')
-                traceback.print_exc()
-            else:
-                self.Log('Slew complete')
+            slew = self.tel.Slew(target.ra.hour, target.dec.deg)
+            slew.AddDoneCallback(lambda op: wx.CallAfter(self.OnSlewDone, op))
+
+    def OnSlewDone(self, op):
+        if op.exception is not None:
+            self.Log('Slew failed:\n{}'.format(op.exception))
+        else:
+            self.Log('Slew complete')
 
     def SyncToAstrometryAndOffsetTelescope(self, event):
-        if self.tel is not None and self.ast_position is not None:
-            ra = self.tel.RightAscension
-            dec = self.tel.Declination
-            sep = self.tel_position.separation(self.ast_position)
+        tel_position = self.TelescopePosition()
+        if tel_position is not None and self.ast_position is not None:
+            sep = tel_position.separation(self.ast_position)
             if (sep.degree < 5 or self.CheckSync()):
-                dra, ddec = self.tel_position.spherical_offsets_to(self.ast_position)
+                dra, ddec = tel_position.spherical_offsets_to(self.ast_position)
                 self.Log('Offsetting telescope to astrometry')
-                self.OffsetTelescope((dra.arcsec, ddec.arcsec))
-                self.Log('Telescope offset to astrometry')
+                offset = self.OffsetTelescope((dra.arcsec, ddec.arcsec))
+                offset.AddDoneCallback(lambda op: wx.CallAfter(
+                    self.Log, 'Telescope offset to astrometry'))
         else:
             self.Log('NOT syncing telescope to astrometry')
 
@@ -1112,23 +1130,22 @@ class ControlPanel(wx.Panel):
         return response == wx.ID_OK
 
     def OffsetTelescope(self, offset_arcsec):
+        # returns an Operation which completes when the offset is done
         dra, ddec = offset_arcsec
         if self.tel is not None:
-            self.tel.GuideRateRightAscension = 0.1
-            self.tel.GuideRateDeclination = 0.1
-            direction = 2 if dra > 0 else 3
-            offset_time = abs(dra / self.tel.GuideRateRightAscension / 3.6)
-            self.Log('Pulse guiding: direction {}, time {}'.format(direction, offset_time))
-            self.tel.PulseGuide(direction, offset_time)
-            direction = 0 if ddec > 0 else 1
-            offset_time = abs(ddec / self.tel.GuideRateDeclination / 3.6)
-            self.Log('Pulse guiding: direction {}, time {}'.format(direction, offset_time))
-            self.tel.PulseGuide(direction, offset_time)
-            while self.tel.IsPulseGuiding:
-                time.sleep(0.1)
-            self.Log('Telescope offset {:.1f}" RA, {:.1f}" Dec'.format(dra, ddec))
+            offset = self.tel.Offset(dra, ddec)
+            offset.AddDoneCallback(lambda op: wx.CallAfter(
+                self.OnOffsetDone, op, dra, ddec))
+            return offset
         else:
             self.Log('NOT offsetting telescope {:.1f}" RA, {:.1f}" Dec'.format(dra, ddec))
+            return Completed()
+
+    def OnOffsetDone(self, op, dra, ddec):
+        if op.exception is None:
+            self.Log('Telescope offset {:.1f}" RA, {:.1f}" Dec'.format(dra, ddec))
+        elif not op.Cancelled():
+            self.Log('Telescope offset failed:\n{}'.format(op.exception))
 
     def GetFlatExpTime(self, start_exptime=None,
                        min_exptime=0.1, max_exptime=120.0,
@@ -1172,8 +1189,7 @@ class ControlPanel(wx.Panel):
         if not self.ImageTaker.isAlive():
             self.Log("Restarting camera")
             self.StopCamera()
-            self.ImageTaker = TakeMainImageThread(self, self.stop_camera,
-                                                  self.take_image, 0.0)
+            self.StartImageTaker()
         self.ImageTaker.SetExpTime(exptime)
         self.take_image.set()
 
@@ -1293,10 +1309,10 @@ class ControlPanel(wx.Panel):
         if not os.path.exists(path):
             os.makedirs(path)
         solvefilename = os.path.join(path, 'solve.fits')
-        self.solver.put((self.filters, solvefilename,
-                         self.image_time,
-                         self.filters_filename.values(),
-                         self.image_tel_position))
+        return Solve(self.solver, self.filters, solvefilename,
+                     self.image_time,
+                     self.filters_filename.values(),
+                     self.image_tel_position)
 
     def OnSolutionReady(self, event):
         if event.solution is not None:
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# controller.py
+
+from __future__ import division
+
+import numpy as np
+
+# Guide controllers, turning each measured offset of the guide star (in
+# pixels, as (dx, dy)) into the correction to send to the AO unit.
+# All keep track of the total correction made, and so of where the star
+# would have been with no corrections, which is what drift and seeing act
+# on.  Each correction is counted as made when it is returned, so it is
+# not asked for again while on its way to the AO unit, and is taken out
+# again with Dropped if the AO unit does not make it.
+# Corrections smaller than min_correction are not sent, as before.
+# With auto=True, gains are estimated online from that uncorrected track
+# (see GainEstimator), trading following drift against chasing seeing.
+
+# ------------------------------------------------------------------------------
+# Estimates, for each axis, the variance per second of the random walk of
+# the uncorrected star position (drift, wind, periodic error, ...) and the
+# variance of the white noise on each measurement (seeing and centroid
+# noise), from the last window positions.  For a random walk plus white
+# noise, the differences between positions k frames apart have variance
+# k q + 2 r, so a straight line fitted to that variance for k up to
+# max_lag gives both.  Steady drift is removed along with the mean of
+# the differences.
+class GainEstimator(object):
+    def __init__(self, window=200, min_samples=30, max_lag=10):
+        self.window = window
+        self.min_samples = min_samples
+        self.max_lag = max_lag
+        self.Reset()
+
+    def Reset(self):
+        self.positions = np.zeros((self.window, 2))
+        self.times = np.zeros(self.window)
+        self.count = 0
+
+    def Add(self, position, t):
+        i = self.count % self.window
+        self.positions[i] = position
+        self.times[i] = t
+        self.count += 1
+
+    def Estimate(self):
+        # (q per second, r) for each axis, and the mean time between
+        # positions, or None if there are too few positions
+        n = min(self.count, self.window)
+        if n < self.min_samples:
+            return None
+        order = np.arange(self.count - n, self.count) % self.window
+        positions = self.positions[order]
+        lags = np.arange(1, min(self.max_lag, n // 3) + 1)
+        variances = np.empty((len(lags), 2))
+        for i, k in enumerate(lags):
+            diffs = positions[k:] - positions[:-k]
+            variances[i] = diffs.var(axis=0)
+        design = np.column_stack([lags, np.full(len(lags), 2.0)])
+        q, r = np.linalg.lstsq(design, variances)[0]
+        dt = max(np.diff(self.times[order]).mean(), 1e-3)
+        return np.maximum(q, 1e-6) / dt, np.maximum(r, 0.0), dt
+
+def SteadyGain(q, r):
+    # steady state Kalman gain for a random walk with variance q per
+    # frame, measured with noise variance r, i.e. the best proportional
+    # gain: near 1 when drift dominates, small when seeing dominates
+    prior = (q + np.sqrt(q**2 + 4 * q * r)) / 2
+    return prior / (prior + r)
+
+# ------------------------------------------------------------------------------
+# Proportional controller with a deadband.  With the default gain of 1 this
+# is the original behaviour, correcting the whole offset each frame.
+class GuideController(object):
+    def __init__(self, min_correction=0.1, gain=1.0, auto=False,
+                 min_gain=0.1, max_gain=1.0, window=100):
+        self.min_correction = min_correction
+        self.gain = np.full(2, gain)
+        self.min_gain = min_gain
+        self.max_gain = max_gain
+        self.estimator = GainEstimator(window) if auto else None
+        self.generation = 0
+        self.Reset()
+
+    def Reset(self):
+        # corrections from before a reset are no longer counted
+        self.generation += 1
+        self.applied = np.zeros(2)
+        self.last_correction = np.zeros(2)
+        self.last_t = None
+        if self.estimator is not None:
+            self.estimator.Reset()
+        self.ResetState()
+
+    def ResetState(self):
+        pass
+
+    def Update(self, offset, error, t, horizon=0.0):
+        # correction for the offset measured in a frame exposed at time t
+        # (on the timing.clock scale), with centroid errors error, to be
+        # made horizon seconds later
+        offset = np.asarray(offset, dtype=np.float64)
+        error = np.asarray(error, dtype=np.float64)
+        dt = 0.0 if self.last_t is None else t - self.last_t
+        self.last_t = t
+        if self.estimator is not None:
+            self.estimator.Add(offset + self.applied, t)
+            estimate = self.estimator.Estimate()
+            if estimate is not None:
+                self.Tune(*estimate)
+        correction = self.Correction(offset, error, dt, horizon)
+        correction = np.where(np.abs(correction) > self.min_correction,
+                              correction, 0.0)
+        self.applied += correction
+        self.last_correction = correction
+        return correction
+
+    def Dropped(self, correction, generation):
+        # a correction returned by Update, while at the given generation,
+        # which the AO unit did not make (cancelled, stale or failed)
+        if generation == self.generation:
+            self.applied -= np.asarray(correction, dtype=np.float64)
+
+    def Tune(self, q, r, dt):
+        self.gain = np.clip(SteadyGain(q * dt, r), self.min_gain,
+                            self.max_gain)
+
+    def Correction(self, offset, error, dt, horizon):
+        return self.gain * offset
+
+    def Describe(self):
+        return 'gain ({:.2f},{:.2f})'.format(*self.gain)
+
+# ------------------------------------------------------------------------------
+# Proportional-integral controller.  The integral term, limited to
+# max_integral pixels, takes out steady drift, which a proportional gain
+# below 1 would otherwise always lag behind.
+class PIController(GuideController):
+    def __init__(self, min_correction=0.1, gain=0.7, integral_gain=0.1,
+                 max_integral=2.0, **kwargs):
+        self.integral_gain = integral_gain
+        self.max_integral = max_integral
+        GuideController.__init__(self, min_correction, gain, **kwargs)
+
+    def ResetState(self):
+        self.integral = np.zeros(2)
+
+    def Correction(self, offset, error, dt, horizon):
+        self.integral = np.clip(self.integral + offset, -self.max_integral,
+                                self.max_integral)
+        return self.gain * offset + self.integral_gain * self.integral
+
+    def Describe(self):
+        return GuideController.Describe(self) + ', integral {:.2f}'.format(
+            self.integral_gain)
+
+# ------------------------------------------------------------------------------
+# Proportional controller with hysteresis, blending in a fraction of the
+# previous correction, so one frame of bad seeing moves the AO unit less.
+class HysteresisController(GuideController):
+    def __init__(self, min_correction=0.1, gain=0.8, hysteresis=0.3,
+                 **kwargs):
+        self.hysteresis = hysteresis
+        GuideController.__init__(self, min_correction, gain, **kwargs)
+
+    def Correction(self, offset, error, dt, horizon):
+        h = self.hysteresis
+        return (1 - h) * self.gain * offset + h * self.last_correction
+
+    def Describe(self):
+        return GuideController.Describe(self) + ', hysteresis {:.2f}'.format(
+            self.hysteresis)
+
+# ------------------------------------------------------------------------------
+# Kalman filter following the uncorrected star position and its drift
+# rate on each axis.  The position follows a random walk (position_noise,
+# pixels^2 per second) and so does the drift rate (drift_noise,
+# (pixels/sec)^2 per second); each measurement has the seeing variance
+# plus that of the centroid.  The correction takes out the filtered
+# position predicted for when the correction is made, so steady drift is
+# corrected without lag, while seeing is averaged over several frames.
+# With auto=True, position_noise and seeing come from GainEstimator.
+class KalmanController(GuideController):
+    def __init__(self, min_correction=0.1, position_noise=0.05,
+                 drift_noise=1e-4, seeing=0.3, initial_drift=0.1,
+                 **kwargs):
+        self.position_noise = np.full(2, position_noise)
+        self.drift_noise = drift_noise
+        self.seeing = np.full(2, seeing)
+        self.initial_drift = initial_drift
+        GuideController.__init__(self, min_correction, **kwargs)
+
+    def ResetState(self):
+        self.position = None
+        self.drift = np.zeros(2)
+        # covariance of position and drift, for each axis
+        self.p11 = self.p12 = self.p22 = None
+
+    def Tune(self, q, r, dt):
+        self.position_noise = q
+        self.seeing = np.sqrt(r)
+
+    def Correction(self, offset, error, dt, horizon):
+        z = offset + self.applied
+        noise = self.seeing**2 + error**2
+        if self.position is None:
+            self.position = z
+            self.p11 = noise
+            self.p12 = np.zeros(2)
+            self.p22 = np.full(2, self.initial_drift**2)
+        else:
+            # predict
+            self.position = self.position + self.drift * dt
+            self.p11 = (self.p11 + 2 * dt * self.p12 + dt**2 * self.p22 +
+                        self.position_noise * dt)
+            self.p12 = self.p12 + dt * self.p22
+            self.p22 = self.p22 + self.drift_noise * dt
+            # update
+            s = self.p11 + noise
+            k1 = self.p11 / s
+            k2 = self.p12 / s
+            innovation = z - self.position
+            self.position = self.position + k1 * innovation
+            self.drift = self.drift + k2 * innovation
+            self.p22 = self.p22 - k2 * self.p12
+            self.p12 = (1 - k1) * self.p12
+            self.p11 = (1 - k1) * self.p11
+        return self.position + self.drift * horizon - self.applied
+
+    def Describe(self):
+        return ('drift ({:.3f},{:.3f}) pix/s, seeing ({:.2f},{:.2f}) '
+                'pix'.format(self.drift[0], self.drift[1], *self.seeing))
+
+controllers = {
+    'proportional': GuideController,
+    'pi': PIController,
+    'hysteresis': HysteresisController,
+    'kalman': KalmanController,
+}
+
+def MakeController(name, min_correction=0.1, **kwargs):
+    try:
+        cls = controllers[name]
+    except KeyError:
+        raise ValueError('Unknown guide controller: {}'.format(name))
+    return cls(min_correction, **kwargs)
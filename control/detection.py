@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# detection.py
+
+from __future__ import division
+
+from collections import namedtuple
+import numpy as np
+from scipy.ndimage import label
+from scipy.ndimage.filters import gaussian_filter
+
+import centroid
+
+# Source detection on a guider frame, for choosing a guide star.
+# Positions are in numpy image pixel coordinates, as used by the guider,
+# with x along the first image axis and y along the second.
+
+# Detected sources.  Each field is an array with one entry per source,
+# sorted best guide star first (or a scalar, for a single source).
+# edge is the distance to the nearest image edge and isolation the distance
+# to the nearest other source, both in pixels.
+Sources = namedtuple('Sources', ['x', 'y', 'flux', 'peak', 'npix', 'snr',
+                                 'fwhm', 'saturated', 'edge', 'isolation',
+                                 'score'])
+
+# Defaults for detection
+nsigma = 5.0  # detection threshold, in sigma of the smoothed image
+min_pixels = 3  # smallest source, in pixels above threshold
+smooth = 1.0  # sigma of Gaussian smoothing, in pixels
+cell = 32  # size of background cells, in pixels
+max_sources = 200  # brightest sources kept for ranking
+
+def EstimateBackground(image, cell=cell):
+    # Background map from the median of each cell, and the robust noise
+    # from the spread of pixels about it.  Cells are taken from the image
+    # trimmed to a whole number of cells, and the map is extended to the
+    # full image by repeating its edges.
+    nx, ny = [max(n // cell, 1) for n in image.shape]
+    cx, cy = [min(cell, n) for n in image.shape]
+    trimmed = image[:nx*cx, :ny*cy].astype(np.float64)
+    cells = trimmed.reshape(nx, cx, ny, cy).swapaxes(1, 2).reshape(nx, ny, -1)
+    grid = np.median(cells, axis=2)
+    background = np.repeat(np.repeat(grid, cx, axis=0), cy, axis=1)
+    pad = [(0, n - m) for n, m in zip(image.shape, background.shape)]
+    background = np.pad(background, pad, mode='edge')
+    residual = trimmed[::2, ::2] - background[:nx*cx:2, :ny*cy:2]
+    noise = 1.4826 * np.median(np.abs(residual - np.median(residual)))
+    return background, max(noise, 1e-6)
+
+def DetectSources(image, nsigma=nsigma, min_pixels=min_pixels, smooth=smooth,
+                  cell=cell, saturation=centroid.saturation,
+                  gain=centroid.gain):
+    # Threshold the smoothed, background-subtracted image, label the
+    # connected regions and measure their moments, all vectorised.
+    # Returns unranked Sources.
+    image = np.asarray(image)
+    background, noise = EstimateBackground(image, cell)
+    data = image - background
+    # smoothing is a matched filter for stars, so faint stars reach the
+    # threshold; its noise is measured rather than predicted
+    smoothed = gaussian_filter(data, smooth) if smooth else data
+    sample = smoothed[::2, ::2]
+    smooth_noise = 1.4826 * np.median(np.abs(sample - np.median(sample)))
+    mask = smoothed > nsigma * max(smooth_noise, 1e-6)
+    labels, n = label(mask)
+    labels = labels.ravel()
+    values = data.ravel()
+    x, y = [c.ravel() for c in np.indices(image.shape)]
+    count = lambda w=None: np.bincount(labels, weights=w, minlength=n+1)[1:]
+    npix = count()
+    # moments of the unsmoothed data within each region
+    w = np.maximum(values, 0)
+    flux = count(w)
+    keep = (npix >= min_pixels) & (flux > 0)
+    total = np.where(keep, flux, 1.0)
+    xc = count(w * x) / total
+    yc = count(w * y) / total
+    sigma2 = (count(w * (x * x + y * y)) / total - xc**2 - yc**2) / 2
+    fwhm = centroid.gaussian_fwhm * np.sqrt(np.maximum(sigma2, 0))
+    peak = np.zeros(n + 1)
+    np.maximum.at(peak, labels, image.ravel())
+    peak = peak[1:]
+    snr = flux / np.sqrt(npix * noise**2 + flux / gain)
+    keep = np.flatnonzero(keep)
+    if len(keep) > max_sources:
+        keep = keep[np.argsort(flux[keep])[::-1][:max_sources]]
+    edge = np.min([xc, yc, image.shape[0] - 1 - xc,
+                   image.shape[1] - 1 - yc], axis=0)
+    sources = Sources(xc, yc, flux, peak, npix, snr, fwhm,
+                      peak >= saturation, edge, np.zeros(n), np.zeros(n))
+    sources = Sources._make(field[keep] for field in sources)
+    return sources._replace(isolation=Isolation(sources.x, sources.y))
+
+def Isolation(x, y):
+    # distance from each source to its nearest neighbour
+    if len(x) < 2:
+        return np.full(len(x), np.inf)
+    d2 = (x[:, None] - x)**2 + (y[:, None] - y)**2
+    np.fill_diagonal(d2, np.inf)
+    return np.sqrt(d2.min(axis=1))
+
+def RankSources(sources, box_size, min_snr=10.0):
+    # Score sources as guide stars and sort them, best first.
+    # Saturated stars, stars whose guide box would cross the edge and stars
+    # with a neighbour inside their guide box are ruled out.  Otherwise the
+    # score is the SNR, reduced for stars which are only just isolated or
+    # near the edge, so a bright isolated star near the centre wins.
+    half = box_size / 2
+    usable = ((~sources.saturated) & (sources.snr >= min_snr) &
+              (sources.edge > half + 1) & (sources.isolation > box_size))
+    isolation = np.clip(sources.isolation / (2 * box_size), 0, 1)
+    edge = np.clip(sources.edge / (4 * box_size), 0, 1)
+    score = np.where(usable, sources.snr * (0.5 + 0.5 * isolation) *
+                     (0.5 + 0.5 * edge), 0.0)
+    order = np.argsort(score)[::-1]
+    sources = sources._replace(score=score)
+    return Sources._make(field[order] for field in sources)
+
+def SelectGuideStar(image, box_size, **kwargs):
+    # best guide star in the image, as a single Source, or None
+    min_snr = kwargs.pop('min_snr', 10.0)
+    sources = RankSources(DetectSources(image, **kwargs), box_size, min_snr)
+    if len(sources.x) == 0 or sources.score[0] <= 0:
+        return None
+    return Sources._make(field[0] for field in sources)
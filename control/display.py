@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# display.py
+
+from __future__ import division
+
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# Class to turn camera images into RGB (greyscale) buffers for display.
+# Images are first binned down towards the display size, keeping the
+# brightest pixel of each bin so stars do not fade, and then mapped to
+# 8 bits through a lookup table.  The table is only rebuilt when the
+# stretch limits drift by more than a fraction of their range, and the
+# limits are found from a subsample of the image.  The RGB buffer is reused
+# from one frame to the next while the size is unchanged.
+# The lower and upper stretch limits are percentiles, as in the original
+# guider display; a percentile of 100 is simply the image maximum.
+class DisplayRenderer(object):
+    def __init__(self, levels=(5.0, 100.0), min_range=16, drift=0.05,
+                 sample_step=4, maxvalue=65535):
+        self.levels = levels
+        # do not exaggerate really low counts
+        self.min_range = min_range
+        self.drift = drift
+        self.sample_step = sample_step
+        self.maxvalue = maxvalue
+        self.limits = None
+        self.lut = None
+        self.rgb = None
+
+    def Render(self, image, size):
+        # RGB buffer, shape (height, width, 3) as wx expects, for the image
+        # to be shown at (at least) the given (width, height)
+        image = self.Downsample(image, size)
+        self.Stretch(image)
+        if image.dtype.kind not in 'iu':
+            image = image.astype(np.int32)
+        mapped = np.take(self.lut, image, mode='clip')
+        shape = (image.shape[1], image.shape[0], 3)
+        if self.rgb is None or self.rgb.shape != shape:
+            self.rgb = np.empty(shape, dtype=np.uint8)
+        np.copyto(self.rgb, mapped.T[:, :, None])
+        return self.rgb
+
+    def Downsample(self, image, size):
+        factor = int(min(image.shape[0] / size[0], image.shape[1] / size[1]))
+        if factor <= 1:
+            return image
+        nx, ny = [n // factor * factor for n in image.shape]
+        # maximum over strided views is much faster than reshaping
+        binned = image[0:nx:factor, 0:ny:factor].copy()
+        for i in range(factor):
+            for j in range(factor):
+                if i or j:
+                    np.maximum(binned, image[i:nx:factor, j:ny:factor],
+                               out=binned)
+        return binned
+
+    def Stretch(self, image):
+        sample = image[::self.sample_step, ::self.sample_step]
+        limits = [image.max() if level >= 100 else
+                  np.percentile(sample, level) for level in self.levels]
+        imin, imax = limits
+        imax = max(imax, imin + self.min_range)
+        if self.limits is not None:
+            old_min, old_max = self.limits
+            tolerance = self.drift * (old_max - old_min)
+            if (abs(imin - old_min) <= tolerance and
+                abs(imax - old_max) <= tolerance):
+                return
+        self.limits = (imin, imax)
+        values = np.arange(self.maxvalue + 1, dtype=np.float64)
+        lut = (values - imin) / (imax - imin) * 255
+        self.lut = lut.clip(0, 255).astype(np.uint8)
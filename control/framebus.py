@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# framebus.py
+
+import wx
+import threading
+from collections import deque, namedtuple
+
+from timing import clock
+
+# ------------------------------------------------------------------------------
+# A frame published on the bus.
+# seq counts frames on each topic, t_ready is the (monotonic) clock time
+# at which the frame was published, and t_exposed when its exposure ended,
+# if known, on the same clock.
+Frame = namedtuple('Frame', ['image', 'image_time', 'image_exptime',
+                             'seq', 't_ready', 't_exposed'])
+
+# Policies for a subscriber whose queue is full:
+# discard the oldest queued frame,
+DROP_OLDEST = 'drop_oldest'
+# only ever hold the newest frame,
+KEEP_LATEST = 'keep_latest'
+# or make the publisher wait until there is space.
+BLOCK = 'block'
+
+# ------------------------------------------------------------------------------
+# A bounded queue of frames for one subscriber to one topic.
+# The optional notify function is called (on the publisher's thread)
+# after each frame is queued.
+class Subscription(object):
+    def __init__(self, topic, maxsize=1, policy=KEEP_LATEST, notify=None):
+        if policy not in (DROP_OLDEST, KEEP_LATEST, BLOCK):
+            raise ValueError('Unknown frame bus policy: {}'.format(policy))
+        self.topic = topic
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.notify = notify
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+
+    def Put(self, frame):
+        with self.condition:
+            if self.closed:
+                return
+            self.received += 1
+            if self.policy == KEEP_LATEST:
+                self.dropped += len(self.frames)
+                self.frames.clear()
+            elif self.policy == DROP_OLDEST:
+                while len(self.frames) >= self.maxsize:
+                    self.frames.popleft()
+                    self.dropped += 1
+            else:
+                while len(self.frames) >= self.maxsize and not self.closed:
+                    self.condition.wait(0.1)
+            self.frames.append(frame)
+            self.condition.notify_all()
+        if self.notify is not None:
+            self.notify(self)
+
+    def Wait(self, block, timeout):
+        # called with the condition held
+        if block:
+            end = None if timeout is None else clock() + timeout
+            while not self.frames and not self.closed:
+                remaining = None if end is None else end - clock()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+    def Get(self, block=True, timeout=None):
+        # return the oldest queued frame, or None if there is none
+        with self.condition:
+            self.Wait(block, timeout)
+            if not self.frames:
+                return None
+            return self.Delivered(self.frames.popleft())
+
+    def GetLatest(self, block=True, timeout=None):
+        # return the newest queued frame, discarding any older ones
+        with self.condition:
+            self.Wait(block, timeout)
+            if not self.frames:
+                return None
+            self.dropped += len(self.frames) - 1
+            frame = self.frames.pop()
+            self.frames.clear()
+            return self.Delivered(frame)
+
+    def Delivered(self, frame):
+        self.delivered += 1
+        self.last_lag = clock() - frame.t_ready
+        self.condition.notify_all()
+        return frame
+
+    def Pending(self):
+        with self.condition:
+            return len(self.frames)
+
+    def Lag(self):
+        # age of the oldest frame waiting to be read
+        with self.condition:
+            if self.frames:
+                return clock() - self.frames[0].t_ready
+            return 0.0
+
+    def GetStats(self):
+        with self.condition:
+            return {'topic': self.topic, 'policy': self.policy,
+                    'received': self.received, 'delivered': self.delivered,
+                    'dropped': self.dropped, 'pending': len(self.frames),
+                    'last_lag': self.last_lag}
+
+    def Close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+# ------------------------------------------------------------------------------
+# Named topics (e.g. 'main' and 'guider' cameras), each with any number of
+# subscribers.  Publishing never queues more than each subscriber allows,
+# so a slow subscriber cannot make memory grow without bound, and with
+# KEEP_LATEST a subscriber always sees the newest frame.
+class FrameBus(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.seq = {}
+
+    def Subscribe(self, topic, maxsize=1, policy=KEEP_LATEST, notify=None):
+        subscription = Subscription(topic, maxsize, policy, notify)
+        with self.lock:
+            self.subscriptions.setdefault(topic, []).append(subscription)
+        return subscription
+
+    def Unsubscribe(self, subscription):
+        subscription.Close()
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.topic, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+
+    def Publish(self, topic, image, image_time=None, image_exptime=None,
+                t_exposed=None):
+        with self.lock:
+            seq = self.seq.get(topic, 0) + 1
+            self.seq[topic] = seq
+            subscriptions = list(self.subscriptions.get(topic, []))
+        frame = Frame(image, image_time, image_exptime, seq, clock(),
+                      t_exposed)
+        for subscription in subscriptions:
+            subscription.Put(frame)
+        return frame
+
+    def GetStats(self):
+        with self.lock:
+            subscriptions = [s for subs in self.subscriptions.values()
+                             for s in subs]
+        return [s.GetStats() for s in subscriptions]
+
+# Shared by all cameras and consumers in this process
+frames = FrameBus()
+
+# ------------------------------------------------------------------------------
+# Notify function which posts a (payload-free) wx event to a window when
+# frames are waiting.  At most one event is pending at a time, so the wx
+# event queue never fills with frames; the handler should call Clear()
+# and then read everything waiting in its Subscription.
+class WxFrameNotify(object):
+    def __init__(self, window, event_class):
+        self.window = window
+        self.event_class = event_class
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def __call__(self, subscription):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+        wx.PostEvent(self.window, self.event_class())
+
+    def Clear(self):
+        with self.lock:
+            self.pending = False
@@ -0,0 +1,671 @@
+# -*- coding: utf-8 -*-
+
+# guideloop.py
+
+import time
+import threading
+import numpy as np
+
+from centroid import BoxIndices, CentroidBoxes, Centroids
+from detection import SelectGuideStar, DetectSources, RankSources
+from controller import GuideController
+from telemetry import GUIDING, LOST, SENT, MADE, DROPPED
+from latency import LatencyMonitor
+from timing import clock
+from orchestrator import scheduler
+from ao import AOStep
+from framebus import frames, KEEP_LATEST
+from logservice import logs, SourceOf
+
+# ------------------------------------------------------------------------------
+# Class to run the guide loop on its own thread, off the wx main thread.
+# It takes the newest frame straight from the guider camera via the frame
+# bus, measures the guide star within the guide box and, when guiding,
+# puts a ('G', dx, dy, deadline) correction on the AO queue (see AOStep).
+# The correction is worked out from the offset by a guide controller (see
+# controller.py), by default correcting the whole offset when it is more
+# than min_correction, as it was before controllers were added.
+# Given a PeriodicErrorModel (see periodic.py), the guide loop adds where
+# the star would have been along RA without corrections, refits the model
+# every refit_period on a thread of its own and, once it is usable and
+# feed_forward is 'ao' or 'mount', predicts the periodic error and
+# corrects it ahead of time through that channel every
+# feed_forward_period, so the guide controller only sees what is left.  RA is along x unless set by SetRADirection.
+# The deadline is when the next frame is expected, after which AOThread
+# discards the correction as stale.
+# With nstars > 1, further guide stars are chosen automatically around the
+# guide box, all the boxes are measured together and their offsets combined
+# into a single correction (see CombineOffsets), optionally also estimating
+# field rotation.
+# The guide box is set from the GUI with SetBox, or by searching the whole
+# frame for the best guide star (see detection.py), either on request or
+# automatically when there is no box or, when not guiding, the star is lost.
+# Each frame the star is checked (see CheckStar).  While it is not valid no
+# corrections are made, and a window around where it was last seen is
+# searched, growing each frame, until it is found again.  The boxes are
+# then measured at the star's new offset from the guide box (self.track),
+# which also follows the star when it moves well away from the middle of
+# the box, and guiding resumes.
+# Given a dark library (see calibration.py) with SetCalibration, only the
+# pixels in the guide boxes, or the region searched for stars, are dark
+# subtracted and have hot pixels removed.
+# Given a TelemetryRecorder (see telemetry.py) with SetTelemetry, a record
+# of each frame measured is kept, with the correction sent and, once the
+# AO unit has made it, how long that took and where the AO unit is, and
+# the per-frame log lines are left out.
+# The time each frame reaches each point on the way from its exposure
+# ending to the AO unit acknowledging the correction is kept in a
+# LatencyMonitor (self.latency, see latency.py), which alerts when the
+# corrections lag too far behind.
+# The box position can be read back with GetBox; the latest centroid can be
+# read back with GetCentroid for display, and the full measurement
+# (see centroid.Centroids) with GetStar.
+class GuideLoopThread(threading.Thread):
+    def __init__(self, parent, box_size, min_correction, method='windowed',
+                 auto_select=False, min_snr=10.0, nstars=1, rotation=False,
+                 controller=None, periodic=None, feed_forward='ao'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.parent = parent
+        self.box_size = box_size
+        self.min_correction = min_correction
+        self.method = method
+        self.auto_select = auto_select
+        self.min_snr = min_snr
+        self.nstars = nstars
+        self.estimate_rotation = rotation
+        if controller is None:
+            controller = GuideController(min_correction)
+        self.controller = controller
+        # expected time from working out a correction to it being made
+        self.ao_latency = 0.02  # seconds
+        # periodic error learning and feed-forward correction
+        self.periodic = periodic
+        self.feed_forward = feed_forward
+        self.ra_direction = np.array([1.0, 0.0])
+        self.refit_period = 60.0  # seconds
+        self.feed_forward_period = 0.5  # seconds
+        self.min_feed_forward = 0.02  # pixels
+        self.last_fit = clock()
+        self.fitting = False
+        self.feed_forward_generation = 0
+        self.ResetFeedForward()
+        # outlier rejection for combining stars, in robust sigma
+        self.clip = 3.0
+        # star validity checks
+        self.min_fwhm = 0.7  # pixels
+        self.max_fwhm = box_size / 3.0  # pixels
+        self.max_flux_change = 3.0  # factor from recent average
+        self.edge_margin = 2  # pixels from edge of box
+        # search window when lost, in box sizes
+        self.max_search = 8
+        # allowance for a correction when the exposure time is very short
+        self.min_deadline = 0.1  # seconds
+        self.frames = frames.Subscribe('guider', policy=KEEP_LATEST)
+        self.stopevent = threading.Event()
+        self.lock = threading.Lock()
+        self.corrections = None
+        self.box_position = None
+        self.centroid = None
+        self.star = None
+        self.search = False
+        self.search_failed = False
+        self.extra_boxes = None
+        self.rotation = None
+        self.calibration = None
+        self.paused = False
+        self.telemetry = None
+        self.ao_position = None
+        self.latency = LatencyMonitor(log=lambda text: self.Log(text))
+        self.t_taken = None
+        self.tracking_generation = 0
+        self.frame_generation = 0
+        self.ResetTracking()
+        if periodic is not None:
+            self.ScheduleFeedForward()
+        self.start()
+
+    def run(self):
+        while not self.stopevent.is_set():
+            frame = self.frames.GetLatest(timeout=0.5)
+            if frame is None or self.paused:
+                continue
+            self.t_taken = clock()
+            with self.lock:
+                box = self.box_position
+                corrections = self.corrections
+                search = self.search or (box is None and self.auto_select)
+                self.search = False
+                # the tracking state this frame is measured with
+                self.frame_generation = self.tracking_generation
+            if search:
+                box = self.FindStar(frame) or box
+            if box is None:
+                continue
+            boxes = [box]
+            if self.nstars > 1:
+                boxes += self.GetExtraBoxes(frame, box)
+            self.Guide(frame, boxes, corrections)
+        frames.Unsubscribe(self.frames)
+
+    def Guide(self, frame, boxes, corrections):
+        with self.lock:
+            tx, ty = self.track
+        boxes = [(bx + tx, by + ty) for bx, by in boxes]
+        x, y = boxes[0]
+        stars = self.MeasureBoxes(frame, boxes)
+        star = Centroids._make(field[0] for field in stars)
+        dx, dy = star.dx, star.dy
+        rotation = None
+        problem = primary_problem = self.CheckStar(star)
+        if len(boxes) > 1:
+            dx, dy, rotation, used = CombineOffsets(
+                np.array(boxes, dtype=np.float64), stars, self.min_snr,
+                self.clip, self.estimate_rotation)
+            if used.any():
+                problem = None
+            else:
+                dx, dy = star.dx, star.dy
+        with self.lock:
+            self.star = star
+            self.rotation = rotation
+            if problem is None:
+                self.centroid = (x + star.dx, y + star.dy)
+            else:
+                self.centroid = None
+                if corrections is None and self.auto_select:
+                    # star lost while not guiding, so look for another
+                    self.search = True
+        times = {'ready': frame.t_ready, 'taken': self.t_taken,
+                 'measured': clock()}
+        if frame.t_exposed is not None:
+            times['exposed'] = frame.t_exposed
+        telemetry = self.telemetry
+        if problem is not None:
+            if telemetry is not None:
+                self.Record(telemetry, frame, corrections, star, x, y,
+                            star.dx + tx, star.dy + ty, flags=LOST)
+            self.latency.Add(times)
+            self.StarLost(frame, problem, corrections)
+            return
+        self.StarFound(star if primary_problem is None else None)
+        # offset of the star from the guide box
+        dx += tx
+        dy += ty
+        if corrections is None:
+            if telemetry is not None:
+                self.Record(telemetry, frame, corrections, star, x, y, dx, dy)
+            self.latency.Add(times)
+            return
+        if telemetry is None:
+            if len(boxes) > 1:
+                self.Log('Combined offset of {:d}/{:d} stars is '
+                         '({:.2f},{:.2f})'.format(used.sum(), len(boxes),
+                                                  dx, dy))
+                if rotation is not None:
+                    self.Log('Field rotation {:.4f} deg'.format(
+                        np.degrees(rotation)))
+            else:
+                self.Log('Centroid within guide box is ({:.2f},{:.2f}), '
+                         'SNR {:.1f}'.format(dx, dy, star.snr))
+        exptime = frame.image_exptime or 0.0
+        # the offset is for the middle of the exposure, and the
+        # correction is made a little after now
+        t = frame.t_ready - exptime / 2.0
+        horizon = clock() + self.ao_latency - t
+        with self.lock:
+            if self.periodic is not None:
+                self.AddPeriodic(t, (dx, dy))
+            controller = self.controller
+            cx, cy = controller.Update((dx, dy), (star.dx_err, star.dy_err),
+                                       t, horizon)
+            generation = controller.generation
+        if not (cx or cy):
+            if telemetry is not None:
+                self.Record(telemetry, frame, corrections, star, x, y, dx, dy)
+            self.latency.Add(times)
+            return
+        deadline = frame.t_ready + max(exptime, self.min_deadline)
+        index = None
+        if telemetry is not None:
+            index = self.Record(telemetry, frame, corrections, star, x, y,
+                                dx, dy, cx, cy, SENT)
+        op = AOStep(corrections, 'G', cx, cy, deadline)
+        times['queued'] = op.t_start
+        correction = (controller, (cx, cy), generation)
+        op.AddDoneCallback(lambda op: self.Acknowledged(
+            telemetry, index, op, times, exptime, correction))
+
+    def Record(self, telemetry, frame, corrections, star, x, y, dx, dy,
+               cx=0.0, cy=0.0, flags=0):
+        if corrections is not None:
+            flags |= GUIDING
+        now = clock()
+        try:
+            return telemetry.Append(t=frame.t_ready,
+                                    time=time.time() - (now - frame.t_ready),
+                                    exptime=frame.image_exptime or 0.0,
+                                    x=x + star.dx, y=y + star.dy,
+                                    dx=dx, dy=dy, flux=star.flux,
+                                    snr=star.snr, fwhm=star.fwhm,
+                                    cx=cx, cy=cy, delay=now - frame.t_ready,
+                                    flags=flags)
+        except Exception as detail:
+            self.TelemetryFailed(telemetry, detail)
+            return None
+
+    def TelemetryFailed(self, telemetry, detail):
+        # stop recording, rather than stop guiding
+        if self.telemetry is telemetry:
+            self.telemetry = None
+            self.Log('Telemetry recording stopped: {}'.format(detail))
+
+    def Acknowledged(self, telemetry, index, op, times, exptime,
+                     correction=None):
+        # called by the AO thread once the correction has been made, or
+        # not, in which case the controller that asked for it, given with
+        # the correction and its generation, no longer counts it as made
+        made = not (op.cancelled or op.exception is not None or
+                    not op.result)
+        if not made and correction is not None:
+            controller, (cx, cy), generation = correction
+            with self.lock:
+                controller.Dropped((cx, cy), generation)
+        if made:
+            times.update(op.marks)
+            times['acked'] = op.t_done
+        self.latency.Add(times, exptime)
+        if telemetry is None or index is None:
+            return
+        if not made:
+            try:
+                telemetry.Update(index, DROPPED)
+            except Exception as detail:
+                self.TelemetryFailed(telemetry, detail)
+            return
+        values = {'latency': op.t_done - op.t_start}
+        position = self.ao_position() if self.ao_position else None
+        if position is not None:
+            values['ao_x'], values['ao_y'] = position
+        try:
+            telemetry.Update(index, MADE, **values)
+        except Exception as detail:
+            self.TelemetryFailed(telemetry, detail)
+
+    def SetTelemetry(self, telemetry, ao_position=None):
+        # ao_position() gives the (x, y) position of the AO unit in steps
+        self.telemetry = telemetry
+        self.ao_position = ao_position
+
+    def MeasureBoxes(self, frame, boxes):
+        index = BoxIndices(frame.image.shape, boxes, self.box_size)
+        data = frame.image[index]
+        calibration = self.calibration
+        if calibration is not None and calibration.Matches(frame.image):
+            data = calibration.CalibrateBoxes(data, index,
+                                              frame.image_exptime or 0.0)
+        return CentroidBoxes(data, self.method)
+
+    def Calibrated(self, frame, image=None, x0=0, y0=0):
+        # the frame's image, or a region of it starting at (x0, y0),
+        # calibrated if possible
+        if image is None:
+            image = frame.image
+        calibration = self.calibration
+        if calibration is not None and calibration.Matches(frame.image):
+            image = calibration.Calibrate(image, frame.image_exptime or 0.0,
+                                          x0, y0)
+        return image
+
+    def Pause(self, paused=True):
+        # stop measuring frames, e.g. while calibrating
+        self.paused = paused
+
+    def SetCalibration(self, calibration):
+        self.calibration = calibration
+
+    def CheckStar(self, star):
+        # reason the star is not fit to guide on, or None if it is
+        if not star.snr >= self.min_snr:
+            return 'SNR {:.1f}'.format(star.snr)
+        if star.saturated:
+            return 'saturated'
+        if not self.min_fwhm <= star.fwhm <= self.max_fwhm:
+            return 'FWHM {:.1f}'.format(star.fwhm)
+        if self.ref_flux is not None:
+            change = star.flux / self.ref_flux
+            if not 1 / self.max_flux_change < change < self.max_flux_change:
+                return 'flux changed by {:.2f}'.format(change)
+        limit = self.box_size / 2.0 - self.edge_margin
+        if max(abs(star.dx), abs(star.dy)) > limit:
+            return 'at edge of box'
+        return None
+
+    def StarFound(self, star):
+        # The tracking state is shared with SetBox, so is only changed
+        # under the lock, and not at all if the box was changed while the
+        # frame was being measured
+        with self.lock:
+            if self.frame_generation != self.tracking_generation:
+                return
+            if self.lost:
+                self.Log('Guide star recovered after {:d} '
+                         'frames'.format(self.lost))
+                self.lost = 0
+            if star is None:
+                # guiding on the other stars
+                return
+            # recent averages, to compare the next frame with
+            if self.ref_flux is None:
+                self.ref_flux = star.flux
+            else:
+                self.ref_flux += 0.2 * (star.flux - self.ref_flux)
+            tx, ty = self.track
+            x, y = self.box_position
+            self.last_position = (x + tx + star.dx, y + ty + star.dy)
+            # follow a star which has moved well off the middle of the box
+            if max(abs(star.dx), abs(star.dy)) > self.box_size / 4.0:
+                self.track = (tx + int(round(star.dx)),
+                              ty + int(round(star.dy)))
+
+    def StarLost(self, frame, problem, corrections):
+        # stop correcting and search around where the star was last seen,
+        # holding the lock as in StarFound, though not while searching
+        with self.lock:
+            if self.frame_generation != self.tracking_generation:
+                return
+            self.lost += 1
+            lost = self.lost
+            last_position = self.last_position
+        if lost == 1:
+            if corrections is not None:
+                self.Log('Guide star lost ({}), corrections '
+                         'suspended'.format(problem))
+            else:
+                self.Log('Guide star lost ({})'.format(problem))
+        if corrections is None or last_position is None:
+            return
+        found = self.SearchNear(frame, last_position, lost)
+        if found is None:
+            return
+        with self.lock:
+            if self.frame_generation != self.tracking_generation:
+                return
+            x, y = self.box_position
+            self.track = (int(round(found[0] - x)), int(round(found[1] - y)))
+        self.Log('Guide star found at ({:.1f},{:.1f})'.format(*found))
+
+    def SearchNear(self, frame, position, attempt):
+        # Look for the star in a window around position, which grows with
+        # each attempt.  Returns the position of the nearest source like
+        # the guide star, or None.
+        size = self.box_size * min(1 + attempt, self.max_search)
+        x0, y0 = [max(int(round(c - size / 2.0)), 0) for c in position]
+        window = frame.image[x0:x0+size, y0:y0+size]
+        if min(window.shape) < self.box_size:
+            return None
+        sources = DetectSources(self.Calibrated(frame, window, x0, y0))
+        ok = (sources.snr >= self.min_snr) & ~sources.saturated
+        if self.ref_flux is not None:
+            change = sources.flux / self.ref_flux
+            ok &= ((change > 1 / self.max_flux_change) &
+                   (change < self.max_flux_change))
+        if not ok.any():
+            return None
+        x = sources.x[ok] + x0
+        y = sources.y[ok] + y0
+        nearest = np.argmin(np.hypot(x - position[0], y - position[1]))
+        return x[nearest], y[nearest]
+
+    def ResetTracking(self):
+        # called with the lock held, once the thread is running
+        self.tracking_generation += 1
+        self.track = (0, 0)
+        self.lost = 0
+        self.ref_flux = None
+        self.last_position = None
+        self.controller.Reset()
+        if self.periodic is not None:
+            # the uncorrected track starts again from here
+            self.periodic.NewSegment()
+
+    def AddPeriodic(self, t, offset):
+        # where the star would have been along RA, refitting now and then,
+        # from the corrections made (see Acknowledged and FeedForwardDone)
+        uncorrected = (np.asarray(offset) + self.controller.applied +
+                       self.feed_forward_applied * self.ra_direction)
+        self.periodic.Add(t, uncorrected.dot(self.ra_direction))
+        if clock() - self.last_fit > self.refit_period and not self.fitting:
+            # fitting a night's data takes a while, so is done on its own
+            # thread, from a snapshot, rather than holding up the frames
+            self.last_fit = clock()
+            self.fitting = True
+            thread = threading.Thread(target=self.FitPeriodic,
+                                      args=self.periodic.Snapshot(),
+                                      name='periodic fit')
+            thread.daemon = True
+            thread.start()
+
+    def FitPeriodic(self, t, y, segments):
+        try:
+            fit = self.periodic.Solve(t, y, segments)
+        except Exception as detail:
+            fit = None
+            self.Log('Periodic error fit failed: {}'.format(detail))
+        with self.lock:
+            self.fitting = False
+            usable = self.periodic.Apply(fit)
+            description = self.periodic.Describe()
+        if usable:
+            self.Log('Periodic error: {}'.format(description))
+
+    def ResetFeedForward(self):
+        self.feed_forward_applied = 0.0
+        self.feed_forward_start = None
+        # steps from before a reset are no longer counted
+        self.feed_forward_generation += 1
+
+    def ScheduleFeedForward(self):
+        def tick():
+            if not self.stopevent.is_set():
+                self.FeedForward()
+                self.ScheduleFeedForward()
+        scheduler.CallLater(self.feed_forward_period, tick)
+
+    def FeedForward(self):
+        # correct the change in periodic error since feed-forward started,
+        # as predicted for when the correction will be made
+        with self.lock:
+            corrections = self.corrections
+            if (corrections is None or self.paused or
+                self.feed_forward not in ('ao', 'mount') or
+                not self.periodic.Ready()):
+                return
+            t = clock() + self.ao_latency
+            if self.feed_forward_start is None:
+                self.feed_forward_start = t
+            target = (self.periodic.Predict(t) -
+                      self.periodic.Predict(self.feed_forward_start))
+            step = target - self.feed_forward_applied
+            if abs(step) < self.min_feed_forward:
+                return
+            self.feed_forward_applied = target
+            generation = self.feed_forward_generation
+        dx, dy = step * self.ra_direction
+        command = 'G' if self.feed_forward == 'ao' else 'M'
+        # no deadline, so it is never replaced, though it may still fail
+        op = AOStep(corrections, command, dx, dy)
+        op.AddDoneCallback(lambda op: self.FeedForwardDone(op, step,
+                                                           generation))
+
+    def FeedForwardDone(self, op, step, generation):
+        # a step not made is no longer counted as applied
+        if op.cancelled or op.exception is not None or not op.result:
+            with self.lock:
+                if generation == self.feed_forward_generation:
+                    self.feed_forward_applied -= step
+
+    def SetRADirection(self, direction):
+        # direction of RA on the guide camera, e.g. from the mount
+        # calibration
+        direction = np.asarray(direction, dtype=np.float64)
+        with self.lock:
+            self.ra_direction = direction / np.hypot(*direction)
+
+    def DescribePeriodicError(self):
+        with self.lock:
+            if self.periodic is None:
+                return 'not learning periodic error'
+            return self.periodic.Describe()
+
+    def GetExtraBoxes(self, frame, box):
+        # further guide stars, chosen once for each guide box
+        if self.extra_boxes is None:
+            sources = RankSources(DetectSources(self.Calibrated(frame)),
+                                  self.box_size, self.min_snr)
+            far = np.hypot(sources.x - box[0], sources.y - box[1])
+            far = far > self.box_size
+            extra = np.flatnonzero(far & (sources.score > 0))
+            extra = extra[:self.nstars - 1]
+            self.extra_boxes = [(int(round(sources.x[i])),
+                                 int(round(sources.y[i]))) for i in extra]
+            self.Log('Guiding on {:d} stars'.format(len(self.extra_boxes) + 1))
+        return self.extra_boxes
+
+    def FindStar(self, frame):
+        t0 = clock()
+        star = SelectGuideStar(self.Calibrated(frame), self.box_size,
+                               min_snr=self.min_snr)
+        if star is None:
+            if not self.search_failed:
+                self.Log('No suitable guide star found')
+            self.search_failed = True
+            return None
+        self.search_failed = False
+        box = (int(round(star.x)), int(round(star.y)))
+        with self.lock:
+            self.ResetBox(*box)
+            # the frame is measured in this box
+            self.frame_generation = self.tracking_generation
+        self.Log('Selected guide star at ({:d},{:d}), SNR {:.1f}, '
+                 'in {:.0f} ms'.format(box[0], box[1], star.snr,
+                                       (clock() - t0) * 1000))
+        return box
+
+    def RequestSearch(self):
+        # search the next frame for the best guide star
+        with self.lock:
+            self.search = True
+
+    def SetBox(self, x, y):
+        with self.lock:
+            self.ResetBox(x, y)
+
+    def ResetBox(self, x, y):
+        # called with the lock held
+        self.box_position = (x, y)
+        self.centroid = None
+        self.star = None
+        self.extra_boxes = None
+        self.ResetTracking()
+
+    def GetBox(self):
+        with self.lock:
+            return self.box_position
+
+    def GetBoxes(self):
+        # all the guide boxes, the main one first
+        with self.lock:
+            if self.box_position is None:
+                return []
+            return [self.box_position] + list(self.extra_boxes or [])
+
+    def GetRotation(self):
+        with self.lock:
+            return self.rotation
+
+    def GetCentroid(self):
+        with self.lock:
+            return self.centroid
+
+    def GetStar(self):
+        with self.lock:
+            return self.star
+
+    def StartGuiding(self, corrections):
+        with self.lock:
+            self.corrections = corrections
+            self.controller.Reset()
+            self.ResetFeedForward()
+            if self.periodic is not None:
+                self.periodic.NewSegment()
+
+    def SetController(self, controller):
+        with self.lock:
+            self.controller = controller
+
+    def DescribeController(self):
+        with self.lock:
+            return self.controller.Describe()
+
+    def StopGuiding(self):
+        with self.lock:
+            self.corrections = None
+
+    def Stop(self):
+        self.stopevent.set()
+
+    def Log(self, text):
+        logs.Post(text, SourceOf(self.parent))
+
+def CombineOffsets(positions, stars, min_snr=10.0, clip=3.0, rotation=False,
+                   floor=0.05):
+    # Combine the offsets of several stars (see centroid.Centroids) into
+    # one, weighting by the inverse variance of each star's position.
+    # Stars which are faint, saturated or too far from the median offset,
+    # in units of the robust scatter (at least floor pixels), are rejected.
+    # With rotation, also fit a small rotation about the weighted centre
+    # of the stars, in radians, which is allowed for in the rejection.
+    # Returns dx, dy, rotation (or None) and the mask of stars used.
+    dx, dy = stars.dx, stars.dy
+    variance = stars.dx_err**2 + stars.dy_err**2
+    valid = ((stars.snr >= min_snr) & ~stars.saturated &
+             np.isfinite(variance) & (variance > 0))
+    if not valid.any():
+        return 0.0, 0.0, None, valid
+    w = 1 / np.where(valid, variance, 1.0)
+    used = valid
+    for i in range(5):
+        # the first pass is translation only, since an outlier would
+        # distort the rotation
+        tx, ty, theta, centre = FitOffset(positions, dx, dy,
+                                          np.where(used, w, 0.0),
+                                          rotation and i > 0)
+        ex, ey = dx - tx, dy - ty
+        if theta is not None:
+            rx, ry = (positions - centre).T
+            ex, ey = ex + theta * ry, ey - theta * rx
+        ex -= np.median(ex[used])
+        ey -= np.median(ey[used])
+        r = np.hypot(ex, ey)
+        scale = max(1.4826 * np.median(r[used]), floor)
+        new = valid & (r <= clip * scale)
+        if not new.any() or (i > 0 and np.all(new == used)):
+            break
+        used = new
+    tx, ty, theta, centre = FitOffset(positions, dx, dy,
+                                      np.where(used, w, 0.0), rotation)
+    return tx, ty, theta, used
+
+def FitOffset(positions, dx, dy, w, rotation=False):
+    # weighted mean offset and, given at least three stars, the rotation
+    # about their weighted centre
+    tx = np.sum(w * dx) / w.sum()
+    ty = np.sum(w * dy) / w.sum()
+    centre = np.sum(w[:, None] * positions, axis=0) / w.sum()
+    if not rotation or np.count_nonzero(w) < 3:
+        return tx, ty, None, centre
+    rx, ry = (positions - centre).T
+    theta = (np.sum(w * (rx * (dy - ty) - ry * (dx - tx))) /
+             np.sum(w * (rx**2 + ry**2)))
+    return tx, ty, theta, centre
@@ -8,14 +8,16 @@ from __future__ import print_function
 # simulate obtaining images for testing
 simulate = False
 
+import os
 import numpy as np
 import scipy.stats
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from Queue import Queue
 
 import wx
 import threading
+import multiprocessing
 import serial
 if not simulate:
     try:
@@ -23,9 +25,23 @@ if not simulate:
     except ImportError:
         simulate = True
 
-from camera import TakeGuiderImageThread, EVT_IMAGEREADY_GUIDER
+import camera
+from camera import TakeGuiderImageThread
+from framebus import frames, KEEP_LATEST
+from centroid import Centroids
+from guideloop import GuideLoopThread
+from controller import MakeController
+from periodic import PeriodicErrorModel
+from telemetry import TelemetryRecorder
+from stats import StatsServer
+from display import DisplayRenderer
+from acquisition import TakeGuiderImageProcess
+from calibration import DarkLibrary, BuildDarkLibrary
 from ao import AOThread
-from logevent import EVT_LOG
+from aocalibration import (Calibrate, CalibrationError, VerifyCalibration,
+                           CalibrationCache, Describe)
+from orchestrator import Task
+from logservice import logs
 
 # ------------------------------------------------------------------------------
 # The main Guider frame
@@ -38,8 +54,6 @@ class Guider(wx.Frame):
         self.SetMinSize((400, 400))
         self.__DoLayout()
         self.Bind(wx.EVT_CLOSE, self.OnQuit)
-        self.Bind(EVT_LOG, self.panel.OnLog)
-        self.Bind(EVT_IMAGEREADY_GUIDER, self.panel.OnImageReady)
         if self.parent is None:
             self.Show(True)
 
@@ -54,6 +68,13 @@ class Guider(wx.Frame):
         # then just hide the frame, otherwise close it completely
         if self.parent is None:
             self.panel.stop_camera.set()
+            self.panel.guideloop.Stop()
+            self.panel.AO.Shutdown(self.panel.timeout)
+            if self.panel.recorder is not None:
+                self.panel.recorder.Close()
+            if self.panel.stats_server is not None:
+                self.panel.stats_server.Stop()
+            logs.Close()
             self.Destroy()
         else:
             self.parent.panel.ToggleGuider(e)
@@ -66,6 +87,8 @@ class Guider(wx.Frame):
 # ------------------------------------------------------------------------------
 # The main Guider panel
 class GuiderPanel(wx.Panel):
+    # where the threads it starts log to (see logservice.py)
+    log_source = 'guider'
 
     def __init__(self, *args, **kwargs):
         wx.Panel.__init__(self, *args, **kwargs)
@@ -73,10 +96,67 @@ class GuiderPanel(wx.Panel):
         # config start
         self.comport = 3
         self.timeout = 10  # seconds
+        # use the SX AO emulator on a pseudo-terminal instead of the AO
+        # unit, moving the simulated camera's stars (see aoemulator.py)
+        self.ao_emulator = False
+        # guider dark library (see calibration.py)
         self.dark = None
+        self.dark_file = 'guider_darks.npz'
+        self.dark_exptimes = (0.1, 0.5, 1.0, 2.0, 5.0)  # seconds
+        self.dark_frames = 5
+        # AO and mount calibration moves, as a fraction of the guide box,
+        # and limits on the probe and pattern sizes, in steps
+        self.calibration_move = 0.3
+        self.ao_probe_steps = 5
+        self.ao_max_steps = 100
+        self.mount_probe_steps = 5
+        self.mount_max_steps = 200
+        # calibrations are saved for each AO port, guide camera and
+        # optical configuration, so change optics when changing the
+        # guide telescope, reducer, etc.
+        self.optics = 'default'
+        self.calibration_file = 'ao_calibration.json'
         self.default_exptime = 1.0  # seconds
         self.guide_box_size = 25  # pixels
         self.min_guide_correction = 0.1  # pixels
+        # 'proportional' (the original), 'pi', 'hysteresis' or 'kalman',
+        # optionally tuning its gains from the guiding so far
+        # (see controller.py).  'pi' and 'kalman' send the change in
+        # correction, which is lost when the AO thread drops a superseded
+        # correction, so are not the default until it adds them up.
+        self.guide_controller = 'proportional'
+        self.auto_tune_gains = False
+        # learn the mount's periodic error while guiding, with the worm
+        # period in seconds if known, and correct it ahead of time through
+        # 'ao' or 'mount', or None to only learn it (see periodic.py)
+        self.learn_periodic_error = True
+        self.worm_period = None
+        self.feed_forward = 'ao'
+        # 'windowed', 'moments', 'gaussian', 'moffat' or 'marginal'
+        # (see centroid.py)
+        self.centroid_method = 'windowed'
+        # choose a guide star automatically when there is none, and look
+        # for another if it is lost while not guiding (see detection.py)
+        self.auto_select_star = True
+        self.min_star_snr = 10.0
+        # number of stars to guide on, combined into one correction,
+        # and whether to estimate field rotation from them
+        self.guide_stars = 1
+        self.estimate_rotation = False
+        # record telemetry of each guide frame, in one file per night in
+        # telemetry_dir, instead of logging each correction (see
+        # telemetry.py)
+        self.telemetry = True
+        self.telemetry_dir = 'telemetry'
+        # warn when the time from a guide exposure ending to the AO unit
+        # making its correction is more than this fraction of the exposure
+        # time (see latency.py)
+        self.latency_alert_fraction = 0.5
+        # serve statistics as JSON on this port, or None (see stats.py)
+        self.stats_port = 8765
+        # run guide camera in a separate process (see acquisition.py)
+        self.acquisition_process = False
+        self.display_period = 0.2  # seconds
         # config end
         self.guiding_on = False
         # These positions are stored in numpy image pixel coordinates,
@@ -84,9 +164,18 @@ class GuiderPanel(wx.Panel):
         self.guide_box_position = None
         self.guide_centroid = None
         self.image = None
+        self.image_time = None
+        self.frame = None
         self.imagecount = None
         self.AOtrained = False
+        self.ao_calibration = None
+        self.mount_calibration = None
+        self.recorder = None
+        self.stats_server = None
+        self.latency_shown = 0
+        self.renderer = DisplayRenderer()
         self.InitPanel()
+        self.LoadCalibration()
         wx.CallLater(50, self.InitAO)
         wx.CallLater(100, self.InitCamera)
 
@@ -132,6 +221,19 @@ class GuiderPanel(wx.Panel):
         subbox1.Add(self.ExpTimeCtrl, flag=wx.ALIGN_CENTER_VERTICAL)
         subbox1.Add(wx.StaticText(panel, label='sec'),
                        flag=wx.ALIGN_CENTER_VERTICAL|wx.LEFT, border=5)
+        subbox1.Add((20, 10))
+        self.FindStarButton = wx.Button(panel, label='Find Star')
+        self.FindStarButton.Bind(wx.EVT_BUTTON, self.FindStar)
+        self.FindStarButton.SetToolTip(wx.ToolTip(
+            'Automatically choose the best guide star'))
+        subbox1.Add(self.FindStarButton, flag=wx.ALIGN_CENTER_VERTICAL|wx.ALL,
+                border=10)
+        self.TakeDarksButton = wx.Button(panel, label='Take Darks')
+        self.TakeDarksButton.Bind(wx.EVT_BUTTON, self.TakeDarks)
+        self.TakeDarksButton.SetToolTip(wx.ToolTip(
+            'Build guider dark library (cover the guide telescope first)'))
+        subbox1.Add(self.TakeDarksButton, flag=wx.ALIGN_CENTER_VERTICAL|wx.ALL,
+                border=10)
         box.Add(subbox1, 0, flag=wx.EXPAND)
 
     def InitGuidingButtons(self, panel, box):
@@ -180,9 +282,17 @@ class GuiderPanel(wx.Panel):
         subbox2.Add(grid, 0, flag=wx.EXPAND)
         subbox2.AddStretchSpacer()
         box.Add(subbox2, 0, flag=wx.EXPAND|wx.RIGHT, border=10)
+        subbox3 = wx.BoxSizer(wx.VERTICAL)
         self.logger = wx.TextCtrl(panel, size=(300,90),
                         style=wx.TE_MULTILINE|wx.TE_READONLY)
-        box.Add(self.logger, 1, flag=wx.ALIGN_CENTER_VERTICAL|wx.EXPAND)
+        subbox3.Add(self.logger, 1, flag=wx.EXPAND)
+        logs.AddView(self.logger, ['guider'])
+        self.LatencyText = wx.StaticText(panel, label='Latency:')
+        self.LatencyText.SetToolTip(wx.ToolTip(
+            'Time from guide exposure end to AO correction, median, 90% and '
+            'histogram, and median of each step on the way'))
+        subbox3.Add(self.LatencyText, 0, flag=wx.EXPAND|wx.TOP, border=5)
+        box.Add(subbox3, 1, flag=wx.ALIGN_CENTER_VERTICAL|wx.EXPAND)
 
     def ToggleCamera(self, e):
         if self.camera_on.is_set():
@@ -201,12 +311,10 @@ class GuiderPanel(wx.Panel):
     def ToggleGuiding(self, e):
         if self.guiding_on:
             self.StopGuiding()
-            self.guiding_on = False
             self.ToggleGuidingButton.SetLabel('Start Guiding')
             self.ToggleCameraButton.Enable()
         else:
             self.StartGuiding()
-            self.guiding_on = True
             self.ToggleGuidingButton.SetLabel('Stop Guiding')
             self.ToggleCameraButton.Disable()
 
@@ -220,26 +328,137 @@ class GuiderPanel(wx.Panel):
 
     def InitCamera(self):
         exptime = self.GetExpTime()
-        self.stop_camera = threading.Event()
-        self.camera_on = threading.Event()
-        self.ImageTaker = TakeGuiderImageThread(self, self.stop_camera,
-                                                self.camera_on, exptime)
+        # Guiding is done by the guide loop thread, as soon as each frame
+        # arrives. The display only takes the newest frame at its own rate.
+        periodic = None
+        if self.learn_periodic_error:
+            periodic = PeriodicErrorModel(self.worm_period)
+        self.guideloop = GuideLoopThread(self, self.guide_box_size,
+                                         self.min_guide_correction,
+                                         self.centroid_method,
+                                         self.auto_select_star,
+                                         self.min_star_snr,
+                                         self.guide_stars,
+                                         self.estimate_rotation,
+                                         MakeController(
+                                             self.guide_controller,
+                                             self.min_guide_correction,
+                                             auto=self.auto_tune_gains),
+                                         periodic, self.feed_forward)
+        self.guideloop.latency.alert_fraction = self.latency_alert_fraction
+        if self.telemetry:
+            self.InitTelemetry()
+        if self.stats_port is not None:
+            self.InitStats()
+        self.frames = frames.Subscribe('guider', policy=KEEP_LATEST)
+        self.DisplayTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnDisplayTimer, self.DisplayTimer)
+        self.DisplayTimer.Start(int(self.display_period * 1000))
+        if self.acquisition_process:
+            self.stop_camera = multiprocessing.Event()
+            self.camera_on = multiprocessing.Event()
+            self.ImageTaker = TakeGuiderImageProcess(self, self.stop_camera,
+                                                     self.camera_on, exptime)
+        else:
+            self.stop_camera = threading.Event()
+            self.camera_on = threading.Event()
+            self.ImageTaker = TakeGuiderImageThread(self, self.stop_camera,
+                                                    self.camera_on, exptime)
+        if os.path.exists(self.dark_file):
+            self.dark = DarkLibrary.Load(self.dark_file)
+            self.guideloop.SetCalibration(self.dark)
+            self.Log('Loaded guider darks for {} sec'.format(
+                ', '.join('{:g}'.format(t) for t in self.dark.Exptimes())))
         self.ToggleCameraButton.Enable()
 
-    def InitAO(self):
-        self.StartGuiding()
-        self.AOcorrections.put('K')
-        self.StopGuiding()
+    def InitTelemetry(self):
+        # the night is taken to start at noon
+        night = datetime.now() - timedelta(hours=12)
+        filename = os.path.join(self.telemetry_dir,
+                                'guiding_{:%Y%m%d}.tlm'.format(night))
+        try:
+            if not os.path.isdir(self.telemetry_dir):
+                os.makedirs(self.telemetry_dir)
+            self.recorder = TelemetryRecorder(filename)
+        except (EnvironmentError, ValueError) as detail:
+            self.Log('Unable to record telemetry: {}'.format(detail))
+            return
+        self.guideloop.SetTelemetry(self.recorder, self.AO.GetPosition)
+        self.AO.SetVerbose(False)
+        self.Log('Recording telemetry to {}'.format(filename))
+
+    def InitStats(self):
+        try:
+            self.stats_server = StatsServer(self.stats_port)
+        except EnvironmentError as detail:
+            self.Log('Unable to serve statistics: {}'.format(detail))
+            return
+        self.stats_server.Add('latency', self.guideloop.latency.GetStats)
+        self.stats_server.Add('ao', self.AO.GetStats)
+        self.stats_server.Add('frames', frames.GetStats)
+        self.stats_server.Start()
+        self.Log('Serving statistics on port {:d}'.format(self.stats_port))
+
+    def TakeDarks(self, e):
+        if not self.camera_on.is_set() or self.guiding_on:
+            self.Log('Start the camera, and stop guiding, to take darks')
+            return
+        self.Log('Taking guider darks - the guide telescope must be covered')
+        self.TakeDarksButton.Disable()
+        self.TrainGuidingButton.Disable()
+        self.ToggleGuidingButton.Disable()
+        self.ToggleCameraButton.Disable()
+        log = self.Log
+        op = BuildDarkLibrary(self.ImageTaker, self.dark_exptimes,
+                              self.dark_frames, log)
+        op.AddDoneCallback(lambda op: wx.CallAfter(self.DarksTaken, op))
 
-    def StartGuiding(self):
+    def DarksTaken(self, op):
+        self.TakeDarksButton.Enable()
+        self.ToggleCameraButton.Enable()
+        if self.guide_box_position is not None:
+            self.EnableGuideButtons()
+        try:
+            self.dark = op.Result()
+        except Exception as detail:
+            self.Log('Unable to take darks: {}'.format(detail))
+            return
+        self.dark.Save(self.dark_file)
+        self.guideloop.SetCalibration(self.dark)
+
+    def InitAO(self):
+        # one AO service for the whole session (see ao.py), so the
+        # serial port is only opened once
+        comport = self.comport
+        if self.ao_emulator:
+            # needs pseudo-terminals, so not available on Windows
+            from aoemulator import SXVAOEmulator
+            self.emulator = SXVAOEmulator()
+            self.emulator.start()
+            comport = self.emulator.Port()
+            camera.simulate_offset = self.emulator.Offset
+            self.Log('Emulating AO unit on {}'.format(comport))
         self.AOcorrections = Queue()
         self.AO = AOThread(self, self.AOcorrections,
-                           self.comport, self.timeout)
+                           comport, self.timeout)
         self.AO.start()
+        self.AOcorrections.put('K')
+
+    def StartGuiding(self):
+        self.AO.SetMode('guiding')
+        self.guideloop.StartGuiding(self.AOcorrections)
+        self.guiding_on = True
 
     def StopGuiding(self):
+        self.guideloop.StopGuiding()
+        self.AO.SetMode('idle')
         self.guiding_on = False
-        self.AOcorrections.put('Q')
+        if self.recorder is not None:
+            self.recorder.Flush()
+        self.Log('Guide controller: {}'.format(
+            self.guideloop.DescribeController()))
+        self.Log('Periodic error: {}'.format(
+            self.guideloop.DescribePeriodicError()))
 
     def MoveAOLeft(self, e):
         self.AOcorrections.put(('G', -50.0, 0.0))
@@ -254,96 +473,106 @@ class GuiderPanel(wx.Panel):
         self.AOcorrections.put(('G', 0.0, 50.0))
 
     def TrainGuiding(self, e):
+        # calibration runs in the background (see aocalibration.py),
+        # with the guide loop paused so it does not chase the star
         self.ToggleCameraButton.Disable()
-        self.StartGuiding()
+        self.TrainGuidingButton.Disable()
+        self.ToggleGuidingButton.Disable()
+        self.AO.SetMode('training')
+        self.guideloop.Pause()
         self.Log('Training AO')
-        # Train AO unit
-        # NEED TO WATCH OUT FOR CASE WHERE WE LOSE GUIDE STAR!
-        # COMMENTED OUT ADJUST_STEPS FOR NOW!
-        for delta in [0.3, 0.6]:
-            dpix = self.guide_box_size * delta
-            movebox = delta>0.5
-            # check x versus y and get step factor
-            dx, dy = self.AObracket(0, dpix, movebox)
-            if abs(dx) < abs(dy):
-                self.AO.toggle_switch_xy()
-                dx, dy = dy, dx
-            factor = abs(dx) / dpix
-            #self.AO.adjust_steps_per_pixel(factor)
-            # check x and y directions
-            dx, dy = self.AObracket(dpix, dpix, movebox)
-            if dx < 0:
-                self.AO.toggle_reverse_x()
-            if dy < 0:
-                self.AO.toggle_reverse_y()
-        # Train AO mount
-        for delta in [0.3, 0.6]:
-            dpix = self.guide_box_size * delta
-            movebox = delta>0.5
-            # check x versus y and get step factor
-            dx, dy = self.AObracket(0, dpix, movebox, mount=True)
-            if abs(dx) < abs(dy):
-                self.AO.toggle_mount_switch_xy()
-                dx, dy = dy, dx
-            factor = abs(dx) / dpix
-            #self.AO.adjust_mount_steps_per_pixel(factor)
-            # check x and y direction
-            dx, dy = self.AObracket(0, dpix, movebox, mount=True)
-            if dx < 0:
-                self.AO.toggle_mount_reverse_x()
-            if dy < 0:
-                self.AO.toggle_mount_reverse_y()
+        op = Task(self.TrainingSteps(), name='train guiding')
+        op.AddDoneCallback(lambda op: wx.CallAfter(self.TrainingDone, op))
+
+    def TrainingSteps(self):
+        log = self.Log
+        start = self.GetGuideBox()
+        target = self.guide_box_size * self.calibration_move
+        if self.ao_calibration is not None and not self.AOtrained:
+            # saved calibration, which only needs checking
+            try:
+                yield VerifyCalibration(self.AOcorrections, 'GS',
+                                        self.ao_calibration,
+                                        self.MeasureStarAt, start, target,
+                                        log=log)
+                yield VerifyCalibration(self.AOcorrections, 'MS',
+                                        self.mount_calibration,
+                                        self.MeasureStarAt, start, target,
+                                        log=log)
+            except CalibrationError as detail:
+                log('Saved AO calibration failed check: {}'.format(detail))
+                log('Retraining AO')
+            else:
+                yield self.ao_calibration, self.mount_calibration, False
+                return
+        ao = yield Calibrate(self.AOcorrections, 'GS', self.MeasureStarAt,
+                             start, target, self.ao_probe_steps,
+                             self.ao_max_steps, log=log)
+        mount = yield Calibrate(self.AOcorrections, 'MS', self.MeasureStarAt,
+                                start, target, self.mount_probe_steps,
+                                self.mount_max_steps, log=log)
+        yield ao, mount, True
+
+    def TrainingDone(self, op):
+        self.guideloop.Pause(False)
+        self.AO.SetMode('idle')
+        self.ToggleCameraButton.Enable()
+        self.TrainGuidingButton.Enable()
+        try:
+            ao, mount, trained = op.Result()
+        except Exception as detail:
+            self.Log('AO training failed: {}'.format(detail))
+            # carry on with the calibration from before, if there was one
+            if self.AOtrained:
+                self.AO.SetCalibration(self.ao_calibration.matrix,
+                                       self.mount_calibration.matrix)
+                self.ToggleGuidingButton.Enable()
+            else:
+                self.ToggleGuidingButton.Disable()
+            return
+        self.ao_calibration, self.mount_calibration = ao, mount
+        # the mount's RA axis, as seen on the guide camera
+        self.guideloop.SetRADirection(mount.pixels_per_step[:, 0])
+        if trained:
+            self.calibration_cache.Put(self.CalibrationKey(), ao, mount)
+        self.AO.SetCalibration(ao.matrix, mount.matrix)
         self.AOtrained = True
         self.ToggleGuidingButton.Enable()
-        self.ToggleCameraButton.Enable()
         self.Log('AO training complete')
 
-    def AObracket(self, axis, dpix, movebox, mount=False):
-        if mount:
-            command = 'M'
-        else:
-            command = 'G'
-        self.AOcorrections.put((command, -dpix, 0.0))
-        if movebox:
-            # NEEDS TESTING
-            x = self.guide_box_position.x + dpix
-            y = self.guide_box_position.y
-            self.guide_box_position = wx.Point(x, y)
-        wx.Yield()
-        time.sleep(0.5)
-        self.WaitForNextImage()
-        dx1, dy1 = self.CentroidBox()
-        self.AOcorrections.put((command, 2.0*dpix, 0.0))
-        wx.Yield()
-        time.sleep(0.5)
-        self.WaitForNextImage()
-        dx2, dy2 = self.CentroidBox()
-        self.AOcorrections.put((command, -dpix, 0.0))
-        wx.Yield()
-        time.sleep(0.5)
-        return (dx2-dx1), (dy2-dy1)
-
-    def WaitForNextImage(self):
-        t = self.image_time
-        for i in range(100):  # max 10 sec
-            #wx.Yield()
-            if t != self.image_time or t is None:
-                break
-            time.sleep(0.1)
+    def CalibrationKey(self):
+        return self.calibration_cache.Key(self.comport,
+                                          TakeGuiderImageThread.camera_id,
+                                          self.optics)
+
+    def LoadCalibration(self):
+        self.calibration_cache = CalibrationCache(self.calibration_file)
+        try:
+            saved = self.calibration_cache.Get(self.CalibrationKey())
+        except (IOError, ValueError, KeyError) as detail:
+            self.Log('Unable to read saved AO calibration: {}'.format(detail))
+            return
+        if saved is None:
+            return
+        self.ao_calibration, self.mount_calibration, timestamp = saved
+        self.Log('Loaded AO calibration from {}'.format(timestamp))
+        self.Log('AO: {}'.format(Describe(self.ao_calibration)))
+        self.Log('Mount: {}'.format(Describe(self.mount_calibration)))
+        self.Log('Train Guiding will check it with a single move')
+
+    def MeasureStarAt(self, frame, position):
+        # position of the star near position, for calibration
+        box = [int(round(c)) for c in position]
+        stars = self.guideloop.MeasureBoxes(frame, [box])
+        star = Centroids._make(field[0] for field in stars)
+        problem = self.guideloop.CheckStar(star)
+        if problem is not None:
+            raise CalibrationError('lost star ({})'.format(problem))
+        return box[0] + star.dx, box[1] + star.dy
 
     def UpdateImageDisplay(self):
         wd, hd = self.ImageDisplay.Size
         wi, hi = self.image.shape
-        # scale image levels from 5th to 100th percentile
-        imin, imax = np.percentile(self.image, (5.0, 100.0))
-        # but do not exaggerate really low counts
-        imax = max(imax, imin+16)
-        image = ((self.image-imin)/(imax-imin) * 255).clip(0, 255)
-        # convert to RGB (but still greyscale)
-        image = image.T.astype('uint8')
-        image = np.dstack((image, image, image))
-        wxImg = wx.EmptyImage(wi, hi)
-        wxImg.SetData( image.tostring() )
         # resize the image to fill sizer, preserving the aspect ratio
         ad = float(hd)/wd
         ai = float(hi)/wi
@@ -353,7 +582,12 @@ class GuiderPanel(wx.Panel):
         else:
             wi_new = wd
             hi_new = wd * ai
-        wxImg = wxImg.Scale(wi_new, hi_new)
+        # binned, stretched and converted to RGB by the renderer
+        rgb = self.renderer.Render(self.image, (wi_new, hi_new))
+        hr, wr = rgb.shape[:2]
+        wxImg = wx.ImageFromBuffer(wr, hr, rgb)
+        if (wr, hr) != (int(wi_new), int(hi_new)):
+            wxImg = wxImg.Scale(wi_new, hi_new)
         bitmap = wxImg.ConvertToBitmap()
         # Add guider box
         if self.guide_box_position is not None:
@@ -365,6 +599,13 @@ class GuiderPanel(wx.Panel):
             dc.SetBrush(wx.TRANSPARENT_BRUSH)
             xc, yc, size = self.GetRectCorner(x, y, size)
             dc.DrawRectangle(xc, yc, size, size)
+            # other guide stars
+            dc.SetPen(wx.Pen(wx.Colour(0, 160, 0, 127), 1))
+            for bx, by in self.guideloop.GetBoxes()[1:]:
+                bx = wd * bx / float(wi) + 1
+                by = hd * by / float(hi) + 1
+                xc, yc, bsize = self.GetRectCorner(bx, by, size)
+                dc.DrawRectangle(xc, yc, bsize, bsize)
             if self.guide_centroid is not None:
                 x = wd * self.guide_centroid.x / wi + 1.5
                 y = hd * self.guide_centroid.y / hi + 1.5
@@ -394,52 +635,64 @@ class GuiderPanel(wx.Panel):
                 self.guide_box_position.x += int(round(dx))
                 self.guide_box_position.y += int(round(dy))
                 self.CentroidBox()
-            if self.camera_on.is_set():
-                self.TrainGuidingButton.Enable()
-                if self.AOtrained:
-                    self.ToggleGuidingButton.Enable()
+            self.SetGuideBox(self.guide_box_position)
+            self.EnableGuideButtons()
             self.Log('Guide box centred at ({:d},{:d})'.format(
                 self.guide_box_position.x, self.guide_box_position.y))
 
-    def OnImageReady(self, event):
-        self.image = event.image
-        self.image_time = event.image_time
-        if self.guiding_on:
-            self.Guide()
+    def FindStar(self, e):
+        self.guideloop.RequestSearch()
+
+    def OnDisplayTimer(self, event):
+        frame = self.frames.GetLatest(block=False)
+        if frame is None:
+            return
+        self.frame = frame
+        self.image = frame.image
+        self.image_time = frame.image_time
+        box = self.guideloop.GetBox()
+        if box is not None and box != self.GetGuideBox():
+            # guide star chosen by the guide loop
+            self.guide_box_position = wx.Point(*box)
+            self.EnableGuideButtons()
+        centroid = self.guideloop.GetCentroid()
+        if centroid is not None:
+            self.guide_centroid = wx.Point(*centroid)
         self.UpdateImageDisplay()
+        if time.time() - self.latency_shown > 1.0:
+            self.latency_shown = time.time()
+            self.LatencyText.SetLabel(self.guideloop.latency.Describe())
+
+    def SetGuideBox(self, position):
+        self.guide_box_position = position
+        self.guideloop.SetBox(position.x, position.y)
+
+    def GetGuideBox(self):
+        if self.guide_box_position is None:
+            return None
+        return (self.guide_box_position.x, self.guide_box_position.y)
 
-    def Guide(self):
-        dx, dy = self.CentroidBox()
-        dx = dx if (abs(dx) > self.min_guide_correction) else 0.0
-        dy = dy if (abs(dy) > self.min_guide_correction) else 0.0
-        self.AOcorrections.put(('G', dx, dy))
+    def EnableGuideButtons(self):
+        if self.camera_on.is_set():
+            self.TrainGuidingButton.Enable()
+            if self.AOtrained:
+                self.ToggleGuidingButton.Enable()
 
     def CentroidBox(self):
-        xc, yc, size = self.GetRectCorner(self.guide_box_position.x,
-                                          self.guide_box_position.y,
-                                          self.guide_box_size)
-        subimage = self.image[xc:xc+size,
-                              yc:yc+size]
-        dx, dy = self.Centroid(subimage)
-        self.Log('Centroid within guide box is ({:.2f},{:.2f})'.format(dx, dy))
+        # measured as by the guide loop, with any dark calibration
+        stars = self.guideloop.MeasureBoxes(self.frame, [self.GetGuideBox()])
+        star = Centroids._make(field[0] for field in stars)
+        dx, dy = star.dx, star.dy
+        self.Log('Centroid within guide box is ({:.2f},{:.2f}) '
+                 '+/- ({:.2f},{:.2f})'.format(dx, dy, star.dx_err, star.dy_err))
+        self.Log('Star SNR {:.1f}, FWHM {:.1f} pixels'.format(star.snr,
+                                                              star.fwhm))
         x = self.guide_box_position.x + dx
         y = self.guide_box_position.y + dy
         self.Log('Centroid within image is ({:.2f},{:.2f})'.format(x, y))
         self.guide_centroid = wx.Point(x, y)
         return dx, dy
 
-    def Centroid(self, image):
-        dx, dy = [self.Centroid1d(np.sum(image, axis)) for axis in (1, 0)]
-        return dx, dy
-
-    def Centroid1d(self, array):
-        n = len(array)
-        p = np.arange(n) - (n-1)/2.0
-        w = array - array.min()
-        w **= 2
-        c = np.average(p, weights=w)
-        return c
-
     def GetExpTime(self):
         try:
             exptime = float(self.ExpTimeCtrl.GetValue())
@@ -451,14 +704,17 @@ class GuiderPanel(wx.Panel):
         return exptime
 
     def Log(self, text):
-        self.logger.AppendText("{}\n".format(text))
-        wx.CallAfter(self.logger.Refresh)
-
-    def OnLog(self, event):
-        self.Log(event.text)
+        logs.Post(text, 'guider')
         
     def OnExit(self, event):
         self.stop_camera.set()
+        self.guideloop.Stop()
+        self.AO.Shutdown(self.timeout)
+        if self.recorder is not None:
+            self.recorder.Close()
+        if self.stats_server is not None:
+            self.stats_server.Stop()
+        self.DisplayTimer.Stop()
         time.sleep(1)
 
 
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# latency.py
+
+from __future__ import division
+
+import threading
+import numpy as np
+
+from timing import clock
+
+# Times (on the timing.clock scale) marked for each guide frame, in order,
+# from the exposure ending to the AO unit acknowledging the correction
+# worked out from it, and the hops between them:
+#   readout   exposure end to the frame being published on the frame bus
+#             (camera readout and polling, and passing the frame from the
+#             acquisition process, if used)
+#   bus       published to taken by the guide loop
+#   centroid  measuring the guide boxes
+#   control   guide controller, to the correction being queued
+#   wait      queued to being sent to the AO unit (the AO thread being
+#             busy, and the minimum time between steps)
+#   serial    sent to acknowledged by the AO unit
+marks = ('exposed', 'ready', 'taken', 'measured', 'queued', 'sent', 'acked')
+hops = ('readout', 'bus', 'centroid', 'control', 'wait', 'serial')
+
+# histogram bin edges, in seconds
+bins = np.logspace(-4, 1, 26)
+
+# ------------------------------------------------------------------------------
+# Rolling record of guide latency, over the last window frames, for each
+# hop and in total, as histograms (see bins) and percentiles.
+# Frames with no correction only have the first few hops, and their total
+# is not known.
+# An alert is logged when the total latency of a correction is more than
+# alert_fraction of the exposure time, at most once every alert_interval,
+# naming the slowest hop.
+class LatencyMonitor(object):
+    def __init__(self, window=500, alert_fraction=0.5, alert_interval=60.0,
+                 log=None):
+        self.window = window
+        self.alert_fraction = alert_fraction
+        self.alert_interval = alert_interval
+        self.log = log
+        self.lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self.lock:
+            # hops, then the total
+            self.values = np.full((self.window, len(hops) + 1), np.nan)
+            self.count = 0
+            self.alerts = 0
+            self.last_alert = None
+
+    def Add(self, times, exptime=None):
+        # times is a dict of the marks known for a frame
+        t = np.array([times.get(mark, np.nan) for mark in marks],
+                     dtype=np.float64)
+        row = np.append(np.diff(t), t[-1] - t[0])
+        with self.lock:
+            self.values[self.count % self.window] = row
+            self.count += 1
+        if exptime and row[-1] > self.alert_fraction * exptime:
+            self.Alert(row, exptime)
+
+    def Alert(self, row, exptime):
+        with self.lock:
+            self.alerts += 1
+            now = clock()
+            if (self.last_alert is not None and
+                now - self.last_alert < self.alert_interval):
+                return
+            self.last_alert = now
+        if self.log is not None:
+            slowest = np.argmax(np.where(np.isfinite(row[:-1]), row[:-1],
+                                         -1))
+            self.log('Guide latency {:.0f} ms is over {:.0f}% of the {:g} '
+                     'sec exposure, mostly {} ({:.0f} ms)'.format(
+                         row[-1] * 1000, self.alert_fraction * 100, exptime,
+                         hops[slowest], row[slowest] * 1000))
+
+    def Values(self):
+        with self.lock:
+            n = min(self.count, self.window)
+            return self.values[:n].copy()
+
+    def Histogram(self, hop='total'):
+        # counts in each of bins, over the window
+        values = self.Values()[:, self.Column(hop)]
+        return np.histogram(values[np.isfinite(values)], bins)[0]
+
+    def Column(self, hop):
+        return len(hops) if hop == 'total' else hops.index(hop)
+
+    def Percentiles(self, hop='total'):
+        # (median, 90%, max) in seconds, or None
+        values = self.Values()[:, self.Column(hop)]
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return None
+        return (np.median(values), np.percentile(values, 90), values.max())
+
+    def GetStats(self):
+        # for the stats server (see stats.py), in seconds
+        stats = {'frames': self.count, 'alerts': self.alerts,
+                 'alert_fraction': self.alert_fraction,
+                 'bins': bins.tolist(), 'hops': {}}
+        for hop in hops + ('total',):
+            p = self.Percentiles(hop)
+            stats['hops'][hop] = {
+                'median': None if p is None else float(p[0]),
+                'p90': None if p is None else float(p[1]),
+                'max': None if p is None else float(p[2]),
+                'histogram': self.Histogram(hop).tolist()}
+        return stats
+
+    def Describe(self):
+        total = self.Percentiles('total')
+        if total is None:
+            text = 'Latency: no corrections yet'
+        else:
+            text = u'Latency {:.0f} ms, 90% {:.0f} ms {}'.format(
+                total[0] * 1000, total[1] * 1000, Sparkline(self.Histogram()))
+        medians = []
+        for hop in hops:
+            p = self.Percentiles(hop)
+            if p is not None:
+                medians.append('{} {:.1f}'.format(hop, p[0] * 1000))
+        if medians:
+            text += '\n' + ', '.join(medians) + ' ms'
+        return text
+
+def Sparkline(counts):
+    # histogram as a line of block characters, from the first to the last
+    # bin with anything in it
+    blocks = u' ▁▂▃▄▅▆▇█'
+    used = np.flatnonzero(counts)
+    if len(used) == 0:
+        return u''
+    counts = counts[used[0]:used[-1] + 1]
+    levels = np.ceil(counts * (len(blocks) - 1) / counts.max()).astype(int)
+    return u''.join(blocks[level] for level in levels)
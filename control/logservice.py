@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# logservice.py
+
+import io
+import wx
+import threading
+from datetime import datetime
+from collections import deque, namedtuple
+
+# A log message, with the UTC time it was posted, where it came from
+# ('control', 'guider', ...) and its level ('info', 'error', ...).
+LogRecord = namedtuple('LogRecord', ['time', 'source', 'level', 'text'])
+
+# ------------------------------------------------------------------------------
+# Logging for the whole session, shared by every thread.
+# Post only appends the record to a deque, which needs no lock, so it
+# never waits for the GUI or the disk.  A background thread takes the
+# records every period seconds, collapses repeats of the same message from
+# the same source, passes them on to the text controls showing each
+# source (see AddView) and writes them to the log file (see Open), keeping
+# any it could not write to try again with the next batch.  A wx timer
+# then appends each text control's new lines in one go, keeping at most
+# scrollback lines in it.
+# Repeats are counted until a different message comes from that source,
+# or repeat_period passes, and then reported in one line.
+# The log file has one record per line, with tab-separated fields:
+#   UTC time (ISO 8601), source, level, repeats, text
+# where repeats is 0, or for a line reporting repeats, how many more times
+# the message was posted, and newlines and tabs in the text are escaped.
+class LogService(object):
+    def __init__(self, period=0.2, scrollback=2000, repeat_period=10.0):
+        self.period = period
+        self.scrollback = scrollback
+        self.repeat_period = repeat_period
+        self.records = deque()
+        self.lock = threading.Lock()
+        self.views = []
+        self.file = None
+        self.repeats = {}
+        # lines still to be written to the log file, kept when writing
+        # fails, to try again with the next batch
+        self.unwritten = deque(maxlen=10000)
+        self.failing = False
+        self.thread = None
+        self.timer = None
+        self.stopevent = threading.Event()
+
+    def Post(self, text, source='control', level='info'):
+        self.records.append(LogRecord(datetime.utcnow(), source, level,
+                                      text))
+        if self.thread is None:
+            self.Start()
+
+    def Start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.Run, name='log')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def Open(self, filename):
+        # log file, appended to through a buffer written out each period
+        f = io.open(filename, 'a', 65536, encoding='utf-8')
+        with self.lock:
+            old, self.file = self.file, f
+        if old is not None:
+            old.close()
+
+    def AddView(self, textctrl, sources):
+        # show records from the given sources in a wx.TextCtrl, which must
+        # be called on the wx main thread
+        view = LogView(textctrl, sources, self.scrollback)
+        with self.lock:
+            self.views.append(view)
+        if self.timer is None:
+            self.timer = wx.Timer()
+            self.timer.Bind(wx.EVT_TIMER, self.OnTimer)
+            self.timer.Start(int(self.period * 1000))
+        return view
+
+    def RemoveView(self, view):
+        with self.lock:
+            if view in self.views:
+                self.views.remove(view)
+
+    def Close(self):
+        # write out everything posted so far and close the log file
+        self.stopevent.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+        if self.timer is not None:
+            self.timer.Stop()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def Run(self):
+        while True:
+            stopping = self.stopevent.wait(self.period)
+            try:
+                self.WriteBatch()
+                self.failing = False
+            except Exception as detail:
+                # not worth stopping the log for, and shown with the next
+                # batch, once until writing works again
+                if not self.failing:
+                    self.failing = True
+                    self.Post('Logging error: {}'.format(detail), 'control',
+                              'error')
+            if stopping:
+                break
+
+    def WriteBatch(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.records.popleft())
+            except IndexError:
+                break
+        out = []
+        for record in batch:
+            repeat = self.repeats.get(record.source)
+            if repeat is not None and repeat[0].text == record.text:
+                repeat[1] += 1
+                continue
+            self.ReportRepeats(record.source, out)
+            self.repeats[record.source] = [record, 0]
+            out.append((record, 0))
+        now = datetime.utcnow()
+        for source, (record, count) in list(self.repeats.items()):
+            if (count and (now - record.time).total_seconds() >
+                self.repeat_period):
+                self.ReportRepeats(source, out)
+                # count again from now
+                self.repeats[source] = [record._replace(time=now), 0]
+        with self.lock:
+            views = list(self.views)
+        if out:
+            # shown even if the log file cannot be written
+            for view in views:
+                view.Add(out)
+        with self.lock:
+            f = self.file
+            if f is None:
+                return
+            for record, repeats in out:
+                self.unwritten.append(u'{}\t{}\t{}\t{:d}\t{}\n'.format(
+                    record.time.isoformat(), record.source, record.level,
+                    repeats, Escape(Text(record.text))))
+            if not self.unwritten:
+                return
+            f.write(u''.join(self.unwritten))
+            f.flush()
+            self.unwritten.clear()
+
+    def ReportRepeats(self, source, out):
+        repeat = self.repeats.pop(source, None)
+        if repeat is not None and repeat[1] > 0:
+            record, count = repeat
+            out.append((record._replace(time=datetime.utcnow()), count))
+
+    def OnTimer(self, event):
+        with self.lock:
+            views = list(self.views)
+        for view in views:
+            if not view.textctrl:
+                # window destroyed
+                self.RemoveView(view)
+            else:
+                view.Show()
+
+def SourceOf(parent):
+    # the source to log as for a thread started by a window, so its
+    # messages are shown in that window
+    return getattr(parent, 'log_source', 'control')
+
+def Text(text):
+    # as unicode, whatever was posted
+    if isinstance(text, bytes):
+        return text.decode('utf-8', 'replace')
+    return u'{}'.format(text)
+
+def Escape(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n').replace('\t', '\\t')
+
+# ------------------------------------------------------------------------------
+# A wx.TextCtrl showing the records from some sources (see
+# LogService.AddView).  Lines waiting to be shown are held in a bounded
+# deque, so a flood of messages while the GUI is busy only keeps the last
+# scrollback of them.  While some text is selected in the control, it is
+# kept selected as lines are added.
+class LogView(object):
+    def __init__(self, textctrl, sources, scrollback):
+        self.textctrl = textctrl
+        self.sources = set(sources)
+        self.scrollback = scrollback
+        self.pending = deque(maxlen=scrollback)
+        self.skipped = 0
+
+    def Add(self, out):
+        # called on the log thread
+        for record, repeats in out:
+            if record.source not in self.sources:
+                continue
+            text = Text(record.text)
+            if repeats:
+                text = u'{} ({:d} more times)'.format(text, repeats)
+            if len(self.pending) == self.scrollback:
+                self.skipped += 1
+            self.pending.append(u'{:%H:%M:%S} UT : {}\n'.format(record.time,
+                                                               text))
+
+    def Show(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self.pending.popleft())
+            except IndexError:
+                break
+        if not lines:
+            return
+        if self.skipped:
+            lines.insert(0, '({:d} lines not shown, see the log '
+                         'file)\n'.format(self.skipped))
+            self.skipped = 0
+        logger = self.textctrl
+        start, end = logger.GetSelection()
+        holding = end > start
+        if holding:
+            caret = logger.GetInsertionPoint()
+            logger.Freeze()
+        logger.AppendText(u''.join(lines))
+        if holding:
+            logger.SetInsertionPoint(caret)
+            logger.SetSelection(start, end)
+            logger.Thaw()
+        else:
+            # trim now and then, rather than for every batch
+            n = logger.GetNumberOfLines()
+            if n > self.scrollback * 1.1:
+                logger.Remove(0, logger.XYToPosition(0, n - self.scrollback))
+
+# Shared by all windows and threads in this process
+logs = LogService()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+# orchestrator.py
+
+# Device orchestration core.
+# Device actions (expose, slew, pulse guide, AO step, solve) are started as
+# Operations, which complete later with a result or an exception, and can be
+# cancelled, given timeouts and combined.  Blocking driver calls run on a
+# DeviceWorker thread owned by the device, and waiting (for settling,
+# polling a driver flag, or a timeout) is done by a single Scheduler
+# thread, so no thread sits in a time.sleep loop.
+# Python 2 has no asyncio, so sequences of operations are written as
+# generators which yield Operations, in the same style as the ControlPanel
+# workers, and run with Task.
+
+import threading
+import heapq
+import traceback
+from Queue import Queue
+
+from timing import clock
+
+try:
+    import pythoncom
+except ImportError:
+    pythoncom = None
+
+class OperationCancelled(Exception):
+    pass
+
+class OperationTimeout(Exception):
+    pass
+
+# ------------------------------------------------------------------------------
+# The result of an action which completes later.
+# Done callbacks are called with the Operation, on whichever thread
+# completes it.  Cancel hooks are called if it is cancelled or times out,
+# and should stop the underlying action (e.g. abort an exposure).
+class Operation(object):
+    def __init__(self, name=None):
+        self.name = name
+        self.condition = threading.Condition()
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.exception = None
+        self.callbacks = []
+        self.cancel_hooks = []
+        self.t_start = clock()
+        self.t_done = None
+        # times at named points on the way, e.g. for measuring latency
+        self.marks = {}
+
+    def __repr__(self):
+        return '<Operation {}>'.format(self.name)
+
+    def SetResult(self, result):
+        return self.Finish(result, None)
+
+    def SetException(self, exception):
+        return self.Finish(None, exception)
+
+    def Cancel(self):
+        return self.Stop(OperationCancelled(self.name), cancelled=True)
+
+    def Timeout(self):
+        return self.Stop(OperationTimeout(self.name))
+
+    def Stop(self, exception, cancelled=False):
+        if not self.Finish(None, exception, cancelled):
+            return False
+        for hook in self.cancel_hooks:
+            try:
+                hook()
+            except Exception:
+                traceback.print_exc()
+        return True
+
+    def Finish(self, result, exception, cancelled=False):
+        with self.condition:
+            if self.done:
+                return False
+            self.result = result
+            self.exception = exception
+            self.cancelled = cancelled
+            self.done = True
+            self.t_done = clock()
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notify_all()
+        for callback in callbacks:
+            self.RunCallback(callback)
+        return True
+
+    def RunCallback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            traceback.print_exc()
+
+    def Mark(self, name):
+        self.marks[name] = clock()
+
+    def AddDoneCallback(self, callback):
+        with self.condition:
+            if not self.done:
+                self.callbacks.append(callback)
+                return
+        self.RunCallback(callback)
+
+    def AddCancelHook(self, hook):
+        self.cancel_hooks.append(hook)
+
+    def Done(self):
+        return self.done
+
+    def Cancelled(self):
+        return self.cancelled
+
+    def Wait(self, timeout=None):
+        with self.condition:
+            if not self.done:
+                self.condition.wait(timeout)
+            return self.done
+
+    def Result(self, timeout=None):
+        # the result, or raise the exception, waiting if necessary
+        if not self.Wait(timeout):
+            raise OperationTimeout(self.name)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def Elapsed(self):
+        end = self.t_done if self.done else clock()
+        return end - self.t_start
+
+def Completed(result=None, name=None):
+    op = Operation(name)
+    op.SetResult(result)
+    return op
+
+# ------------------------------------------------------------------------------
+# Single thread which calls functions at given times.
+class Scheduler(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.condition = threading.Condition()
+        self.queue = []
+        self.count = 0
+        self.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                when, count, func = self.queue[0]
+                wait = when - clock()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.queue)
+            try:
+                func()
+            except Exception:
+                traceback.print_exc()
+
+    def CallLater(self, delay, func):
+        with self.condition:
+            self.count += 1
+            heapq.heappush(self.queue, (clock() + delay, self.count, func))
+            self.condition.notify()
+
+scheduler = Scheduler()
+
+def Delay(seconds, name='delay'):
+    # operation which completes after the given time
+    op = Operation(name)
+    scheduler.CallLater(seconds, lambda: op.SetResult(None))
+    return op
+
+def WithTimeout(op, timeout):
+    # make op time out (running its cancel hooks) if not done in time
+    if timeout is not None:
+        scheduler.CallLater(timeout, op.Timeout)
+    return op
+
+def Gather(*ops):
+    # operation which completes with a list of the results of all the
+    # given operations, or fails with the first exception among them
+    gathered = Operation('gather')
+    remaining = [len(ops)]
+    lock = threading.Lock()
+    def child_done(op):
+        if op.exception is not None:
+            gathered.SetException(op.exception)
+            return
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            gathered.SetResult([o.result for o in ops])
+    def cancel_children():
+        for op in ops:
+            op.Cancel()
+    gathered.AddCancelHook(cancel_children)
+    if not ops:
+        gathered.SetResult([])
+    for op in ops:
+        op.AddDoneCallback(child_done)
+    return gathered
+
+# ------------------------------------------------------------------------------
+# Runs a generator which yields Operations, resuming it when each is done.
+# The result of each Operation is sent back into the generator as the value
+# of the yield (or its exception is thrown in).  The Task completes with the
+# last value the generator yields which is not an Operation.
+# Cancelling the Task cancels the Operation it is waiting for.
+class Task(Operation):
+    def __init__(self, generator, name=None):
+        Operation.__init__(self, name)
+        self.generator = generator
+        self.current = None
+        self.AddCancelHook(self.CancelCurrent)
+        self.Step(None, None)
+
+    def Step(self, value, exception):
+        while not self.done:
+            try:
+                if exception is not None:
+                    item = self.generator.throw(exception)
+                else:
+                    item = self.generator.send(value)
+            except StopIteration:
+                self.SetResult(self.result)
+                return
+            except Exception as detail:
+                self.SetException(detail)
+                return
+            if isinstance(item, Operation):
+                self.current = item
+                item.AddDoneCallback(self.Resume)
+                return
+            self.result = item
+            value, exception = item, None
+
+    def Resume(self, op):
+        if op is self.current and not self.done:
+            self.current = None
+            self.Step(op.result, op.exception)
+
+    def CancelCurrent(self):
+        current = self.current
+        if current is not None:
+            current.Cancel()
+        try:
+            self.generator.close()
+        except ValueError:
+            # generator is running, and will stop at its next yield
+            pass
+
+# ------------------------------------------------------------------------------
+# Thread which owns a device and runs all calls to it, one at a time.
+# COM is initialised on this thread, so the device's COM object must be
+# created here, in Setup, and only used from here.
+class DeviceWorker(threading.Thread):
+    def __init__(self, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.calls = Queue()
+        self.start()
+
+    def run(self):
+        if pythoncom is not None:
+            pythoncom.CoInitialize()
+        try:
+            self.Setup()
+            while True:
+                item = self.calls.get()
+                if item is None:
+                    break
+                op, func, args, kwargs = item
+                if op is not None and op.Done():
+                    # cancelled before it started
+                    continue
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as detail:
+                    if op is None:
+                        traceback.print_exc()
+                    else:
+                        op.SetException(detail)
+                else:
+                    if op is not None:
+                        op.SetResult(result)
+        finally:
+            self.Teardown()
+            if pythoncom is not None:
+                pythoncom.CoUninitialize()
+
+    def Setup(self):
+        pass
+
+    def Teardown(self):
+        pass
+
+    def Submit(self, func, *args, **kwargs):
+        # run func on this thread, returning an Operation for its result
+        op = Operation(getattr(func, '__name__', None))
+        self.calls.put((op, func, args, kwargs))
+        return op
+
+    def Poll(self, func, interval, timeout=None, name=None):
+        # Operation which completes with the first true value returned by
+        # func, which is called on this thread every interval seconds.
+        # The thread is free to run other calls in between.
+        op = WithTimeout(Operation(name), timeout)
+        def check():
+            if op.Done():
+                return
+            try:
+                value = func()
+            except Exception as detail:
+                op.SetException(detail)
+                return
+            if value:
+                op.SetResult(value)
+            else:
+                scheduler.CallLater(interval, enqueue)
+        def enqueue():
+            if not op.Done():
+                self.calls.put((None, check, (), {}))
+        enqueue()
+        return op
+
+    def Stop(self):
+        self.calls.put(None)
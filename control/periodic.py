@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# periodic.py
+
+from __future__ import division
+
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# Model of the mount's periodic error, learnt from guiding.
+# The guide loop adds the position along RA, in pixels, where the star
+# would have been without any corrections, against time (on the
+# timing.clock scale).  Each guiding run is a separate segment, with its own
+# offset and drift, while the periodic error, which follows the worm
+# gear, carries on from one to the next.
+# The period is found from the strongest peak in the periodogram between
+# min_period and max_period seconds, unless the worm period is given, and
+# the error is fitted by harmonics of it, together with the offset and
+# drift of each segment.  The model is only used once the data cover
+# min_cycles periods and it explains at least min_explained of the
+# variance left after removing the drifts.
+# Fit does it all at once; to fit on another thread, take a Snapshot of
+# the data, Solve it there and then Apply the result.
+class PeriodicErrorModel(object):
+    def __init__(self, period=None, harmonics=4, min_period=60.0,
+                 max_period=1200.0, min_cycles=1.5, min_explained=0.5,
+                 max_samples=5000):
+        self.fixed_period = period
+        self.harmonics = harmonics
+        self.min_period = min_period
+        self.max_period = max_period
+        self.min_cycles = min_cycles
+        self.min_explained = min_explained
+        self.max_samples = max_samples
+        self.times = []
+        self.positions = []
+        self.segments = []
+        self.segment = 0
+        self.Clear()
+
+    def Clear(self):
+        # forget the fit, but not the data
+        self.period = None
+        self.origin = None
+        self.coeffs = None
+        self.explained = 0.0
+        self.amplitude = 0.0
+
+    def NewSegment(self):
+        if self.segments and self.segments[-1] == self.segment:
+            self.segment += 1
+
+    def Add(self, t, position):
+        self.times.append(t)
+        self.positions.append(position)
+        self.segments.append(self.segment)
+        if len(self.times) > self.max_samples:
+            del self.times[0], self.positions[0], self.segments[0]
+
+    def Span(self):
+        if not self.times:
+            return 0.0
+        return self.times[-1] - self.times[0]
+
+    def Ready(self):
+        return self.coeffs is not None
+
+    def Fit(self):
+        # returns True if there is a usable model
+        if self.Span() < self.min_cycles * (self.fixed_period or
+                                            self.min_period):
+            return False
+        return self.Apply(self.Solve(*self.Snapshot()))
+
+    def Snapshot(self):
+        # copy of the data, as (times, positions, segments)
+        return (np.array(self.times), np.array(self.positions),
+                np.array(self.segments))
+
+    def Solve(self, t, y, segments):
+        # Fit to a snapshot, without changing the model, returning
+        # (period, origin, coeffs, explained), or None if there is no
+        # usable fit
+        span = t[-1] - t[0] if len(t) else 0.0
+        if span < self.min_cycles * (self.fixed_period or self.min_period):
+            return None
+        drifts = self.Drifts(t, segments)
+        # what is left once each segment's offset and drift are removed
+        residual = y - drifts.dot(np.linalg.lstsq(drifts, y)[0])
+        period = self.fixed_period or self.FindPeriod(t, y, residual, drifts)
+        if period is None or span < self.min_cycles * period:
+            return None
+        origin = t[0]
+        design = np.column_stack([drifts,
+                                  self.Harmonics(t, period, origin)])
+        coeffs = np.linalg.lstsq(design, y)[0]
+        remaining = y - design.dot(coeffs)
+        explained = 1 - remaining.var() / max(residual.var(), 1e-12)
+        if explained < self.min_explained:
+            return None
+        return period, origin, coeffs[drifts.shape[1]:], explained
+
+    def Apply(self, fit):
+        # use a fit from Solve, returning True if there is a usable model
+        if fit is None:
+            self.Clear()
+            return False
+        self.period, self.origin, self.coeffs, self.explained = fit
+        # peak to peak, from the model over one period
+        phase = self.origin + np.linspace(0, self.period, 200)
+        curve = self.Harmonics(phase, self.period,
+                               self.origin).dot(self.coeffs)
+        self.amplitude = curve.max() - curve.min()
+        return True
+
+    def Drifts(self, t, segments):
+        # offset and drift columns for each segment
+        columns = []
+        for segment in np.unique(segments):
+            inside = segments == segment
+            start = t[inside][0]
+            columns.append(inside.astype(np.float64))
+            columns.append(np.where(inside, t - start, 0.0))
+        return np.column_stack(columns)
+
+    def FindPeriod(self, t, y, residual, drifts):
+        span = t[-1] - t[0]
+        longest = min(self.max_period, span / self.min_cycles)
+        if longest <= self.min_period:
+            return None
+        # Periodogram peak, from a thousand samples at most, which are
+        # plenty to find it.  The peak can be pulled by harmonics and gaps,
+        # so the period is then refined around it with the full fit.
+        step = max(len(t) // 1000, 1)
+        sample = residual[::step] - residual[::step].mean()
+        periods = np.linspace(self.min_period, longest, 500)
+        power = self.Power(periods, t[::step] - t[0], sample)
+        best = periods[np.argmax(power)]
+        width = periods[1] - periods[0]
+        periods = np.linspace(best - 2 * width, best + 2 * width, 41)
+        misfit = [self.Misfit(t, y, drifts, period) for period in periods]
+        return periods[np.argmin(misfit)]
+
+    def Misfit(self, t, y, drifts, period):
+        design = np.column_stack([drifts, self.Harmonics(t, period, t[0])])
+        coeffs = np.linalg.lstsq(design, y)[0]
+        return np.sum((y - design.dot(coeffs))**2)
+
+    def Power(self, periods, t, y):
+        # periodogram, for trial periods
+        angles = np.outer(2 * np.pi / periods, t)
+        return np.cos(angles).dot(y)**2 + np.sin(angles).dot(y)**2
+
+    def Harmonics(self, t, period, origin):
+        phase = 2 * np.pi * (np.asarray(t, dtype=np.float64) -
+                             origin) / period
+        k = np.arange(1, self.harmonics + 1)
+        angles = np.outer(phase, k)
+        return np.column_stack([np.cos(angles), np.sin(angles)])
+
+    def Predict(self, t):
+        # periodic error at time t, in pixels along RA
+        if self.coeffs is None:
+            return 0.0
+        return float(self.Harmonics([t], self.period,
+                                    self.origin).dot(self.coeffs)[0])
+
+    def Describe(self):
+        if self.coeffs is None:
+            return 'no periodic error model'
+        return ('period {:.1f} sec, {:.2f} pixels peak to peak, explaining '
+                '{:.0f}% of the variance'.format(self.period, self.amplitude,
+                                                 self.explained * 100))
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# replay.py
+
+from __future__ import division, print_function
+
+import os
+import argparse
+import tempfile
+import time
+from Queue import Queue
+import numpy as np
+
+from ao import AOThread, AOStep
+from aoemulator import SXVAOEmulator
+from guideloop import GuideLoopThread
+from controller import MakeController
+from periodic import PeriodicErrorModel
+from telemetry import TelemetryRecorder, Load, RMS, SENT, MADE, DROPPED
+from latency import hops
+from framebus import frames
+from timing import clock
+
+# ------------------------------------------------------------------------------
+# Replay of guider frames through the real guide path, GuideLoopThread
+# (centroiding and guide controller) and AOThread (scheduling and the
+# serial protocol), against the SX AO emulator, so changes to it can be
+# benchmarked before a night, without the hardware or the sky.
+# Frames are published on the frame bus as by the guider camera, one every
+# exptime / speed seconds, so speed > 1 replays faster than real time.
+# They are either synthetic or recorded:
+#  - SyntheticFrames draws a star with seeing, drift and periodic error,
+#    seen through the emulated tip-tilt and mount (see
+#    SXVAOEmulator.Offset), so the loop is closed and the tracking error,
+#    the true offset of the star from the guide box, can be measured.  The
+#    frames are the same on each run, from the seed, though the timing of
+#    the threads is not.
+#  - RecordedFrames replays a cube of images saved with numpy (.npy, or
+#    .npz with 'images' and optionally 'exptimes'), which cannot follow the
+#    corrections, so only the latencies and the offsets measured count.
+# Stage latencies come from timing the guide loop's methods and from its
+# telemetry (see telemetry.py), followed by the medians of the hops kept by
+# its LatencyMonitor (see latency.py), taking a frame's exposure to end
+# when drawing it starts:
+#   bus       frame published to the guide loop taking it
+#   centroid  measuring the guide boxes
+#   guide     the whole of the guide loop's work on the frame
+#   ao        correction queued to the AO unit acknowledging it
+#   total     frame published to the AO unit acknowledging the correction
+
+class SyntheticFrames(object):
+    def __init__(self, emulator, shape=(200, 200), fwhm=3.0, flux=20000.0,
+                 sky=1000.0, read_noise=10.0, seeing=0.3, drift=(0.02, 0.01),
+                 periodic=1.0, period=120.0, seed=0):
+        self.emulator = emulator
+        self.shape = shape
+        self.sigma = fwhm / 2.3548
+        self.flux = flux
+        self.sky = sky
+        self.read_noise = read_noise
+        self.seeing = seeing
+        self.drift = np.array(drift, dtype=np.float64)
+        self.periodic = periodic
+        self.period = period
+        self.state = np.random.RandomState(seed)
+        self.start = np.array(shape) / 2.0
+        self.x, self.y = np.indices(shape)
+        # truth for each frame, by t_ready
+        self.truth = {}
+
+    def Box(self):
+        return tuple(int(round(c)) for c in self.start)
+
+    def Position(self, t):
+        # where the star is, without seeing, t seconds into the run
+        disturbance = self.drift * t
+        disturbance[0] += self.periodic * np.sin(2 * np.pi * t / self.period)
+        return self.start + disturbance + self.emulator.Offset()
+
+    def Frame(self, t, exptime):
+        position = self.Position(t)
+        seen = position + self.state.normal(0, self.seeing, 2)
+        star = np.exp(-((self.x - seen[0])**2 + (self.y - seen[1])**2) /
+                      (2 * self.sigma**2))
+        star *= self.flux * exptime / (2 * np.pi * self.sigma**2)
+        image = self.state.poisson(star + self.sky * exptime)
+        image = image + self.state.normal(0, self.read_noise, self.shape)
+        return image, position
+
+    def Record(self, frame, position):
+        self.truth[frame.t_ready] = position - self.Box()
+
+    def Error(self, t):
+        # true offset of the star from the guide box, for frames ready at t
+        return np.array([self.truth[ti] for ti in t])
+
+class RecordedFrames(object):
+    def __init__(self, filename, exptime):
+        if filename.endswith('.npz'):
+            data = np.load(filename)
+            self.images = data['images']
+            self.exptimes = (data['exptimes'] if 'exptimes' in data.files
+                             else np.full(len(self.images), exptime))
+        else:
+            self.images = np.load(filename, mmap_mode='r')
+            self.exptimes = np.full(len(self.images), exptime)
+        self.index = 0
+
+    def Box(self):
+        # found by the guide loop
+        return None
+
+    def Frame(self, t, exptime):
+        image = np.asarray(self.images[self.index % len(self.images)])
+        self.index += 1
+        return image, None
+
+    def Record(self, frame, position):
+        pass
+
+def Timed(func, times):
+    # func, appending how long each call takes to times
+    def timed(*args, **kwargs):
+        t0 = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            times.append(clock() - t0)
+    return timed
+
+def Percentiles(times):
+    ms = np.asarray(times, dtype=np.float64) * 1000
+    ms = ms[np.isfinite(ms)]
+    if len(ms) == 0:
+        return 'none'
+    return ('median {:6.2f} ms, 90% {:6.2f} ms, 99% {:6.2f} ms, max {:6.2f} '
+            'ms'.format(np.median(ms), np.percentile(ms, 90),
+                        np.percentile(ms, 99), ms.max()))
+
+def Replay(source, loop, ao, nframes, exptime, speed, exptimes=None):
+    # publish the frames, at exptime / speed intervals, and wait for the
+    # last correction
+    t_start = clock()
+    for i in range(nframes):
+        frame_exptime = exptime if exptimes is None else float(
+            exptimes[i % len(exptimes)])
+        wait = t_start + (i + 1) * exptime / speed - clock()
+        if wait > 0:
+            time.sleep(wait)
+        t_exposed = clock()
+        t = (t_exposed - t_start) * speed
+        image, position = source.Frame(t, frame_exptime)
+        frame = frames.Publish('guider', image, time.time(), frame_exptime,
+                               t_exposed)
+        source.Record(frame, position)
+    time.sleep(max(exptime / speed, 2 * ao.minsteptime))
+
+def Report(source, data, times, latency, settle):
+    guided = data[data['t'] >= data['t'][0] + settle] if len(data) else data
+    sent = guided['flags'] & SENT != 0
+    print('{:d} frames, {:d} corrections sent, {:d} made, {:d} '
+          'dropped'.format(len(guided), int(sent.sum()),
+                           int(np.sum(guided['flags'] & MADE != 0)),
+                           int(np.sum(guided['flags'] & DROPPED != 0))))
+    stages = [('bus', times['bus']), ('centroid', times['centroid']),
+              ('guide', times['guide']),
+              ('ao', guided['latency'][sent]),
+              ('total', guided['delay'][sent] + guided['latency'][sent])]
+    for name, values in stages:
+        print('{:>8s}: {}'.format(name, Percentiles(values)))
+    medians = []
+    for hop in hops:
+        p = latency.Percentiles(hop)
+        if p is not None:
+            medians.append('{} {:.2f}'.format(hop, p[0] * 1000))
+    print('Hops: {} ms'.format(', '.join(medians)))
+    print('Measured offset rms ({:.3f},{:.3f}) pixels, {:.3f} '
+          'overall'.format(*RMS(guided)))
+    if isinstance(source, SyntheticFrames) and len(guided):
+        error = source.Error(guided['t'])
+        rms = np.sqrt(np.mean(error**2, axis=0))
+        print('Tracking error rms ({:.3f},{:.3f}) pixels, {:.3f} overall, '
+              'max {:.3f}'.format(rms[0], rms[1], np.hypot(*rms),
+                                  np.hypot(error[:, 0], error[:, 1]).max()))
+        measured = np.column_stack([guided['dx'], guided['dy']])
+        print('Measured less true offset rms {:.3f} pixels'.format(
+            np.sqrt(np.mean(np.sum((measured - error)**2, axis=1)))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay guider frames '
+                                     'through the guide loop and AO thread '
+                                     'against the SX AO emulator')
+    parser.add_argument('--frames', help='recorded frames (.npy or .npz), '
+                        'instead of synthetic ones')
+    parser.add_argument('--nframes', type=int, default=300)
+    parser.add_argument('--exptime', type=float, default=1.0)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay this many times faster than real time')
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help='seconds at the start left out of the results')
+    parser.add_argument('--controller', default='kalman')
+    parser.add_argument('--no-auto', dest='auto', action='store_false',
+                        help='do not tune the controller gains')
+    parser.add_argument('--periodic', action='store_true',
+                        help='learn and correct periodic error')
+    parser.add_argument('--method', default='windowed',
+                        help='centroiding method')
+    parser.add_argument('--box-size', type=int, default=25)
+    parser.add_argument('--min-correction', type=float, default=0.1)
+    parser.add_argument('--seeing', type=float, default=0.3)
+    parser.add_argument('--drift', type=float, nargs=2, default=[0.02, 0.01],
+                        help='pixels per second')
+    parser.add_argument('--pe', type=float, default=1.0,
+                        help='periodic error amplitude in pixels')
+    parser.add_argument('--pe-period', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--telemetry', help='keep the telemetry in this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    log = []
+    emulator = SXVAOEmulator()
+    emulator.start()
+    ao = AOThread(None, Queue(), emulator.Port(), 10)
+    ao.Log = print if args.verbose else log.append
+    # the emulator's true calibration
+    ao.SetCalibration(np.linalg.inv(emulator.pixels_per_step),
+                      np.linalg.inv(emulator.mount_pixels_per_step))
+    ao.SetVerbose(args.verbose)
+    ao.start()
+    if args.frames:
+        source = RecordedFrames(args.frames, args.exptime)
+        exptimes = source.exptimes
+    else:
+        # the seeing is averaged over the exposure
+        source = SyntheticFrames(emulator, seeing=args.seeing /
+                                 np.sqrt(args.exptime), drift=args.drift,
+                                 periodic=args.pe, period=args.pe_period,
+                                 seed=args.seed)
+        exptimes = None
+    periodic = PeriodicErrorModel() if args.periodic else None
+    controller = MakeController(args.controller, args.min_correction,
+                                auto=args.auto)
+    loop = GuideLoopThread(None, args.box_size, args.min_correction,
+                           args.method, auto_select=True,
+                           controller=controller, periodic=periodic)
+    loop.Log = ao.Log
+    times = {'bus': [], 'centroid': [], 'guide': []}
+    guide = loop.Guide
+    def timed_guide(frame, boxes, corrections):
+        times['bus'].append(clock() - frame.t_ready)
+        return guide(frame, boxes, corrections)
+    loop.Guide = Timed(timed_guide, times['guide'])
+    loop.MeasureBoxes = Timed(loop.MeasureBoxes, times['centroid'])
+    filename = args.telemetry
+    if filename is None:
+        handle, filename = tempfile.mkstemp(suffix='.tlm')
+        os.close(handle)
+        os.remove(filename)
+    telemetry = TelemetryRecorder(filename)
+    first = telemetry.Count()
+    loop.SetTelemetry(telemetry, ao.GetPosition)
+    try:
+        AOStep(ao.corrections, 'GS', 0, 0).Result(30.0)
+        if not ao.connected:
+            raise RuntimeError('unable to connect to emulator')
+        ao.SetMode('guiding')
+        if source.Box() is not None:
+            loop.SetBox(*source.Box())
+        loop.StartGuiding(ao.corrections)
+        Replay(source, loop, ao, args.nframes, args.exptime, args.speed,
+               exptimes)
+        loop.StopGuiding()
+        telemetry.Flush()
+        data = Load(filename)[first:]
+        # the guide loop only takes the newest frame, so some may be
+        # skipped when replaying fast
+        print('Replayed {:d} frames at {:g}x, {:d} measured'.format(
+            args.nframes, args.speed, len(data)))
+        Report(source, data, times, loop.latency,
+               args.settle / args.speed)
+        print('Controller: {}'.format(loop.DescribeController()))
+        if periodic is not None:
+            print('Periodic error: {}'.format(loop.DescribePeriodicError()))
+    finally:
+        loop.Stop()
+        ao.Shutdown(10.0)
+        emulator.Stop()
+        telemetry.Close()
+        if args.telemetry is None:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,14 @@
 import wx
 import threading
 
-from logevent import *
+from logservice import logs, SourceOf
 
 from scipy.ndimage.filters import median_filter, gaussian_filter
 import astropy.io.fits as pyfits
 
 import astrotortilla.solver.AstrometryNetSolver as AstSolve
 from astrotortilla.units import Coordinate
+from orchestrator import Operation
 
 # ------------------------------------------------------------------------------
 # Event to signal that a new solution is ready for use
@@ -25,6 +26,8 @@ class SolutionReadyEvent(wx.PyCommandEvent):
 # Class to obtain plate solution on a separate thread.
 # When run, this creates a solver, waits filenames in a Queue,
 # and posts events when a solution is ready.
+# An Operation may be added to the end of the queued tuple, to be
+# completed with the solution (see Solve).
 # Stops when a None is added to the Queue.
 class SolverThread(threading.Thread):
     def __init__(self, parent, incoming, directory=None, timeout=60):
@@ -48,12 +51,14 @@ class SolverThread(threading.Thread):
         self.solver.setProperty('scale_max', 3.0)
         self.solver.setProperty('scale_units', 'arcsecperpix')
         self.solver.setProperty('searchradius', 5.0)
+        op = None
         try:
             while True:
                 incoming = self.incoming.get()
                 if incoming is None:
                     break
-                filters, fn, image_time, filenames, position = incoming
+                filters, fn, image_time, filenames, position = incoming[:5]
+                op = incoming[5] if len(incoming) > 5 else None
                 self.CreateSolveImage(filters, fn)
                 if position is not None:
                     target = Coordinate(position.ra.deg, position.dec.deg)
@@ -70,8 +75,13 @@ class SolverThread(threading.Thread):
                              SolutionReadyEvent(solution=solution,
                                             image_time=image_time,
                                             filenames=filenames))
+                if op is not None:
+                    op.SetResult(solution)
+                    op = None
         except Exception as detail:
             self.Log('Error in solver:\n{}'.format(detail))
+            if op is not None:
+                op.SetException(detail)
             raise
 
     def Log(self, text):
@@ -80,7 +90,7 @@ class SolverThread(threading.Thread):
                 text = text.strip()
             if ((len(text) > 0) and (text != self.lastlog)
                 and ('did not' not in text)):
-                    wx.PostEvent(self.parent, LogEvent(text=text))
+                    logs.Post(text, SourceOf(self.parent))
                     self.lastlog = text
         except:
             pass
@@ -94,3 +104,12 @@ class SolverThread(threading.Thread):
         image = median_filter(image, (3,3))
         image = gaussian_filter(image, 2)
         pyfits.writeto(filename, image, clobber=True)
+
+# ------------------------------------------------------------------------------
+# Operation (see orchestrator.py) to solve the given filtered image using
+# the SolverThread reading the given queue, which completes with the
+# solution (or None if solving failed).
+def Solve(incoming, filters, fn, image_time, filenames, position):
+    op = Operation('solve')
+    incoming.put((filters, fn, image_time, filenames, position, op))
+    return op
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# stats.py
+
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# ------------------------------------------------------------------------------
+# Machine-readable statistics, served as JSON over HTTP on its own thread,
+# e.g. for monitoring the guide latency (see latency.py) from a script:
+#   GET /stats          all sources, as {name: stats}
+#   GET /stats/<name>   one source
+# Sources are added with Add(name, function), the function returning
+# anything json can encode, and are called on the server's thread.
+# Only connections from this machine are accepted, unless another address
+# is given.
+class StatsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, address='localhost'):
+        HTTPServer.__init__(self, (address, port), StatsHandler)
+        self.lock = threading.Lock()
+        self.sources = {}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def Add(self, name, function):
+        with self.lock:
+            self.sources[name] = function
+
+    def Start(self):
+        self.thread.start()
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def Collect(self, name=None):
+        # {name: stats} for all sources, or the stats of one
+        with self.lock:
+            sources = dict(self.sources)
+        if name is not None:
+            return sources[name]()
+        return dict((key, function()) for key, function in sources.items())
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if not parts or parts[0] != 'stats' or len(parts) > 2:
+            self.send_error(404)
+            return
+        try:
+            stats = self.server.Collect(parts[1] if len(parts) > 1 else None)
+        except KeyError:
+            self.send_error(404)
+            return
+        body = json.dumps(stats, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # not to stderr for every request
+        pass
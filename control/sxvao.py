@@ -3,6 +3,11 @@
 # sxvao.py
 
 import serial
+from collections import OrderedDict
+import numpy as np
+
+# most steps one command can carry, its count being 5 digits
+max_command_steps = 99999
 
 
 class SXVAO():
@@ -19,12 +24,22 @@ class SXVAO():
         self.mount_switch_xy = False
         self.mount_reverse_x = False
         self.mount_reverse_y = False
+        # 2x2 matrices taking a movement in pixels to (x, y) steps, from
+        # calibration (see aocalibration.py), used instead of the above
+        self.matrix = None
+        self.mount_matrix = None
         self.max_steps = 10
         self.steps_limit = 1000
+        # recentre with the mount as soon as steps_limit is passed, or
+        # leave it to a separate offload loop calling Offload
+        self.recentre = True
+        # log the steps taken
+        self.verbose = True
         # internal variables
         self.ao = None
         self.count_steps_N = 0
         self.count_steps_W = 0
+        self.at_limit = False
 
     def Connect(self):
         if self.ao is None:
@@ -34,7 +49,11 @@ class SXVAO():
                 return False
             self.ao.write('X')
             response = self.ao.read(1)
-            return response == 'Y'
+            if response != 'Y':
+                # close again, so a later attempt can reopen the port
+                self.Disconnect()
+                return False
+            return True
         else:
             return False
 
@@ -44,6 +63,11 @@ class SXVAO():
             self.ao = None
 
     def MakeCorrection(self, dx, dy):
+        # (dx, dy) is the offset of the star, in pixels, so the calibrated
+        # move is the one taking the star back by that much
+        if self.matrix is not None:
+            sx, sy = np.dot(self.matrix, (-dx, -dy))
+            return self.MakeStepCorrection(sx, sy)
         if self.reverse_x:
             dx = -dx
         if self.reverse_y:
@@ -51,20 +75,17 @@ class SXVAO():
         if self.switch_xy:
             dx, dy = dy, dx
         nx = self.DeltaToSteps(dx)
-        dir = 'T' if dx > 0 else 'W'
-        while nx > 0:
-            n = nx%self.max_steps
-            self.MakeSteps(dir, n)
-            nx -= n
         ny = self.DeltaToSteps(dy)
-        dir = 'N' if dy > 0 else 'S'
-        while ny > 0:
-            n = ny%self.max_steps
-            self.MakeSteps(dir, n)
-            ny -= n
-        return True
+        return self.MakeStepCorrection(np.sign(dx) * nx, np.sign(dy) * ny)
+
+    def MakeStepCorrection(self, sx, sy):
+        # signed steps, positive being T and N
+        return self.SendSteps(self.PlanSteps('G', sx, sy, self.max_steps))
 
     def MakeMountCorrection(self, dx, dy):
+        if self.mount_matrix is not None:
+            sx, sy = np.dot(self.mount_matrix, (-dx, -dy))
+            return self.MakeMountStepCorrection(sx, sy)
         if self.mount_reverse_x:
             dx = -dx
         if self.mount_reverse_y:
@@ -72,12 +93,13 @@ class SXVAO():
         if self.mount_switch_xy:
             dx, dy = dy, dx
         nx = self.DeltaToMountSteps(dx)
-        dir = 'T' if dx > 0 else 'W'
-        self.MakeMountSteps(dir, nx)
         ny = self.DeltaToMountSteps(dy)
-        dir = 'N' if dy > 0 else 'S'
-        self.MakeMountSteps(dir, ny)
-        return True
+        return self.MakeMountStepCorrection(np.sign(dx) * nx,
+                                            np.sign(dy) * ny)
+
+    def MakeMountStepCorrection(self, sx, sy):
+        # signed steps, positive being T and N
+        return self.SendSteps(self.PlanSteps('M', sx, sy))
 
     def DeltaToSteps(self, d):
         return int(round(abs(d)/self.steps_per_pixel))
@@ -85,8 +107,75 @@ class SXVAO():
     def DeltaToMountSteps(self, d):
         return int(round(abs(d)/self.mount_steps_per_pixel))
 
-    def MakeSteps(self, dir, n=1):
-        # dir must be one of [N, S, T, W]
+    def PlanSteps(self, kind, sx, sy, max_steps=None):
+        # (kind, dir, n) commands for signed steps, kind being 'G' for the
+        # AO unit or 'M' for the mount, in chunks of at most max_steps,
+        # and never more than one command can carry
+        commands = []
+        for steps, dirs in ((sx, 'WT'), (sy, 'SN')):
+            n = int(round(abs(steps)))
+            dir = dirs[1] if steps > 0 else dirs[0]
+            chunk = min(max_steps or max_command_steps, max_command_steps)
+            while n > 0:
+                m = min(n, chunk)
+                commands.append((kind, dir, m))
+                n -= m
+        return commands
+
+    def SendSteps(self, commands, recentre=True):
+        # The commands are written back to back, and the one byte
+        # acknowledgements read together afterwards, so a correction
+        # takes one round trip however many chunks it has.
+        # Each is acknowledged with its kind, or 'L' if the AO unit hit
+        # its limit, which forces the mount to take over.
+        if not commands:
+            return True
+        if any(not 0 < n <= max_command_steps for kind, dir, n in commands):
+            # would not fit the fixed width of the commands
+            self.parent.Log('Refusing steps {}, outside 1 to {:d} '
+                            'steps'.format(commands, max_command_steps))
+            return False
+        self.ao.write(''.join('{}{:1s}{:05d}'.format(kind, dir, n)
+                              for kind, dir, n in commands))
+        responses = self.ao.read(len(commands))
+        taken = OrderedDict()
+        limit = False
+        failed = False
+        acknowledged = 0
+        for i, (kind, dir, n) in enumerate(commands):
+            response = responses[i:i+1]
+            if response == kind or (kind == 'G' and response == 'L'):
+                acknowledged += 1
+                if kind == 'G':
+                    self.CountSteps(dir, n)
+                taken[kind, dir] = taken.get((kind, dir), 0) + n
+                limit = limit or response == 'L'
+            else:
+                failed = True
+        kinds = set(kind for kind, dir, n in commands)
+        if kinds == set('G'):
+            name = 'AO unit'
+        elif kinds == set('M'):
+            name = 'Mount'
+        else:
+            name = 'AO unit and mount'
+        if taken and self.verbose:
+            self.parent.Log('{} took steps {}'.format(name, ', '.join(
+                '{:d} {:s}'.format(n, dir) for (kind, dir), n in taken.items())))
+        if limit:
+            self.parent.Log('AO unit hit limit')
+            self.at_limit = True
+        if failed:
+            self.parent.Log('{} stepping failed ({:d} of {:d} '
+                            'acknowledged)'.format(name, acknowledged,
+                                                   len(commands)))
+            # discard anything late, so the next acknowledgements match
+            self.ao.flushInput()
+        if recentre and self.recentre and 'G' in kinds:
+            failed = not self.RecentreMountIfNeeded(force=limit) or failed
+        return not failed
+
+    def CountSteps(self, dir, n):
         if dir == 'N':
             self.count_steps_N += n
         elif dir == 'S':
@@ -95,54 +184,69 @@ class SXVAO():
             self.count_steps_W += n
         elif dir == 'T':
             self.count_steps_W -= n
-        command = 'G{:1s}{:05d}'.format(dir, n)
-        self.ao.write(command)
-        response = self.ao.read(1)
-        if response == 'G':
-            self.parent.Log('AO unit took {:d} steps {:s}'.format(n, dir))
-        elif response == 'L':
-            self.parent.Log('AO unit hit limit')
-        else:
-            self.parent.Log('AO unit stepping failed')
-        self.RecentreMountIfNeeded(force=(response=='L'))
+
+    def MakeSteps(self, dir, n=1):
+        # dir must be one of [N, S, T, W]
+        return self.SendSteps([('G', dir, n)])
 
     def MakeMountSteps(self, dir, n=1):
         # dir must be one of [N, S, T, W]
-        command = 'M{:1s}{:05d}'.format(dir, n)
-        self.ao.write(command)
-        response = self.ao.read(1)
-        if response == 'M':
-            self.parent.Log('Mount took {:d} steps {:s}'.format(n, dir))
-        else:
-            self.parent.Log('Mount stepping failed')
+        return self.SendSteps([('M', dir, n)])
 
     def RecentreMountIfNeeded(self, force=False):
         # Move to approximately recentre AO with
-        # opposing move for scope to keep image stationary
-        # North-South
-        mount_steps_N = (self.count_steps_N * self.mount_steps_per_pixel
-                         / self.steps_per_pixel)
-        if self.count_steps_N > self.steps_limit or force:
-            self.MakeSteps('S', abs(self.count_steps_N))
-            self.MakeMountSteps('N', abs(mount_steps_N))
-            self.count_steps_N = 0
-        elif self.count_steps_N < -self.steps_limit:
-            self.MakeSteps('N', abs(self.count_steps_N))
-            self.MakeMountSteps('S', abs(mount_steps_N))
-            self.count_steps_N = 0
-        # West-East
-        mount_steps_W = (self.count_steps_W * self.mount_steps_per_pixel
-                         / self.steps_per_pixel)
-        if self.count_steps_W > self.steps_limit or force:
-            self.MakeSteps('T', abs(self.count_steps_W))
-            self.MakeMountSteps('W', abs(mount_steps_W))
-            self.count_steps_W = 0
-        elif self.count_steps_W < -self.steps_limit:
-            self.MakeSteps('W', abs(self.count_steps_W))
-            self.MakeMountSteps('T', abs(mount_steps_W))
-            self.count_steps_W = 0
+        # opposing move for scope to keep image stationary,
+        # all in one round trip, in chunks of at most max_steps
+        ratio = self.mount_steps_per_pixel / self.steps_per_pixel
+        # signed (x, y) steps from centre, as in Offload, on the axes past
+        # the limit
+        position = np.array([-self.count_steps_W, self.count_steps_N])
+        if not force:
+            position = np.where(np.abs(position) > self.steps_limit,
+                                position, 0)
+        if not position.any():
+            return True
+        commands = (self.PlanSteps('G', -position[0], -position[1],
+                                   self.max_steps) +
+                    self.PlanSteps('M', position[0] * ratio,
+                                   position[1] * ratio, self.max_steps))
+        self.parent.Log('Recentring AO unit with mount')
+        return self.SendSteps(commands, recentre=False)
+
+    def Offload(self, fraction, max_steps, deadband):
+        # Bleed a fraction of the AO unit's offset from centre into the
+        # mount, a few steps at a time, so guiding carries on around it.
+        # The mount moves first, then the AO unit moves back the same
+        # distance on the sky, in one round trip.
+        # After hitting a limit, offload as much as allowed at once.
+        position = np.array([-self.count_steps_W, self.count_steps_N])
+        if self.at_limit:
+            fraction, deadband = 1.0, 0
+        n = np.clip(np.round(np.abs(position) * fraction), 1, max_steps)
+        back = np.where(np.abs(position) > deadband,
+                        -np.sign(position) * n, 0)
+        self.at_limit = False
+        if not back.any():
+            return True
+        mount = self.MountStepsFor(back)
+        commands = (self.PlanSteps('M', mount[0], mount[1]) +
+                    self.PlanSteps('G', back[0], back[1], self.max_steps))
+        return self.SendSteps(commands, recentre=False)
+
+    def MountStepsFor(self, steps):
+        # signed mount steps to keep the star still while the AO unit
+        # moves by the given signed steps
+        if self.matrix is not None and self.mount_matrix is not None:
+            pixels = np.linalg.solve(self.matrix, steps)
+            return -self.mount_matrix.dot(pixels)
+        ratio = self.mount_steps_per_pixel / self.steps_per_pixel
+        return -np.asarray(steps) * ratio
 
     def Centre(self):
         self.ao.write('K')
         response = self.ao.read(1)
+        if response == 'K':
+            self.count_steps_N = 0
+            self.count_steps_W = 0
+            self.at_limit = False
         return response == 'K'
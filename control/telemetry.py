@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+# telemetry.py
+
+from __future__ import division, print_function
+
+import os
+import json
+import struct
+import argparse
+import threading
+import numpy as np
+from scipy.signal import welch
+
+# Guiding telemetry: one fixed-width record for each frame the guide loop
+# measures, appended to a memory-mapped file, so recording one costs little
+# more than setting a few array elements, and read back as a numpy
+# structured array for analysis (see Load and Summary, or run this module
+# on a file).
+# The fields of each record are:
+#   t           when the frame was ready, on the timing.clock scale (seconds),
+#               which may start again from 0 in each process
+#   time        the same, as a Unix time (seconds), which carries on across
+#               restarts, so is used to order the records and find gaps
+#   exptime     exposure time of the frame (seconds)
+#   x, y        position of the guide star on the frame (pixels)
+#   dx, dy      offset of the star from the guide box (pixels)
+#   flux, snr, fwhm  of the guide star
+#   cx, cy      correction sent to the AO unit (pixels), 0 if none
+#   ao_x, ao_y  position of the AO unit once it was made (steps)
+#   delay       from the frame being ready to the correction being queued
+#   latency     from the correction being queued to the AO unit
+#               acknowledging it (seconds)
+#   flags       GUIDING, LOST, SENT, MADE and DROPPED below
+# Values not known, such as the latency of a correction never made, are NaN.
+record_dtype = np.dtype([('t', '<f8'), ('time', '<f8'), ('exptime', '<f4'),
+                         ('x', '<f4'), ('y', '<f4'),
+                         ('dx', '<f4'), ('dy', '<f4'),
+                         ('flux', '<f4'), ('snr', '<f4'), ('fwhm', '<f4'),
+                         ('cx', '<f4'), ('cy', '<f4'),
+                         ('ao_x', '<f4'), ('ao_y', '<f4'),
+                         ('delay', '<f4'), ('latency', '<f4'),
+                         ('flags', 'u1')])
+
+GUIDING = 1   # guiding was on
+LOST = 2      # the star was not fit to guide on, so no correction
+SENT = 4      # a correction was queued for the AO unit
+MADE = 8      # the AO unit made it
+DROPPED = 16  # it was superseded by a newer one, stale, or failed
+
+# The file starts with a HEADER_SIZE byte header holding the magic string,
+# the number of records, the number of records in each chunk and the
+# record fields, as JSON.  The records follow in chunks, each stored a
+# column at a time, so reading one field over a night only touches that
+# field's pages, and the file grows a chunk at a time without moving what
+# is already there.  The number of records is updated with each one, so
+# the file can be read while it is being written, or after a crash.
+# A file cannot be resized on Windows while any of it is mapped, so the
+# recorder unmaps everything to grow the file, which it does
+# grow_chunks chunks at a time.
+MAGIC = b'GTLM0001'
+HEADER_SIZE = 4096
+
+def WriteHeader(filename, chunk_size, dtype=record_dtype):
+    fields = json.dumps(dtype.descr).encode('ascii')
+    header = MAGIC + struct.pack('<QII', 0, chunk_size, len(fields)) + fields
+    if len(header) > HEADER_SIZE:
+        raise ValueError('too many telemetry fields')
+    with open(filename, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+
+def ReadHeader(filename):
+    # (number of records, records per chunk, record dtype)
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[:8] != MAGIC:
+        raise ValueError('{} is not a telemetry file'.format(filename))
+    count, chunk_size, length = struct.unpack('<QII', header[8:24])
+    fields = json.loads(header[24:24 + length].decode('ascii'))
+    dtype = np.dtype([(str(name), str(fmt)) for name, fmt in fields])
+    return count, chunk_size, dtype
+
+def Layout(dtype, chunk_size):
+    # bytes in each chunk, and (name, dtype, offset) of each column in it
+    columns = []
+    offset = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        columns.append((name, field, offset))
+        offset += field.itemsize * chunk_size
+    return offset, columns
+
+# ------------------------------------------------------------------------------
+# Appends records to a telemetry file, creating it if need be, or carrying
+# on from the end of it, so a night's guiding can go into one file across
+# restarts.  Append fills in a new record and returns its index, so values
+# known later, such as the AO unit's acknowledgement, can be filled in
+# with Update.  Both may be called from any thread.
+class TelemetryRecorder(object):
+    def __init__(self, filename, chunk_size=4096, grow_chunks=4):
+        self.filename = filename
+        self.grow_chunks = grow_chunks
+        self.lock = threading.Lock()
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            count, chunk_size, dtype = ReadHeader(filename)
+            if dtype != record_dtype:
+                raise ValueError('{} has different telemetry '
+                                 'fields'.format(filename))
+        else:
+            WriteHeader(filename, chunk_size)
+        self.chunk_size = chunk_size
+        self.chunk_bytes, self.layout = Layout(record_dtype, chunk_size)
+        # the chunks mapped, most recent last
+        self.chunks = []
+        self.MapHeader()
+        self.count = int(self.header[0])
+        # values of a record until they are filled in
+        self.blank = np.zeros(1, dtype=record_dtype)[0]
+        for name in record_dtype.names:
+            if name != 'flags':
+                self.blank[name] = np.nan
+
+    def Append(self, **values):
+        with self.lock:
+            if self.header is None:
+                return None
+            index = self.count
+            columns = self.Columns(index // self.chunk_size)
+            i = index % self.chunk_size
+            for name, column in columns.items():
+                column[i] = self.blank[name]
+            for name, value in values.items():
+                columns[name][i] = value
+            self.count += 1
+            self.header[0] = self.count
+        return index
+
+    def Update(self, index, flags=0, **values):
+        # flags are added to those already set
+        with self.lock:
+            if self.header is None or not 0 <= index < self.count:
+                return
+            columns = self.Columns(index // self.chunk_size)
+            i = index % self.chunk_size
+            columns['flags'][i] |= flags
+            for name, value in values.items():
+                columns[name][i] = value
+
+    def MapHeader(self):
+        self.header = np.memmap(self.filename, dtype='<u8', mode='r+',
+                                offset=8, shape=(1,))
+
+    def Grow(self, size):
+        # grow the file to at least size bytes, with nothing mapped
+        if os.path.getsize(self.filename) >= size:
+            return
+        for n, columns, mapped in self.chunks:
+            mapped.flush()
+        self.header.flush()
+        # the maps are closed once nothing refers to them
+        self.chunks = []
+        self.header = None
+        try:
+            with open(self.filename, 'r+b') as f:
+                f.truncate(size + (self.grow_chunks - 1) * self.chunk_bytes)
+        finally:
+            self.MapHeader()
+
+    def Columns(self, chunk):
+        # the columns of a chunk, mapping it, and growing the file to hold
+        # it, if need be
+        for n, columns, mapped in self.chunks:
+            if n == chunk:
+                return columns
+        offset = HEADER_SIZE + chunk * self.chunk_bytes
+        self.Grow(offset + self.chunk_bytes)
+        mapped = np.memmap(self.filename, dtype=np.uint8, mode='r+',
+                           offset=offset, shape=(self.chunk_bytes,))
+        columns = dict((name, mapped[start:start + dtype.itemsize *
+                                     self.chunk_size].view(dtype))
+                       for name, dtype, start in self.layout)
+        self.chunks.append((chunk, columns, mapped))
+        # keep the last few, for updates to recent records
+        if len(self.chunks) > 2:
+            self.chunks.pop(0)[2].flush()
+        return columns
+
+    def Count(self):
+        return self.count
+
+    def Flush(self):
+        with self.lock:
+            if self.header is None:
+                return
+            for n, columns, mapped in self.chunks:
+                mapped.flush()
+            self.header.flush()
+
+    def Close(self):
+        self.Flush()
+        with self.lock:
+            self.chunks = []
+            self.header = None
+
+def Load(filename):
+    # all the records in a telemetry file, as a numpy structured array
+    count, chunk_size, dtype = ReadHeader(filename)
+    data = np.zeros(count, dtype=dtype)
+    if count == 0:
+        return data
+    chunk_bytes, layout = Layout(dtype, chunk_size)
+    nchunks = (count + chunk_size - 1) // chunk_size
+    raw = np.memmap(filename, dtype=np.uint8, mode='r', offset=HEADER_SIZE,
+                    shape=(nchunks * chunk_bytes,))
+    for chunk in range(nchunks):
+        first = chunk * chunk_size
+        n = min(chunk_size, count - first)
+        base = chunk * chunk_bytes
+        for name, field, start in layout:
+            start += base
+            data[name][first:first + n] = raw[
+                start:start + n * field.itemsize].view(field)
+    return data
+
+# ------------------------------------------------------------------------------
+# Analysis of the records loaded from a telemetry file.
+
+def Guided(data):
+    # records of frames guided on
+    flags = data['flags']
+    return data[(flags & GUIDING != 0) & (flags & LOST == 0)]
+
+def RMS(data):
+    # rms offset of the star from the guide box in x, y and overall (pixels)
+    dx = data['dx'].astype(np.float64)
+    dy = data['dy'].astype(np.float64)
+    if len(dx) == 0:
+        return np.nan, np.nan, np.nan
+    return (np.sqrt(np.mean(dx**2)), np.sqrt(np.mean(dy**2)),
+            np.sqrt(np.mean(dx**2 + dy**2)))
+
+def Runs(t, max_gap=5.0):
+    # slices of the records between gaps of more than max_gap times the
+    # usual time between frames, or where the time goes back
+    if len(t) < 2:
+        return [slice(0, len(t))]
+    dt = np.diff(t)
+    breaks = np.flatnonzero((dt > max_gap * np.median(dt)) | (dt <= 0)) + 1
+    edges = np.concatenate([[0], breaks, [len(t)]])
+    return [slice(a, b) for a, b in zip(edges[:-1], edges[1:])]
+
+def PowerSpectrum(data, field='dx', segment=256):
+    # Power spectral density of a field (pixels^2/Hz) against frequency
+    # (Hz), from Welch's method on each uninterrupted run of records,
+    # resampled to the median time between frames, and averaged over the
+    # runs, weighted by their length.  None if no run is long enough.
+    t = data['time']
+    if len(t) < 2:
+        return None
+    dt = np.median(np.diff(t))
+    if not dt > 0:
+        return None
+    total = None
+    weight = 0
+    for run in Runs(t):
+        tr = t[run]
+        if len(tr) < segment:
+            continue
+        grid = np.arange(tr[0], tr[-1], dt)
+        values = np.interp(grid, tr, data[field][run].astype(np.float64))
+        freqs, power = welch(values, fs=1 / dt, nperseg=segment)
+        if total is None:
+            total = power * len(grid)
+        else:
+            total += power * len(grid)
+        weight += len(grid)
+    if total is None:
+        return None
+    return freqs, total / weight
+
+def Peaks(freqs, power, n=3):
+    # periods (seconds) of the n strongest peaks, leaving out the lowest
+    # frequency, which holds the drift
+    freqs, power = freqs[1:], power[1:]
+    local = np.flatnonzero((power[1:-1] > power[:-2]) &
+                           (power[1:-1] >= power[2:])) + 1
+    strongest = local[np.argsort(power[local])[::-1][:n]]
+    return 1 / freqs[strongest], power[strongest]
+
+def LatencyHistogram(data, field='latency', bin_width=0.005):
+    # (counts, bin edges in seconds) of the latency of the corrections made
+    values = data[field]
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(1)
+    edges = np.arange(0, values.max() + bin_width, bin_width)
+    if len(edges) < 2:
+        edges = np.array([0.0, bin_width])
+    return np.histogram(values, edges)
+
+def Percentiles(values):
+    # median, 90% and maximum in ms, as in aobenchmark.py
+    ms = values[np.isfinite(values)] * 1000
+    if len(ms) == 0:
+        return 'none'
+    return 'median {:.1f} ms, 90% {:.1f} ms, max {:.1f} ms'.format(
+        np.median(ms), np.percentile(ms, 90), ms.max())
+
+def Summary(data):
+    flags = data['flags']
+    guided = Guided(data)
+    lines = []
+    # guiding time, leaving out the gaps
+    span = sum(data['time'][run][-1] - data['time'][run][0]
+               for run in Runs(data['time']) if run.stop > run.start)
+    lines.append('{:d} frames over {:.1f} hours, {:d} guiding, {:d} star '
+                 'lost'.format(len(data), span / 3600, len(guided),
+                               int(np.sum((flags & GUIDING != 0) &
+                                          (flags & LOST != 0)))))
+    lines.append('RMS offset ({:.3f},{:.3f}) pixels, {:.3f} overall'.format(
+        *RMS(guided)))
+    sent = flags & SENT != 0
+    lines.append('{:d} corrections sent, {:d} made, {:d} dropped'.format(
+        int(sent.sum()), int(np.sum(flags & MADE != 0)),
+        int(np.sum(flags & DROPPED != 0))))
+    lines.append('Frame to correction: {}'.format(
+        Percentiles(data['delay'][sent])))
+    lines.append('Correction to AO acknowledgement: {}'.format(
+        Percentiles(data['latency'][sent])))
+    for field in ('dx', 'dy'):
+        spectrum = PowerSpectrum(guided, field)
+        if spectrum is None:
+            continue
+        periods, power = Peaks(*spectrum)
+        lines.append('Strongest periods in {}: {}'.format(field, ', '.join(
+            '{:.1f} sec'.format(p) for p in periods)))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise guiding '
+                                     'telemetry')
+    parser.add_argument('filenames', nargs='+')
+    parser.add_argument('--histogram', action='store_true',
+                        help='show the AO acknowledgement latencies')
+    args = parser.parse_args()
+    for filename in args.filenames:
+        data = Load(filename)
+        print('{}:'.format(filename))
+        print(Summary(data))
+        if args.histogram:
+            counts, edges = LatencyHistogram(data)
+            scale = 50 / max(counts.max(), 1) if len(counts) else 0
+            for count, edge in zip(counts, edges):
+                print('{:6.0f} ms {:7d} {}'.format(edge * 1000, count,
+                                                   '#' * int(count * scale)))
+
+if __name__ == '__main__':
+    main()
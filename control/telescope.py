@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# telescope.py
+
+from datetime import datetime, timedelta
+from collections import namedtuple
+import numpy as np
+
+from orchestrator import DeviceWorker, Task, Delay, scheduler
+from logservice import logs, SourceOf
+
+try:
+    import win32com.client
+    import pythoncom
+except ImportError:
+    win32com = None
+
+# Snapshot of the telescope, read by TelescopeDevice.PollState: the UTC
+# time it was read on the PC, the telescope's own time, position (RA in
+# hours, Dec in degrees), whether it is slewing, tracking and pulse
+# guiding, and the PC time it was last seen to move.
+TelescopeState = namedtuple('TelescopeState',
+                            ['time', 'utc', 'ra', 'dec', 'slewing',
+                             'tracking', 'pulse_guiding', 'last_move'])
+
+# ------------------------------------------------------------------------------
+# Telescope, run on its own thread.
+# The ASCOM driver object is created and used only on this thread, and
+# every action returns an Operation (see orchestrator.py), so nothing
+# here blocks the wx main thread.
+# Once StartPolling is called, the state of the telescope is also read
+# every poll_period seconds, in between other calls, and kept in state
+# (see TelescopeState), which any thread can read without waiting for
+# the driver.  Functions added with AddStateCallback are called on this
+# thread with each new state that differs from the last by more than the
+# time, and failed is set to the exception if reading the state fails,
+# which stops the polling.
+# The telescope counts as moving while slewing, or if its position
+# changes by more than move_threshold between polls.
+class TelescopeDevice(DeviceWorker):
+    def __init__(self, parent, driver_id="ASCOM.Celestron.Telescope",
+                 poll_period=1.0):
+        self.parent = parent
+        self.driver_id = driver_id
+        self.tel = None
+        self.poll_period = poll_period  # seconds
+        self.move_threshold = 15.0  # arcsec
+        self.state = None
+        self.failed = None
+        self.polling = False
+        self.state_callbacks = []
+        self.last_move = datetime.utcnow()
+        # how often to check whether slews and pulse guides have finished
+        self.slew_check_period = 0.2  # seconds
+        self.pulse_check_period = 0.02  # seconds
+        self.slew_timeout = 300.0  # seconds
+        self.settle_time = 2.0  # seconds
+        DeviceWorker.__init__(self, driver_id)
+
+    def Setup(self):
+        self.tel = win32com.client.Dispatch(self.driver_id)
+
+    def Teardown(self):
+        self.tel = None
+
+    def Stop(self):
+        self.polling = False
+        DeviceWorker.Stop(self)
+
+    def Log(self, text):
+        logs.Post(text, SourceOf(self.parent))
+
+    def Connect(self):
+        return self.Submit(self.DoConnect)
+
+    def DoConnect(self):
+        if not self.tel.Connected:
+            try:
+                self.tel.Connected = True
+            except pythoncom.com_error as error:
+                pass
+        if not self.tel.Connected:
+            self.Log("Unable to connect to telescope")
+            return False
+        self.Log("Connected to telescope")
+        self.Log("Telescope time is {}".format(self.tel.UTCDate))
+        if not self.tel.Tracking:
+            self.tel.Tracking = True
+        if self.tel.Tracking:
+            self.Log("Telescope tracking")
+        else:
+            self.Log("Unable to start telescope tracking")
+        now = self.tel.UTCDate
+        now = datetime(now.year, now.month, now.day,
+                       now.hour, now.minute, now.second,
+                       now.msec * 1000)
+        time_offset = abs(now - datetime.utcnow())
+        if time_offset > timedelta(seconds=1):
+            self.Log("Warning: PC and telescope times do not agree!")
+        return True
+
+    def Disconnect(self):
+        return self.Submit(self.DoDisconnect)
+
+    def DoDisconnect(self):
+        self.tel.Connected = False
+
+    def StartPolling(self):
+        if not self.polling:
+            self.polling = True
+            self.calls.put((None, self.PollState, (), {}))
+
+    def StopPolling(self):
+        self.polling = False
+
+    def AddStateCallback(self, func):
+        self.state_callbacks.append(func)
+
+    def PollState(self):
+        if not self.polling:
+            return
+        try:
+            state = self.ReadState()
+        except Exception as detail:
+            self.polling = False
+            self.failed = detail
+            return
+        finally:
+            if self.polling:
+                scheduler.CallLater(self.poll_period, self.EnqueuePoll)
+        last, self.state = self.state, state
+        if last is None or state[2:] != last[2:]:
+            for func in list(self.state_callbacks):
+                func(state)
+
+    def EnqueuePoll(self):
+        if self.polling:
+            self.calls.put((None, self.PollState, (), {}))
+
+    def ReadState(self):
+        tel = self.tel
+        utc = tel.UTCDate
+        ra, dec = tel.RightAscension, tel.Declination
+        slewing = tel.Slewing
+        now = datetime.utcnow()
+        last = self.state
+        if slewing or (last is not None and Separation(
+                last.ra * 15, last.dec, ra * 15, dec) * 3600 >
+                       self.move_threshold):
+            self.last_move = now
+        return TelescopeState(now, utc, ra, dec, slewing, tel.Tracking,
+                              tel.IsPulseGuiding, self.last_move)
+
+    def Get(self, *names):
+        # read one or more driver properties
+        def get():
+            values = tuple(getattr(self.tel, name) for name in names)
+            return values[0] if len(values) == 1 else values
+        return self.Submit(get)
+
+    def Slew(self, ra_hours, dec_deg):
+        # slew, wait for the slew to finish and then for the mount to settle
+        task = Task(self.SlewSteps(ra_hours, dec_deg), name='slew')
+        task.AddCancelHook(self.Abort)
+        return task
+
+    def SlewSteps(self, ra_hours, dec_deg):
+        yield self.Submit(self.StartSlew, ra_hours, dec_deg)
+        yield self.Poll(lambda: not self.tel.Slewing, self.slew_check_period,
+                        timeout=self.slew_timeout, name='slewing')
+        yield Delay(self.settle_time, name='settle')
+
+    def StartSlew(self, ra_hours, dec_deg):
+        self.tel.TargetRightAscension = ra_hours
+        self.tel.TargetDeclination = dec_deg
+        if self.tel.CanSlewAsync:
+            self.tel.SlewToTargetAsync()
+        else:
+            self.tel.SlewToTarget()
+
+    def Abort(self):
+        self.Submit(lambda: self.tel.AbortSlew())
+
+    def PulseGuide(self, direction, duration):
+        # duration in milliseconds; direction as ASCOM GuideDirections
+        return Task(self.PulseGuideSteps([(direction, duration)]),
+                    name='pulse guide')
+
+    def PulseGuideSteps(self, pulses):
+        for direction, duration in pulses:
+            yield self.Submit(self.DoPulseGuide, direction, duration)
+        yield self.Poll(lambda: not self.tel.IsPulseGuiding,
+                        self.pulse_check_period, name='pulse guiding')
+
+    def Offset(self, dra, ddec, rate=0.1):
+        # offset by (dra, ddec) arcsec, at the given guide rate in deg/sec
+        return Task(self.OffsetSteps(dra, ddec, rate), name='offset')
+
+    def OffsetSteps(self, dra, ddec, rate):
+        ra_rate, dec_rate = yield self.Submit(self.SetGuideRates, rate)
+        pulses = []
+        direction = 2 if dra > 0 else 3
+        offset_time = abs(dra / ra_rate / 3.6)
+        self.Log('Pulse guiding: direction {}, time {}'.format(direction,
+                                                              offset_time))
+        pulses.append((direction, offset_time))
+        direction = 0 if ddec > 0 else 1
+        offset_time = abs(ddec / dec_rate / 3.6)
+        self.Log('Pulse guiding: direction {}, time {}'.format(direction,
+                                                              offset_time))
+        pulses.append((direction, offset_time))
+        for step in self.PulseGuideSteps(pulses):
+            yield step
+
+    def DoPulseGuide(self, direction, duration):
+        self.tel.PulseGuide(direction, duration)
+
+    def SetGuideRates(self, rate):
+        # the mount may not support exactly the requested rate
+        self.tel.GuideRateRightAscension = rate
+        self.tel.GuideRateDeclination = rate
+        return self.tel.GuideRateRightAscension, self.tel.GuideRateDeclination
+
+def Separation(ra1, dec1, ra2, dec2):
+    # angular separation in degrees between positions in degrees, as
+    # numbers or arrays, with the Vincenty formula as used by astropy
+    ra1, dec1, ra2, dec2 = np.radians([ra1, dec1, ra2, dec2])
+    dra = ra2 - ra1
+    sin1, cos1 = np.sin(dec1), np.cos(dec1)
+    sin2, cos2 = np.sin(dec2), np.cos(dec2)
+    num = np.hypot(cos2 * np.sin(dra), cos1 * sin2 - sin1 * cos2 * np.cos(dra))
+    den = sin1 * sin2 + cos1 * cos2 * np.cos(dra)
+    return np.degrees(np.arctan2(num, den))
+
+def Sexagesimal(value, units='hms', precision=1, sign=False):
+    # value as e.g. 05h31m04.2s (units 'hms') or +21d02m11.0s ('dms'),
+    # the same as astropy's Angle.to_string with pad=True
+    negative = value < 0
+    seconds = round(abs(value) * 3600, precision)
+    degrees, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    width = 3 + precision if precision else 2
+    text = '{:02d}{}{:02d}{}{:0{}.{}f}{}'.format(
+        int(degrees), units[0], int(minutes), units[1], seconds, width,
+        precision, units[2])
+    if negative:
+        return '-' + text
+    return ('+' + text) if sign else text
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+# timing.py
+
+import sys
+import time
+
+# Clock for measuring intervals, which is not affected by changes to the
+# system time.  Python 2 has no time.monotonic; on Windows time.clock is
+# a high resolution counter, elsewhere fall back to time.time.
+if hasattr(time, 'monotonic'):
+    clock = time.monotonic
+elif sys.platform == 'win32':
+    clock = time.clock
+else:
+    clock = time.time